@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Compare the JPEG quality search strategies (see QUALITY_SEARCH_STRATEGIES),
+using a few deterministic synthetic images, by the selected quality, number
+of encodes per image and time spent.
+
+Usage: python3 benchmarks/bench_quality_search.py [ROUNDS]
+"""
+import sys
+from timeit import default_timer as timer
+
+from PIL import Image, ImageFilter
+
+from optimize_images.img_dynamic_quality import QUALITY_SEARCH_STRATEGIES
+from optimize_images.img_dynamic_quality import search_jpeg_quality
+
+
+def make_test_images():
+    size = (1600, 1200)
+    gradient = Image.linear_gradient("L").resize(size)
+    noise = Image.effect_noise(size, 40)
+    fractal = Image.effect_mandelbrot(size, (-2.0, -1.5, 1.0, 1.5), 100)
+    return {
+        "gradient": Image.merge("RGB", (gradient, gradient.rotate(90), fractal)),
+        "noise": Image.merge("RGB", (noise, gradient, noise.filter(ImageFilter.BLUR))),
+        "fractal": Image.merge("RGB", (fractal, fractal.rotate(180), gradient)),
+    }
+
+
+def main(rounds: int):
+    images = make_test_images()
+    for name in QUALITY_SEARCH_STRATEGIES:
+        encodes = 0
+        qualities = []
+        start = timer()
+        for _ in range(rounds):
+            for img in images.values():
+                result = search_jpeg_quality(img, strategy=name)
+                encodes += result.encodes
+                qualities.append(result.quality)
+        elapsed = timer() - start
+        searches = rounds * len(images)
+        print(f"{name:>10}: {encodes / searches:.1f} encodes/image, "
+              f"{elapsed / searches * 1000:.1f} ms/image, "
+              f"qualities {qualities[:len(images)]}")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Compare the current rebuild_palette() implementation with the original
+per-pixel (getpixel/putpixel) one, using large synthetic mode "P" images.
+
+Usage: python3 benchmarks/bench_rebuild_palette.py [WIDTH HEIGHT]
+"""
+import sys
+from timeit import default_timer as timer
+from typing import Tuple
+
+from PIL import Image
+
+from optimize_images.img_aux_processing import rebuild_palette
+
+
+def legacy_rebuild_palette(img: Image.Image) -> Tuple[Image.Image, int]:
+    """ The original implementation, visiting every pixel in Python. """
+    width, height = img.size
+    img = img.convert("RGBA")
+    palette = []
+    alpha_layer = Image.new("L", img.size)
+
+    for x in range(width):
+        for y in range(height):
+            red, green, blue, alpha = img.getpixel((x, y))
+            alpha_layer.putpixel((x, y), alpha)
+            if (red, green, blue) not in palette:
+                palette.append((red, green, blue))
+
+    img.putalpha(alpha_layer)
+    flat_palette = []
+    for rgb in palette:
+        flat_palette = flat_palette + list(rgb)
+    img = img.convert("P", palette=flat_palette, colors=len(palette))
+    return img, len(img.getcolors())
+
+
+def make_indexed_image(width: int, height: int) -> Image.Image:
+    """ A deterministic mode "P" image with 256 colors and transparency. """
+    img = Image.effect_noise((width, height), 64).convert("RGB")
+    img = img.quantize(256)
+    img.info["transparency"] = 0
+    return img
+
+
+def main(width: int, height: int):
+    img = make_indexed_image(width, height)
+
+    start = timer()
+    new_img, new_colors = rebuild_palette(img)
+    new_time = timer() - start
+
+    start = timer()
+    old_img, old_colors = legacy_rebuild_palette(img)
+    old_time = timer() - start
+
+    assert new_colors == old_colors
+    assert new_img.tobytes() == old_img.tobytes()
+    assert new_img.getpalette() == old_img.getpalette()
+
+    print(f"rebuild_palette on a {width}x{height} mode P image:")
+    print(f"  per-pixel: {old_time:.3f}s")
+    print(f"  current:   {new_time:.3f}s ({old_time / new_time:.0f}x faster)")
+
+
+if __name__ == "__main__":
+    size = [int(arg) for arg in sys.argv[1:3]] or [2000, 1500]
+    main(*size)
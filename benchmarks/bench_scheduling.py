@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Compare the time needed to process a mixed set of images (many small icons,
+some medium photos and a few huge panoramas, found last) when submitting one
+task at a time in the order the files are found, and when using size-aware
+scheduling (most expensive first, small images in chunks).
+
+The difference depends on the number of CPU cores: the longest-first order
+only helps when there are several workers that could otherwise be left idle
+at the end. So, besides the actual run, the time each image takes to process
+is measured and used to simulate both orders with 2 to 16 workers (ignoring
+the communication overhead).
+
+Usage: python3 benchmarks/bench_scheduling.py [JOBS]
+"""
+import heapq
+import os
+import random
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import cpu_count
+from timeit import default_timer as timer
+
+from PIL import Image, ImageFilter
+
+from optimize_images.constants import MAX_TASKS_IN_FLIGHT_PER_WORKER
+from optimize_images.data_structures import BatchOptions
+from optimize_images.do_optimization import do_optimization
+from optimize_images.file_utils import search_images
+from optimize_images.scheduler import _Window, preflight, run_tasks
+
+
+def make_photo(width: int, height: int, seed: int) -> Image.Image:
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.frombytes("L", (width, height), random.Random(seed).randbytes(width * height))
+    noise = Image.blend(gradient, noise.filter(ImageFilter.GaussianBlur(2)), 0.3)
+    return Image.merge("RGB", (gradient, noise, gradient.rotate(180)))
+
+
+def make_corpus(folder: str) -> None:
+    """ Files are named so that the huge ones are found last. """
+    for i in range(300):
+        make_photo(32, 32, i).save(os.path.join(folder, f"a_icon{i:03}.png"))
+    for i in range(20):
+        make_photo(1200, 900, i).save(os.path.join(folder, f"b_photo{i:02}.jpg"), quality=95)
+    for i in range(3):
+        make_photo(6000, 2000, i).save(os.path.join(folder, f"c_panorama{i}.jpg"), quality=95)
+
+
+def run(corpus: str, jobs: int, window_size: int) -> float:
+    with tempfile.TemporaryDirectory() as work_dir:
+        folder = os.path.join(work_dir, "images")
+        shutil.copytree(corpus, folder)
+        options = BatchOptions(folder, use_cache=False)
+        tasks = (options.task_for(path) for path in sorted(search_images(folder, recursive=False)))
+
+        start = timer()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for _ in run_tasks(executor, tasks, jobs * MAX_TASKS_IN_FLIGHT_PER_WORKER,
+                               window_size=window_size):
+                pass
+        return timer() - start
+
+
+def measure_durations(corpus: str) -> dict:
+    with tempfile.TemporaryDirectory() as work_dir:
+        folder = os.path.join(work_dir, "images")
+        shutil.copytree(corpus, folder)
+        options = BatchOptions(folder, use_cache=False)
+        durations = {}
+        for path in sorted(search_images(folder, recursive=False)):
+            start = timer()
+            do_optimization(options.task_for(path))
+            durations[os.path.basename(path)] = timer() - start
+        return durations
+
+
+def makespan(submissions: list, workers: int) -> float:
+    """ The time until the last worker finishes, when each submission is
+        taken by the first worker available.
+    """
+    finish_times = [0.0] * workers
+    for duration in submissions:
+        heapq.heappush(finish_times, heapq.heappop(finish_times) + duration)
+    return max(finish_times)
+
+
+def simulate(corpus: str, durations: dict) -> None:
+    options = BatchOptions(corpus)
+    window = _Window(256)
+    for seq, path in enumerate(sorted(search_images(corpus, recursive=False))):
+        window.add(preflight(seq, options.task_for(path)))
+    chunks = []
+    while window:
+        chunks.append(window.pop_next())
+
+    in_order = [durations[name] for name in sorted(durations)]
+    size_aware = [sum(durations[os.path.basename(item.task.src_path)] for item in chunk)
+                  for chunk in chunks]
+    print(f"\nSimulated ({len(in_order)} vs. {len(size_aware)} submissions):")
+    for workers in (2, 4, 8, 16):
+        ideal = sum(in_order) / workers
+        print(f"{workers:>3} workers: {makespan(in_order, workers):.2f}s in order, "
+              f"{makespan(size_aware, workers):.2f}s size-aware (ideal {ideal:.2f}s)")
+
+
+def main(jobs: int):
+    with tempfile.TemporaryDirectory() as corpus:
+        make_corpus(corpus)
+        print(f"{len(os.listdir(corpus))} images, {jobs} jobs, {cpu_count()} CPUs\n")
+        # A window of one task is the same as submitting them in order, one by one
+        for label, window_size in (("in order, one by one", 1), ("size-aware", 256)):
+            elapsed = min(run(corpus, jobs, window_size) for _ in range(3))
+            print(f"{label:>22}: {elapsed:.2f}s")
+
+        simulate(corpus, measure_durations(corpus))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else cpu_count())
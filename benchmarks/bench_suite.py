@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# encoding: utf-8
+"""
+Time each stage of the image processing (quality search, palette rebuild,
+color reduction, resizing...) and the full JPEG/PNG optimization paths, using
+deterministic synthetic images at several resolutions and color modes.
+
+The results can be saved as JSON and compared with a previous run, in order
+to detect performance regressions between versions:
+
+    python3 benchmarks/bench_suite.py --output before.json
+    (...change something...)
+    python3 benchmarks/bench_suite.py --output after.json --compare before.json
+
+Usage: python3 benchmarks/bench_suite.py [-h] [--sizes SIZES] [--rounds N]
+                                         [--filter TEXT] [--output PATH]
+                                         [--compare PATH] [--threshold RATIO]
+"""
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+from io import BytesIO
+from timeit import default_timer as timer
+from typing import Any, Callable, Dict, List, NamedTuple, Tuple
+
+import PIL
+from PIL import Image, ImageFilter
+
+from optimize_images import __version__
+from optimize_images.data_structures import BatchOptions
+from optimize_images.img_aux_processing import do_reduce_colors, downsize_img
+from optimize_images.img_aux_processing import rebuild_palette, remove_transparency
+from optimize_images.img_dynamic_quality import get_diff_at_quality, jpeg_dynamic_quality
+from optimize_images.img_info import is_big_png_photo, open_image_data
+from optimize_images.img_optimize_jpg import optimize_jpg
+from optimize_images.img_optimize_png import optimize_png
+
+SIZES = {
+    "small": (320, 240),
+    "medium": (1600, 1200),
+    "large": (4000, 3000),
+}
+
+
+class Benchmark(NamedTuple):
+    name: str
+    # Prepares the arguments for a single (timed) call, from the test images.
+    setup: Callable[[Dict[str, Any]], Tuple]
+    func: Callable
+
+
+# ==============================[ Test images ]==============================
+
+def make_photo(size: Tuple[int, int], seed: int = 1) -> Image.Image:
+    """ A deterministic photo-like RGB image: smooth areas, edges and noise. """
+    width, height = size
+    gradient = Image.linear_gradient("L").resize(size)
+    fractal = Image.effect_mandelbrot(size, (-2.0, -1.5, 1.0, 1.5), 100)
+    noise = Image.frombytes("L", size, random.Random(seed).randbytes(width * height))
+    noise = Image.blend(gradient, noise.filter(ImageFilter.GaussianBlur(2)), 0.3)
+    return Image.merge("RGB", (gradient.rotate(180), noise, fractal))
+
+
+def make_images(size: Tuple[int, int]) -> Dict[str, Any]:
+    photo = make_photo(size)
+    alpha = Image.radial_gradient("L").resize(size)
+    rgba = photo.copy()
+    rgba.putalpha(alpha)
+    palette = photo.quantize(256)
+
+    encoded = {}
+    for name, img, fmt in (("jpeg", photo, "JPEG"),
+                           ("png_rgb", photo, "PNG"),
+                           ("png_rgba", rgba, "PNG"),
+                           ("png_p", palette, "PNG")):
+        buffer = BytesIO()
+        img.save(buffer, fmt, quality=95) if fmt == "JPEG" else img.save(buffer, fmt)
+        encoded[name] = buffer.getvalue()
+
+    return {"photo": photo, "rgba": rgba, "palette": palette, "encoded": encoded}
+
+
+# ==============================[ Benchmarks ]===============================
+
+def _task(name: str):
+    return BatchOptions(name).task_for(name)
+
+
+BENCHMARKS: List[Benchmark] = [
+    Benchmark("jpeg_dynamic_quality",
+              lambda images: (images["photo"],),
+              jpeg_dynamic_quality),
+    Benchmark("get_diff_at_quality",
+              lambda images: (images["photo"], 80),
+              get_diff_at_quality),
+    Benchmark("rebuild_palette",
+              lambda images: (images["palette"].copy(),),
+              rebuild_palette),
+    Benchmark("do_reduce_colors[RGBA]",
+              lambda images: (images["rgba"].copy(), 256),
+              do_reduce_colors),
+    Benchmark("do_reduce_colors[P]",
+              lambda images: (images["palette"].copy(), 64),
+              do_reduce_colors),
+    Benchmark("is_big_png_photo",
+              lambda images: (open_image_data(images["encoded"]["png_rgb"], "bench.png"),),
+              is_big_png_photo),
+    Benchmark("downsize_img[JPEG file]",
+              lambda images: (open_image_data(images["encoded"]["jpeg"]).img,
+                              images["photo"].width // 3, 0),
+              downsize_img),
+    Benchmark("remove_transparency",
+              lambda images: (images["rgba"].copy(), (255, 255, 255)),
+              remove_transparency),
+    Benchmark("optimize_jpg",
+              lambda images: (_task("bench.jpg"),
+                              open_image_data(images["encoded"]["jpeg"], "bench.jpg"),
+                              BytesIO()),
+              optimize_jpg),
+    Benchmark("optimize_png[RGBA]",
+              lambda images: (_task("bench.png"),
+                              open_image_data(images["encoded"]["png_rgba"], "bench.png"),
+                              BytesIO()),
+              optimize_png),
+    Benchmark("optimize_png[P]",
+              lambda images: (_task("bench.png"),
+                              open_image_data(images["encoded"]["png_p"], "bench.png"),
+                              BytesIO()),
+              optimize_png),
+]
+
+
+def run_benchmark(benchmark: Benchmark, images: Dict[str, Any], rounds: int) -> Dict[str, float]:
+    # The first call (not timed) warms up any caches and lazy imports
+    benchmark.func(*benchmark.setup(images))
+
+    timings = []
+    for _ in range(rounds):
+        args = benchmark.setup(images)
+        start = timer()
+        benchmark.func(*args)
+        timings.append(timer() - start)
+
+    return {"min": min(timings),
+            "median": statistics.median(timings),
+            "mean": statistics.mean(timings),
+            "stdev": statistics.stdev(timings) if len(timings) > 1 else 0.0,
+            "rounds": rounds}
+
+
+def run_suite(sizes: List[str], rounds: int, name_filter: str) -> Dict[str, Any]:
+    results = {}
+    for size_name in sizes:
+        images = make_images(SIZES[size_name])
+        for benchmark in BENCHMARKS:
+            key = f"{benchmark.name}@{size_name}"
+            if name_filter and name_filter not in key:
+                continue
+            results[key] = run_benchmark(benchmark, images, rounds)
+            print(f"{key:<40} {results[key]['median'] * 1000:>10.2f} ms")
+
+    return {"version": __version__,
+            "pillow": PIL.__version__,
+            "python": platform.python_version(),
+            "machine": f"{platform.system()} {platform.machine()}",
+            "date": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "results": results}
+
+
+def compare(previous: Dict[str, Any], current: Dict[str, Any], threshold: float) -> int:
+    """ Show the change in median time of each benchmark, since a previous
+        run. Returns the number of benchmarks that are slower by more than
+        the specified threshold (e.g., 0.1 = 10%).
+    """
+    print(f"\nCompared with version {previous['version']} ({previous['date']}):\n")
+    regressions = 0
+    for key, result in current["results"].items():
+        old = previous["results"].get(key)
+        if old is None or not old["median"]:
+            continue
+        change = result["median"] / old["median"] - 1
+        flag = ""
+        if change > threshold:
+            flag = "  <-- slower"
+            regressions += 1
+        print(f"{key:<40} {old['median'] * 1000:>10.2f} ms {result['median'] * 1000:>10.2f} ms "
+              f"{change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--sizes", default="small,medium",
+                        help=f"Comma separated image sizes to use ({', '.join(SIZES)}).")
+    parser.add_argument("--rounds", type=int, default=3,
+                        help="The number of timed calls of each benchmark.")
+    parser.add_argument("--filter", default="",
+                        help="Only run the benchmarks whose name contains this text.")
+    parser.add_argument("--output", help="Save the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare with the results in this JSON file.")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="Report benchmarks slower than this ratio (default: 0.1).")
+    args = parser.parse_args()
+
+    sizes = [size.strip() for size in args.sizes.split(",") if size.strip()]
+    unknown = [size for size in sizes if size not in SIZES]
+    if unknown:
+        parser.error(f"unknown sizes: {', '.join(unknown)}")
+
+    current = run_suite(sizes, max(args.rounds, 1), args.filter)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(current, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            previous = json.load(file)
+        if compare(previous, current, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,2 @@
 __version__ = '2.0.0a1'
-from optimize_images.api import optimize_as_batch
+from optimize_images.api import optimize_as_batch, optimize_bytes
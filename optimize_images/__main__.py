@@ -27,9 +27,10 @@ the features depending on them should be treated as optional.
 
 © 2025 Victor Domingos & contributers (MIT License)
 """
-import concurrent.futures.process
 import os
 import sys
+from contextlib import ExitStack
+from typing import Callable, Optional
 
 from optimize_images.exceptions import OIImagesNotFoundError, OIInvalidPathError
 from optimize_images.exceptions import OIKeyboardInterrupt
@@ -43,130 +44,165 @@ except ImportError:
 
 from timeit import default_timer as timer
 
-from optimize_images.file_utils import search_images
-from optimize_images.data_structures import OutputConfiguration, Task
-from optimize_images.do_optimization import do_optimization
+from optimize_images.api import iter_batch_results
+from optimize_images.constants import DEFAULT_MAX_PIXELS, DEFAULT_QUALITY_SEARCH
+from optimize_images.constants import MAX_TASKS_IN_FLIGHT_PER_WORKER
+from optimize_images.file_utils import ImageCounter
+from optimize_images.data_structures import BatchOptions, BatchResult, TaskResult
 from optimize_images.platforms import adjust_for_platform, IconGenerator
+from optimize_images.profiling import ProfileSummary
 from optimize_images.argument_parser import get_args
 from optimize_images.reporting import (show_file_status,
                                        show_final_report,
                                        show_img_exception,
-                                       human)
-
-
-def count_gen(gen):
-    l = list(gen)
-    return len(l), l
+                                       human,
+                                       overall_progress,
+                                       JsonLinesReport)
 
 
 def optimize_batch(src_path, watch_dir, recursive, quality, remove_transparency,
                    reduce_colors, max_colors, max_w, max_h, keep_exif, convert_all,
                    conv_big, force_del, bg_color, grayscale, ignore_size_comparison,
-                   fast_mode, jobs, output_config):
+                   fast_mode, jobs, output_config, use_cache=True,
+                   serve_address='', keep_timestamps=False,
+                   profile=False, json_lines='', ordered=False,
+                   max_memory=0, max_pixels=DEFAULT_MAX_PIXELS,
+                   huge_images='skip', by_content=False,
+                   png_budget=0.0, output_format='',
+                   quality_search=DEFAULT_QUALITY_SEARCH) -> Optional[BatchResult]:
     appstart = timer()
-    line_width, our_pool_executor, workers = adjust_for_platform()
+    workers = adjust_for_platform()[2]
 
     if jobs != 0:
         workers = jobs
 
-    found_files = 0
-    optimized_files = 0
-    skipped_files = 0
-    total_src_size = 0
-    total_bytes_saved = 0
-
-    if watch_dir:
+    options = BatchOptions(src_path, recursive, quality, remove_transparency,
+                           reduce_colors, max_colors, max_w, max_h, keep_exif,
+                           convert_all, conv_big, force_del, bg_color, grayscale,
+                           ignore_size_comparison, fast_mode, jobs, output_config,
+                           use_cache, keep_timestamps, profile, ordered, max_memory,
+                           max_pixels, huge_images, by_content, png_budget,
+                           output_format, quality_search)
+    batch = BatchResult()
+    profile_summary = ProfileSummary() if profile else None
+    json_report = JsonLinesReport(json_lines) if json_lines and not serve_address else None
+
+    def record(result: TaskResult):
+        batch.add(result, keep=False)
+        if profile_summary is not None:
+            profile_summary.add(result)
+        if json_report is not None:
+            json_report.add(result)
+
+    if serve_address:
+        from optimize_images.server import serve
+        serve(serve_address, options, workers)
+        return None
+
+    elif watch_dir:
         if not os.path.isdir(os.path.abspath(src_path)):
             msg = "\nPlease specify a valid path to an existing folder."
             raise OIInvalidPathError(msg)
 
-        watch_task = Task(src_path, quality, remove_transparency, reduce_colors,
-                          max_colors, max_w, max_h, keep_exif, convert_all,
-                          conv_big, force_del, bg_color, grayscale,
-                          ignore_size_comparison, fast_mode, output_config)
-
         from optimize_images.watch import watch_for_new_files
-        watch_for_new_files(watch_task)
-        return
+        watch_for_new_files(options.task_for(src_path), workers, json_report)
+        return None
+
+    completed = False
+    try:
+        _optimize_path(options, workers, appstart, record, batch)
+        completed = True
+    except OIKeyboardInterrupt:
+        # Report the images that were processed before the interruption
+        if batch.found_files:
+            show_final_report(batch.found_files, batch.optimized_files, batch.total_src_size,
+                              batch.total_bytes_saved, timer() - appstart, output_config,
+                              profile_summary)
+        raise
+    finally:
+        batch.elapsed_seconds = timer() - appstart
+        if json_report is not None:
+            json_report.finish(batch, completed)
+
+    if batch.found_files:
+        show_final_report(batch.found_files, batch.optimized_files, batch.total_src_size,
+                          batch.total_bytes_saved, batch.elapsed_seconds, output_config,
+                          profile_summary)
+    else:
+        msg = "\nNo supported image files were found in the specified directory."
+        raise OIImagesNotFoundError(msg)
+
+    return batch
+
+
+def _optimize_path(options: BatchOptions, workers: int, appstart: float,
+                   record: Callable[[TaskResult], None], batch: BatchResult):
+    src_path, output_config = options.src_path, options.output_config
+    line_width, our_pool_executor, _ = adjust_for_platform()
 
     # Optimize all images in a directory
-    elif os.path.isdir(src_path):
+    if os.path.isdir(src_path):
 
         if not output_config.quiet_mode and not output_config.show_only_summary:
             icons = IconGenerator()
-            recursion_txt = 'Recursively searching' if recursive else 'Searching'
+            recursion_txt = 'Recursively searching' if options.recursive else 'Searching'
             opt_msg = 'and optimizing image files'
-            exif_txt = '(keeping exif data) ' if keep_exif else ''
+            exif_txt = '(keeping exif data) ' if options.keep_exif else ''
             print(f"\n{recursion_txt} {opt_msg} {exif_txt}in:\n{src_path}\n")
 
-        tasks = (Task(img_path, quality, remove_transparency, reduce_colors,
-                      max_colors, max_w, max_h, keep_exif, convert_all, conv_big,
-                      force_del, bg_color, grayscale, ignore_size_comparison, fast_mode,
-                      output_config)
-                 for img_path in search_images(src_path, recursive=recursive))
+        # Count the images concurrently, only to show the overall progress
+        counter = ImageCounter(src_path, options.recursive, options.by_content)
+        if output_config.show_overall_progress:
+            counter.start()
+
+        max_in_flight = workers * MAX_TASKS_IN_FLIGHT_PER_WORKER
+        executors = []
+        with ExitStack() as stack:
+            # A new pool replaces the current one if a worker process crashes
+            def new_executor():
+                executors.append(stack.enter_context(our_pool_executor(max_workers=workers)))
+                return executors[-1]
 
-        num_images, tasks = count_gen(tasks)
-        with our_pool_executor(max_workers=workers) as executor:
-            current_img = ''
             try:
-                for result in executor.map(do_optimization, tasks):
-                    current_img = result.img
-                    found_files += 1
-                    total_src_size += result.orig_size
-                    if result.was_optimized:
-                        optimized_files += 1
-                        total_bytes_saved += result.orig_size - result.final_size
-                    else:
-                        skipped_files += 1
+                for result in iter_batch_results(options, new_executor(), max_in_flight,
+                                                 new_executor):
+                    record(result)
 
                     if result.output_config.quiet_mode or result.output_config.show_only_summary:
                         continue
 
+                    if result.error:
+                        show_img_exception(result.error, result.img)
+
                     if result.output_config.show_overall_progress:
                         cur_time_passed = round(timer() - appstart)
-                        perc_done = found_files / num_images * 100
-                        message = f"[{cur_time_passed:.1f}s {perc_done:.1f}%] {icons.optimized} {optimized_files} {icons.skipped} {skipped_files}, saved {human(total_bytes_saved)}"
+                        progress = overall_progress(batch.found_files, counter.count,
+                                                    counter.finished)
+                        message = f"[{cur_time_passed:.1f}s {progress}] {icons.optimized} {batch.optimized_files} {icons.skipped} {batch.skipped_files}, saved {human(batch.total_bytes_saved)}"
                         print(message, end='\r')
                     else:
                         show_file_status(result, line_width, icons)
 
-            except concurrent.futures.process.BrokenProcessPool as bppex:
-                show_img_exception(bppex, current_img)
             except KeyboardInterrupt:
+                # Don't wait for the images that were not processed yet
+                for executor in executors:
+                    executor.shutdown(wait=False, cancel_futures=True)
                 msg = "\b \n\n  == Operation was interrupted by the user. ==\n"
                 raise OIKeyboardInterrupt(msg)
 
     # Optimize a single image
     elif os.path.isfile(src_path) and '~temp~' not in src_path:
-        found_files += 1
-
-        img_task = Task(src_path, quality, remove_transparency, reduce_colors,
-                        max_colors, max_w, max_h, keep_exif, convert_all, conv_big,
-                        force_del, bg_color, grayscale, ignore_size_comparison, fast_mode,
-                        output_config)
-
-        result = do_optimization(img_task)
-        total_src_size = result.orig_size
-        if result.was_optimized:
-            optimized_files = 1
-            total_bytes_saved = result.orig_size - result.final_size
+        for result in iter_batch_results(options):
+            record(result)
 
-        if not result.output_config.quiet_mode and not result.output_config.show_only_summary:
-            icons = IconGenerator()
-            show_file_status(result, line_width, icons)
+            if not result.output_config.quiet_mode and not result.output_config.show_only_summary:
+                icons = IconGenerator()
+                show_file_status(result, line_width, icons)
     else:
         msg = "\nNo image files were found. Please enter a valid path to the " \
               "image file or the folder containing any images to be processed."
         raise OIImagesNotFoundError(msg)
 
-    if found_files:
-        time_passed = timer() - appstart
-        show_final_report(found_files, optimized_files, total_src_size,
-                          total_bytes_saved, time_passed, output_config)
-    else:
-        msg = "\nNo supported image files were found in the specified directory."
-        raise OIImagesNotFoundError(msg)
-
 
 def main():
     args = get_args()
@@ -1,11 +1,146 @@
-from optimize_images.data_structures import TaskResult, Task
+import os
+from concurrent.futures import Executor
+from io import BytesIO
+from timeit import default_timer as timer
+from typing import BinaryIO, Callable, Iterator, Optional, Tuple
+
+from optimize_images.cache import ResultCache
+from optimize_images.constants import DEFAULT_MAX_PIXELS, DEFAULT_QUALITY_SEARCH
+from optimize_images.constants import MAX_TASKS_IN_FLIGHT_PER_WORKER
+from optimize_images.data_structures import BatchOptions, BatchResult, TaskResult, Task
 from optimize_images.do_optimization import do_optimization
+from optimize_images.exceptions import OIImagesNotFoundError
+from optimize_images.file_utils import DirectorySyncer, search_images
+from optimize_images.platforms import adjust_for_platform
+from optimize_images.scheduler import run_tasks
+
+
+def iter_batch_results(options: BatchOptions,
+                       executor: Optional[Executor] = None,
+                       max_in_flight: int = 0,
+                       new_executor: Optional[Callable[[], Executor]] = None
+                       ) -> Iterator[TaskResult]:
+    """ Try to reduce the file size of all images found in the specified path
+        (a folder or a single image file), yielding a TaskResult for each one
+        as soon as it is available (or in the order the images are found, if
+        options.ordered is True).
+
+    :param options: A BatchOptions object containing the path and all the
+                    parameters for the image processing.
+    :param executor: The executor to use when processing images in a folder.
+                     If not specified, the images are processed one by one,
+                     in the current thread.
+    :param max_in_flight: The maximum number of tasks submitted to the
+                          executor at a given time (by default, a few per job).
+    :param new_executor: A function to replace the executor if it breaks,
+                         because a worker process crashed. If not specified,
+                         BrokenExecutor is raised in that case.
+    """
+    src_path = options.src_path
+    if os.path.isdir(src_path):
+        img_paths = search_images(src_path, options.recursive, options.by_content)
+    elif os.path.isfile(src_path) and '~temp~' not in src_path:
+        img_paths = iter([src_path])
+    else:
+        msg = "\nNo image files were found. Please enter a valid path to the " \
+              "image file or the folder containing any images to be processed."
+        raise OIImagesNotFoundError(msg)
+
+    if not max_in_flight:
+        workers = options.jobs or adjust_for_platform()[2]
+        max_in_flight = workers * MAX_TASKS_IN_FLIGHT_PER_WORKER
+
+    tasks = (options.task_for(img_path) for img_path in img_paths)
+    cache = ResultCache() if options.use_cache else None
+    syncer = DirectorySyncer()
+    try:
+        for result in run_tasks(executor, tasks, max_in_flight, cache,
+                                ordered=options.ordered, new_executor=new_executor,
+                                max_memory=options.max_memory):
+            if result.was_optimized:
+                syncer.add(result.img)
+            yield result
+    finally:
+        syncer.sync()
+        if cache is not None:
+            cache.evict()
+            cache.close()
+
+
+def _warm_up_worker():
+    """ Import everything needed to process images, so that the first task
+        sent to each worker doesn't have to pay for it.
+    """
+    from PIL import Image
+    Image.init()
+
+
+class Optimizer:
+    """ Optimize batches of images, keeping a pool of worker processes (and
+        their imported modules) ready between calls.
+
+    Usage:
+
+        with Optimizer(jobs=4) as optimizer:
+            result = optimizer.optimize(BatchOptions('path/to/images'))
+    """
+
+    def __init__(self, jobs: int = 0):
+        _, self._pool_executor, workers = adjust_for_platform()
+        self.workers = jobs or workers
+        self.executor: Executor = self._new_pool()
+
+    def _new_pool(self) -> Executor:
+        executor = self._pool_executor(max_workers=self.workers, initializer=_warm_up_worker)
+        # Start all the workers now, instead of on demand
+        for future in [executor.submit(_warm_up_worker) for _ in range(self.workers)]:
+            future.result()
+        return executor
+
+    def _replace_pool(self) -> Executor:
+        """ Replace a pool that is broken, because a worker process crashed. """
+        self.executor.shutdown(wait=False)
+        self.executor = self._new_pool()
+        return self.executor
+
+    def optimize(self, options: BatchOptions) -> BatchResult:
+        """ Try to reduce the file size of all images found in the specified
+            path, using the specified options (options.jobs is ignored).
+
+        :return: A BatchResult object with the totals and all TaskResults.
+        """
+        start = timer()
+        batch = BatchResult()
+        max_in_flight = self.workers * MAX_TASKS_IN_FLIGHT_PER_WORKER
+        for result in iter_batch_results(options, self.executor, max_in_flight,
+                                         self._replace_pool):
+            batch.add(result)
+        batch.elapsed_seconds = timer() - start
+        return batch
+
+    def optimize_image(self, task: Task) -> TaskResult:
+        """ Try to reduce the file size of a single image, using the pool. """
+        return self.executor.submit(do_optimization, task).result()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
 
 
 def optimize_as_batch(src_path, watch_dir=False, recursive=True, quality=80, remove_transparency=False,
                       reduce_colors=False, max_colors=256, max_w=0, max_h=0, keep_exif=False,
                       convert_all=False, conv_big=False, force_del=False, bg_color=(255, 255, 255),
-                      grayscale=False, ignore_size_comparison=False, fast_mode=False, jobs=0):
+                      grayscale=False, ignore_size_comparison=False, fast_mode=False, jobs=0,
+                      use_cache=True, keep_timestamps=False,
+                      profile=False, max_memory=0, max_pixels=DEFAULT_MAX_PIXELS,
+                      huge_images='skip', png_budget=0.0,
+                      output_format='',
+                      quality_search=DEFAULT_QUALITY_SEARCH) -> Optional[BatchResult]:
     """ Try to reduce the file size of all images found in the specified path,
         using The specified parameters.
 
@@ -27,12 +162,34 @@ def optimize_as_batch(src_path, watch_dir=False, recursive=True, quality=80, rem
     :param ignore_size_comparison:
     :param fast_mode:
     :param jobs:
+    :param use_cache:
+    :param keep_timestamps:
+    :param profile:
+    :param max_memory:
+    :param max_pixels:
+    :param huge_images:
+    :param png_budget:
+    :param output_format:
+    :param quality_search:
+    :return: A BatchResult object with the totals and all TaskResults (or None
+             when watching a directory, which only returns when interrupted).
     """
-    from optimize_images.__main__ import optimize_batch as optimize
+    options = BatchOptions(src_path, recursive, quality, remove_transparency,
+                           reduce_colors, max_colors, max_w, max_h, keep_exif,
+                           convert_all, conv_big, force_del, bg_color, grayscale,
+                           ignore_size_comparison, fast_mode, jobs,
+                           use_cache=use_cache, keep_timestamps=keep_timestamps,
+                           profile=profile, max_memory=max_memory,
+                           max_pixels=max_pixels, huge_images=huge_images,
+                           png_budget=png_budget, output_format=output_format,
+                           quality_search=quality_search)
+    if watch_dir:
+        from optimize_images.watch import watch_for_new_files
+        watch_for_new_files(options.task_for(src_path), jobs or adjust_for_platform()[2])
+        return None
 
-    optimize(src_path, watch_dir, recursive, quality, remove_transparency, conv_big,
-             force_del, reduce_colors, max_colors, max_w, max_h, keep_exif, convert_all,
-             bg_color, grayscale, ignore_size_comparison, fast_mode, jobs)
+    with Optimizer(jobs) as optimizer:
+        return optimizer.optimize(options)
 
 
 def optimize_single_img(task: Task) -> TaskResult:
@@ -47,3 +204,49 @@ def optimize_single_img(task: Task) -> TaskResult:
        :return: A TaskResult object containing information for single file report.
        """
     return do_optimization(task)
+
+
+def optimize_bytes(data: bytes,
+                   options: Optional[BatchOptions] = None,
+                   name: str = '') -> Tuple[bytes, TaskResult]:
+    """ Try to reduce the size of an image file that is already in memory,
+        without reading from or writing to the disk.
+
+    :param data: The contents of the image file.
+    :param options: A BatchOptions object containing the parameters for the
+                    image processing (its src_path, recursive, jobs and
+                    use_cache fields are ignored).
+    :param name: A name (or path) to identify the image in the TaskResult.
+    :return: The resulting image file contents (the same data object, if it
+             could not be optimized) and a TaskResult object.
+    """
+    dest = BytesIO()
+    result = do_optimization(_task_for_data(name, options), data, dest)
+    return (dest.getvalue() if result.was_optimized else data), result
+
+
+def optimize_file_obj(src: BinaryIO,
+                      dest: BinaryIO,
+                      options: Optional[BatchOptions] = None,
+                      name: str = '') -> TaskResult:
+    """ Try to reduce the size of an image read from a file object (e.g., a
+        request body), writing the result (or the original image, if it could
+        not be optimized) to another file object.
+
+    :param src: A binary file object to read the image file from.
+    :param dest: A binary file object to write the resulting image file to.
+    :param options: A BatchOptions object containing the parameters for the
+                    image processing (its src_path, recursive, jobs and
+                    use_cache fields are ignored).
+    :param name: A name (or path) to identify the image in the TaskResult.
+    :return: A TaskResult object.
+    """
+    data = src.read()
+    result = do_optimization(_task_for_data(name, options), data, dest)
+    if not result.was_optimized:
+        dest.write(data)
+    return result
+
+
+def _task_for_data(name: str, options: Optional[BatchOptions]) -> Task:
+    return (options or BatchOptions(name)).task_for(name)
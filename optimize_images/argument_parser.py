@@ -3,13 +3,17 @@ import os
 import platform
 import re
 import sys
-from argparse import ArgumentParser
+from argparse import ArgumentParser, ArgumentTypeError
 
 import PIL  # it exists, was checked on main
 
 from optimize_images import __version__
-from optimize_images.constants import DEFAULT_QUALITY, SUPPORTED_FORMATS
+from optimize_images.constants import DEFAULT_MAX_PIXELS, DEFAULT_QUALITY, DEFAULT_QUALITY_SEARCH
+from optimize_images.constants import HUGE_IMAGE_POLICIES, SUPPORTED_FORMATS
+from optimize_images.constants import AUTO_OUTPUT_FORMAT, OUTPUT_FORMATS
 from optimize_images.data_structures import OutputConfiguration
+from optimize_images.img_dynamic_quality import QUALITY_SEARCH_STRATEGIES
+from optimize_images.img_output_formats import output_candidates
 
 
 def get_version_info() -> str:
@@ -39,6 +43,15 @@ def get_version_info() -> str:
            f'\n  - Watchdog {wd_version}\n\n'
 
 
+def parse_size(text: str) -> int:
+    """ Convert a size like 512M or 4G (or just a number of bytes) to bytes. """
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([KMGT]?)B?', text.strip(), re.IGNORECASE)
+    if not match:
+        raise ArgumentTypeError(f"invalid size: {text!r} (examples: 512M, 4G)")
+    number, unit = match.groups()
+    return int(float(number) * 1024 ** ' KMGT'.index(unit.upper() or ' '))
+
+
 def get_formats() -> str:
     """ Get a string that displays a list of supported formats. """
     formats = ', '.join(SUPPORTED_FORMATS).strip().upper()
@@ -77,12 +90,25 @@ def get_args():
     parser.add_argument('-nr', '--no-recursion', action='store_true',
                         help="Don't recurse through subdirectories.")
 
+    by_content_help = 'Find PNG and JPEG images by their content (reading the ' \
+                      'first few bytes of each file) instead of their file ' \
+                      'extension. Slower, but also finds image files with ' \
+                      'unusual names, and skips files that are not images.'
+    parser.add_argument('--by-content', action='store_true', help=by_content_help)
+
     parser.add_argument('-wd', '--watch-directory', action='store_true',
                         help='Watch a directory continuously for new files and '
                              'optimize any file as soon as it is created (file '
                              'paths are saved in a temporary list, so that each '
                              'file should just be processed once per session).')
 
+    serve_help = 'Run as a server, keeping a pool of workers ready and ' \
+                 'accepting optimization jobs from local clients through a ' \
+                 'Unix domain socket (unix:PATH) or a TCP port (HOST:PORT). ' \
+                 'Any other options specified are used as defaults for the jobs.'
+    parser.add_argument('--serve', dest="serve_address", metavar="ADDRESS",
+                        type=str, default='', help=serve_help)
+
     jobs_help = 'The max. number of simultaneous jobs to run at a given time. ' \
                 'The default value (0), for most platforms, will generate a ' \
                 'total of N + 1 processes, where N is the number of CPUs or ' \
@@ -91,6 +117,50 @@ def get_args():
     parser.add_argument('-jobs', dest="jobs",
                         type=int, default=0, help=jobs_help)
 
+    max_memory_help = 'The approximate max. amount of memory (e.g., 512M or ' \
+                      '4G) to use for processing images at a given time. ' \
+                      'The memory needed for each image is estimated from ' \
+                      'its dimensions, and fewer images are processed ' \
+                      'simultaneously if needed (images that need more than ' \
+                      'that are processed alone). By default, there is no limit.'
+    parser.add_argument('--max-memory', dest="max_memory", metavar="SIZE",
+                        type=parse_size, default=0, help=max_memory_help)
+
+    max_pixels_help = 'The max. number of pixels (width x height) of the ' \
+                      'images to be processed as usual. The default value ' \
+                      f'is {DEFAULT_MAX_PIXELS}, the same limit that Pillow ' \
+                      'uses to protect against decompression bomb attacks.'
+    parser.add_argument('--max-pixels', dest="max_pixels", metavar="PIXELS",
+                        type=int, default=DEFAULT_MAX_PIXELS, help=max_pixels_help)
+
+    huge_images_help = 'What to do with images that have more pixels than ' \
+                       'the limit (--max-pixels): skip them (default), ' \
+                       'process them alone (isolate), or downsize them to ' \
+                       'the limit when loading them.'
+    parser.add_argument('--huge-images', dest="huge_images", default='skip',
+                        choices=HUGE_IMAGE_POLICIES, help=huge_images_help)
+
+    nocache_help = "Don't use the result cache. By default, images that were " \
+                   "already processed in a previous run using the same " \
+                   "options, and haven't changed since then, are skipped."
+    parser.add_argument('--no-cache', action='store_true', help=nocache_help)
+
+    profile_help = 'Measure the time spent in each processing stage and the ' \
+                   'peak memory used, and show them by format in the final ' \
+                   'report.'
+    parser.add_argument('--profile', action='store_true', help=profile_help)
+
+    json_help = 'Write a JSON record for each image to the specified file, as ' \
+                'soon as it is processed, followed by a summary record ' \
+                '(JSON Lines format). Use - to write them to the standard ' \
+                'output, instead of the usual messages.'
+    parser.add_argument('--json-lines', dest="json_lines", metavar="PATH",
+                        type=str, default='', help=json_help)
+
+    ordered_help = 'Show the results in the order the images are found. By ' \
+                   'default, each result is shown as soon as it is available.'
+    parser.add_argument('--ordered', action='store_true', help=ordered_help)
+
     only_summary_help = 'Show only the summary'
     parser.add_argument('--only-summary', action='store_true', help=only_summary_help)
 
@@ -131,6 +201,19 @@ def get_args():
               'finish faster.'
     general_group.add_argument('-fm', '--fast-mode', action='store_true', help=fm_help)
 
+    kt_help = 'Keep the access and modification times of the original files ' \
+              '(by default, optimized files are marked as modified).'
+    general_group.add_argument('-kt', '--keep-timestamps', action='store_true', help=kt_help)
+
+    of_help = 'Convert the images to WebP or AVIF, using the quality that ' \
+              'attains the same quality threshold as for JPEG images, or ' \
+              'try all of them (auto) and keep the smallest result. By ' \
+              'default, the original files will remain untouched and will be ' \
+              'kept alongside the converted images (use -fd to delete them).'
+    general_group.add_argument('--output-format', dest="output_format", default='',
+                               choices=list(OUTPUT_FORMATS) + [AUTO_OUTPUT_FORMAT],
+                               help=of_help)
+
     jpg_msg = 'The following options apply only to JPEG image files.'
     jpg_group = parser.add_argument_group(
         'JPEG specific options'.upper(), description=jpg_msg)
@@ -140,6 +223,16 @@ def get_args():
     jpg_group.add_argument('-q', dest='quality',
                            type=int, help=q_help)
 
+    qs_help = 'The method used to select the quality setting for each image ' \
+              '(unless in fast mode): secant (default) interpolates on the ' \
+              'difference between the original and encoded images, ' \
+              'bisection is the original method, and parallel tries all ' \
+              'the candidate values at once, in threads (more encodes, but ' \
+              'faster when there are idle CPU cores, e.g. for a single image).'
+    jpg_group.add_argument('--quality-search', dest='quality_search',
+                           default=DEFAULT_QUALITY_SEARCH,
+                           choices=sorted(QUALITY_SEARCH_STRATEGIES), help=qs_help)
+
     jpg_group.add_argument(
         '-ke',
         '--keep-exif',
@@ -155,6 +248,13 @@ def get_args():
     png_group.add_argument('-rc', "--reduce-colors", dest="reduce_colors",
                            action='store_true', help=rc_help)
 
+    png_budget_help = "Try several PNG encoder settings for each image (and a " \
+                      "lossless color palette, when possible), for up to this " \
+                      "number of seconds, keeping the smallest result. " \
+                      "Defaults to 0 (a single encode with the usual settings)."
+    png_group.add_argument('--png-budget', dest="png_budget", metavar="SECONDS",
+                           type=float, default=0.0, help=png_budget_help)
+
     mc_help = "The maximum number of colors when reducing colors (-rc) " \
               "(an integer between 0 and 255). Defaults to 255."
     png_group.add_argument('-mc', dest="max_colors",
@@ -195,7 +295,8 @@ def get_args():
     png_group.add_argument(
         '-ca', "--convert-all", action='store_true', help=ca_help)
 
-    fd_help = "Delete the original file when converting to JPG."
+    fd_help = "Delete the original file when converting to JPG (or to " \
+              "another output format, with --output-format)."
     png_group.add_argument(
         '-fd', "--force-delete", action='store_true', help=fd_help)
 
@@ -215,6 +316,8 @@ def get_args():
 
     if args.path:
         src_path = os.path.expanduser(args.path)
+    elif args.serve_address:
+        src_path = ''
     else:
         msg = "\nPlease specify the path of the image or folder to process.\n\n"
         parser.exit(status=0, message=msg)
@@ -229,6 +332,19 @@ def get_args():
         msg = "\nPlease specify image dimensions as positive integers.\n\n"
         parser.exit(status=0, message=msg)
 
+    if args.png_budget < 0:
+        msg = "\nPlease specify the PNG time budget as a positive number of seconds.\n\n"
+        parser.exit(status=0, message=msg)
+
+    if args.output_format and not output_candidates(args.output_format, 'PNG'):
+        msg = f"\nThe installed version of Pillow doesn't support the " \
+              f"{args.output_format.upper()} format.\n\n"
+        parser.exit(status=0, message=msg)
+
+    if args.max_pixels < 1:
+        msg = "\nPlease specify the max. number of pixels as a positive integer.\n\n"
+        parser.exit(status=0, message=msg)
+
     if args.val and args.hex_color:
         msg = "\nBackground color should be entered only once.\n\n"
         parser.exit(status=0, message=msg)
@@ -255,9 +371,14 @@ def get_args():
               "bright red you can use: '-bg 255 0 0' or '-hbg #FF0000'.\n\n"
         parser.exit(status=0, message=msg)
 
-    output_config = OutputConfiguration(args.only_summary, args.only_progress, args.quiet)
+    # The JSON records can't be mixed with the usual messages
+    quiet = args.quiet or args.json_lines == '-'
+    output_config = OutputConfiguration(args.only_summary, args.only_progress, quiet)
     return src_path, watch_dir, recursive, quality, args.remove_transparency, \
         args.reduce_colors, args.max_colors, args.max_width, args.max_height, \
         args.keep_exif, args.convert_all, args.convert_big, args.force_delete, \
         bg_color, args.grayscale, args.no_comparison, args.fast_mode, \
-        args.jobs, output_config
+        args.jobs, output_config, not args.no_cache, args.serve_address, \
+        args.keep_timestamps, args.profile, args.json_lines, args.ordered, \
+        args.max_memory, args.max_pixels, args.huge_images, args.by_content, \
+        args.png_budget, args.output_format, args.quality_search
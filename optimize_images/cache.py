@@ -0,0 +1,206 @@
+# encoding: utf-8
+"""
+Persistent result cache, used to skip images that were already processed with
+the same options in a previous run.
+
+Each entry is keyed by the absolute path of the source file and records its
+size, modification time and a content digest as they were right after it was
+processed, along with a digest of the options used and the resulting
+TaskResult. An unchanged file costs a single os.stat() call; a file whose
+modification time changed (but not its size) is only considered unchanged if
+its contents still match the stored digest.
+
+The state of each file is recorded by the worker that processed it (see
+Task.record_source), right after processing it, so that the files don't have
+to be read again by the main process.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Optional, Tuple
+
+from optimize_images.constants import CACHE_COMMIT_INTERVAL, CACHE_DIR_NAME
+from optimize_images.constants import CACHE_FILENAME, CACHE_MAX_AGE_DAYS
+from optimize_images.constants import CACHE_VACUUM_THRESHOLD
+from optimize_images.data_structures import Task, TaskResult
+
+# Task fields that don't have any effect on the resulting image.
+_NON_OUTPUT_FIELDS = ('src_path', 'output_config', 'keep_timestamps', 'profile',
+                      'record_source')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    path TEXT PRIMARY KEY,
+    size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    options TEXT NOT NULL,
+    result TEXT NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_last_seen ON results (last_seen);
+"""
+
+
+def get_cache_dir() -> str:
+    """ Get the folder where the result cache is stored, following the XDG
+        base directory specification when available.
+    """
+    base_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base_dir, CACHE_DIR_NAME)
+
+
+def file_digest(path: str) -> str:
+    """ Return a hexadecimal digest of the contents of a file. """
+    digest = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_state(path: str) -> Optional[Tuple[int, int, str]]:
+    """ Return the size, modification time (ns) and digest of a file, or None
+        if it can't be read (e.g., it was removed).
+    """
+    try:
+        stat = os.stat(path)
+        return stat.st_size, stat.st_mtime_ns, file_digest(path)
+    except OSError:
+        return None
+
+
+def options_digest(task: Task) -> str:
+    """ Return a digest of the task options that may change the resulting image. """
+    options = tuple((field, value) for field, value in task._asdict().items()
+                    if field not in _NON_OUTPUT_FIELDS)
+    return hashlib.blake2b(repr(options).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class ResultCache:
+    """ An on-disk (SQLite) index of previously processed images. """
+
+    def __init__(self, db_path: str = ''):
+        if not db_path:
+            db_path = os.path.join(get_cache_dir(), CACHE_FILENAME)
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=30)
+        self.conn.executescript(_SCHEMA)
+        self._uncommitted = 0
+
+    def lookup(self, task: Task) -> Optional[TaskResult]:
+        """ Return a (skipped) TaskResult if this file was already processed
+            using the same options and hasn't changed since then, or None
+            otherwise. Its formats, modes, colors and quality are the ones
+            recorded when it was processed, but no encodes were done now.
+        """
+        path = os.path.abspath(task.src_path)
+        row = self.conn.execute(
+            'SELECT size, mtime_ns, digest, options, result FROM results WHERE path = ?',
+            (path,)).fetchone()
+        if row is None:
+            return None
+
+        size, mtime_ns, digest, options, result = row
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+
+        if stat.st_size != size or options != options_digest(task):
+            return None
+
+        try:
+            fields = {k: v for k, v in json.loads(result).items() if k in TaskResult._fields}
+            fields['output_config'] = task.output_config
+            cached_result = TaskResult(**fields)
+        except (ValueError, TypeError, AttributeError):
+            # A corrupt entry (or written by an incompatible version)
+            return None
+
+        if stat.st_mtime_ns != mtime_ns:
+            try:
+                if file_digest(path) != digest:
+                    return None
+            except OSError:
+                return None
+            self.conn.execute('UPDATE results SET mtime_ns = ? WHERE path = ?',
+                              (stat.st_mtime_ns, path))
+
+        self.conn.execute('UPDATE results SET last_seen = ? WHERE path = ?',
+                          (time.time(), path))
+        self._maybe_commit()
+
+        return cached_result._replace(img=task.src_path,
+                                      orig_size=stat.st_size,
+                                      final_size=stat.st_size,
+                                      was_optimized=False,
+                                      was_downsized=False,
+                                      encodes=0,
+                                      stage_seconds=None,
+                                      peak_memory=0,
+                                      elapsed_seconds=0.0,
+                                      cached=True)
+
+    def store(self, task: Task, result: TaskResult) -> None:
+        """ Record the state of a file that has just been processed, as
+            recorded by the worker (result.source_state), or as it is now, if
+            it wasn't recorded (Task.record_source was not set).
+        """
+        if not result.orig_format:
+            # The file could not be read. It may be worth trying again later.
+            return
+
+        path = os.path.abspath(task.src_path)
+        state = result.source_state or source_state(path)
+        if state is None:
+            # The source file may have been removed (e.g., -fd)
+            return
+
+        size, mtime_ns, digest = state
+        self.conn.execute(
+            'INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)',
+            (path, size, mtime_ns, digest, options_digest(task),
+             json.dumps(result.to_dict()), time.time()))
+        self._maybe_commit()
+
+    def evict(self, max_age_days: float = CACHE_MAX_AGE_DAYS) -> int:
+        """ Remove the entries that were not used in the last max_age_days
+            days, reclaiming disk space if a significant number of entries was
+            removed. Returns the number of removed entries.
+        """
+        oldest = time.time() - max_age_days * 24 * 3600
+        cursor = self.conn.execute('DELETE FROM results WHERE last_seen < ?', (oldest,))
+        self.conn.commit()
+        self._uncommitted = 0
+
+        removed = cursor.rowcount
+        if removed >= CACHE_VACUUM_THRESHOLD:
+            self.vacuum()
+        return removed
+
+    def vacuum(self) -> None:
+        """ Rebuild the database file, reclaiming unused disk space. """
+        self.conn.commit()
+        self.conn.execute('VACUUM')
+
+    def close(self) -> None:
+        self.conn.commit()
+        self.conn.close()
+
+    def _maybe_commit(self) -> None:
+        self._uncommitted += 1
+        if self._uncommitted >= CACHE_COMMIT_INTERVAL:
+            self.conn.commit()
+            self._uncommitted = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
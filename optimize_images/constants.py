@@ -2,10 +2,64 @@
 
 # ============================[ General settings ]============================
 SUPPORTED_FORMATS = ['png', 'jpg', 'jpeg']
+# The first bytes of PNG and JPEG files, used to find images by their content
+IMAGE_SIGNATURES = (b'\x89PNG\r\n\x1a\n', b'\xff\xd8\xff')
 DEFAULT_QUALITY = 80
+DEFAULT_QUALITY_SEARCH = 'secant'
 DEFAULT_BG_COLOR = (255, 255, 255)
 MIN_BIG_IMG_SIZE = 80_000
 MIN_BIG_IMG_AREA = 800 * 600
+MIN_BIG_IMG_COLORS = 2 ** 16
+MAX_TASKS_IN_FLIGHT_PER_WORKER = 4
+
+# Images with more pixels than this (--max-pixels) are skipped, processed
+# alone or downsized on load (--huge-images). The default is the same limit
+# over which Pillow refuses to open images, as possible decompression bomb
+# attacks (twice the limit over which it only warns about them), so that all
+# the images that could be processed before are still processed by default.
+DEFAULT_MAX_PIXELS = 2 * (1024 * 1024 * 1024 // 4 // 3)
+HUGE_IMAGE_POLICIES = ('skip', 'isolate', 'downsize')
+
+# Task scheduling: the number of discovered tasks that are sorted by their
+# estimated cost (pixels) before being submitted, and the grouping of small
+# images into chunks (each one sent to a worker as a single submission)
+SCHEDULER_WINDOW = 256
+SMALL_TASK_COST = 512 * 512
+MAX_TASKS_PER_CHUNK = 16
+
+# Memory budget (--max-memory): the estimated peak memory used to process an
+# image is its decoded size (width x height x bands) times this number of
+# copies (e.g., when converting or removing transparency), plus its file size
+PEAK_MEMORY_COPIES = 3
+
+# The number of threads used to encode PNG images with different settings
+# (--png-budget), for each image being processed
+PNG_TRIAL_THREADS = 2
+
+# Output formats (--output-format), by their file extension, and the Pillow
+# format of each one. With "auto", each image is encoded in all of them that
+# are available, and the smallest result is kept.
+OUTPUT_FORMATS = {'webp': 'WEBP', 'avif': 'AVIF'}
+AUTO_OUTPUT_FORMAT = 'auto'
+
+# Map image files of at least this size into memory, instead of reading them
+MMAP_MIN_FILE_SIZE = 1024 * 1024
+
+# Make the thumbnail for the quality analysis in two steps (a fast integer
+# reduction, followed by a final resample) when the source is at least this
+# many times larger than it
+ANALYSIS_REDUCING_GAP = 3.0
+
+# =========================[ Watch directory settings ]========================
+WATCH_DEBOUNCE_SECONDS = 0.5
+WATCH_RECENT_PATHS_MAX = 10_000
+
+# ===========================[ Result cache settings ]=========================
+CACHE_DIR_NAME = 'optimize-images'
+CACHE_FILENAME = 'results.sqlite3'
+CACHE_MAX_AGE_DAYS = 90
+CACHE_COMMIT_INTERVAL = 100
+CACHE_VACUUM_THRESHOLD = 1000
 
 # ====================[ iOS/Pythonista specific settings ]====================
 IPAD_FONT_SIZE = 15
@@ -1,7 +1,11 @@
 # encoding: utf-8
 import concurrent.futures
-from dataclasses import dataclass
-from typing import NamedTuple, Tuple, NewType, Optional, List
+from dataclasses import dataclass, field
+from typing import Any, Dict, NamedTuple, Tuple, NewType, Optional, List
+
+from PIL import Image
+
+from optimize_images.constants import DEFAULT_MAX_PIXELS, DEFAULT_QUALITY_SEARCH
 
 PPoolExType = NewType('PPoolExType', concurrent.futures.ProcessPoolExecutor)
 TPoolExType = NewType('TPoolExType', concurrent.futures.ThreadPoolExecutor)
@@ -30,6 +34,14 @@ class Task(NamedTuple):
     no_size_comparison: bool
     fast_mode: bool
     output_config: OutputConfiguration
+    keep_timestamps: bool = False
+    profile: bool = False
+    max_pixels: int = DEFAULT_MAX_PIXELS
+    huge_images: str = 'skip'  # What to do with images over max_pixels
+    png_budget: float = 0.0  # Seconds for trying several PNG encoder settings
+    output_format: str = ''  # Convert to webp, avif or auto (empty: keep the format)
+    record_source: bool = False  # Get TaskResult.source_state (for the result cache)
+    quality_search: str = DEFAULT_QUALITY_SEARCH  # See QUALITY_SEARCH_STRATEGIES
 
 
 class TaskResult(NamedTuple):
@@ -47,6 +59,86 @@ class TaskResult(NamedTuple):
     had_exif: bool
     has_exif: bool
     output_config: OutputConfiguration
+    encodes: int = 0  # Number of times the image was encoded (including quality search)
+    stage_seconds: Optional[Dict[str, float]] = None  # Only when profiling
+    peak_memory: int = 0  # Bytes, only when profiling
+    quality: int = 0  # The JPEG quality setting used, if saved as JPEG
+    elapsed_seconds: float = 0.0
+    error: str = ''  # Why the image was not processed (e.g., it crashed a worker)
+    png_trial: str = ''  # The PNG encoder settings that won, if several were tried
+    # The size, modification time (ns) and digest of the source file right
+    # after it was processed, if requested (Task.record_source)
+    source_state: Optional[Tuple[int, int, str]] = None
+    cached: bool = False  # Skipped, as it was already processed (see ResultCache)
+
+    @classmethod
+    def unprocessed(cls, task: Task, orig_size: int, error: str = '') -> 'TaskResult':
+        """ Get a TaskResult for an image that could not be processed. """
+        return cls(img=task.src_path,
+                   orig_format='',
+                   result_format='',
+                   orig_mode='',
+                   result_mode='',
+                   orig_colors=0,
+                   final_colors=0,
+                   orig_size=orig_size,
+                   final_size=0,
+                   was_optimized=False,
+                   was_downsized=False,
+                   had_exif=False,
+                   has_exif=False,
+                   output_config=task.output_config,
+                   error=error)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """ Get the result fields (except the output configuration and the
+            state of the source file) as a JSON serializable dict.
+        """
+        return {k: v for k, v in self._asdict().items()
+                if k not in ('output_config', 'source_state')}
+
+
+class ImageHeader(NamedTuple):
+    """ The information about an image that can be read from its file header,
+        without decoding it.
+    """
+    img_format: str
+    width: int
+    height: int
+    mode: str
+    frames: int
+    has_transparency: bool
+    file_size: int
+
+    @classmethod
+    def of(cls, img: Image.Image, file_size: int) -> 'ImageHeader':
+        return cls((img.format or '').upper(), img.width, img.height, img.mode,
+                   getattr(img, 'n_frames', 1), 'transparency' in img.info, file_size)
+
+    @property
+    def pixels(self) -> int:
+        return self.width * self.height
+
+    @property
+    def decoded_bytes(self) -> int:
+        """ The size of the pixel data of the first frame, once decoded. """
+        return self.pixels * Image.getmodebands(self.mode)
+
+
+@dataclass
+class ImageContext:
+    """ An image file that was read into memory and opened (but not yet
+        decoded), to be shared by all the processing steps, so that each file
+        is read and decoded only once.
+    """
+    src_path: str
+    img: Image.Image
+    img_format: str
+    orig_size: int
+
+    @property
+    def header(self) -> ImageHeader:
+        return ImageHeader.of(self.img, self.orig_size)
 
 
 @dataclass
@@ -68,15 +160,52 @@ class BatchOptions:
     ignore_size_comparison: bool = False
     fast_mode: bool = False
     jobs: int = 0
-    output_config: Optional[object] = None
+    output_config: Optional[OutputConfiguration] = None
+    use_cache: bool = True
+    keep_timestamps: bool = False
+    profile: bool = False
+    ordered: bool = False  # Get the results in the order the images are found
+    max_memory: int = 0  # Bytes, for all the images processed at a given time
+    max_pixels: int = DEFAULT_MAX_PIXELS
+    huge_images: str = 'skip'  # What to do with images over max_pixels
+    by_content: bool = False  # Find images by their content, not their extension
+    png_budget: float = 0.0  # Seconds for trying several PNG encoder settings
+    output_format: str = ''  # Convert to webp, avif or auto (empty: keep the format)
+    quality_search: str = DEFAULT_QUALITY_SEARCH  # See QUALITY_SEARCH_STRATEGIES
+
+    def task_for(self, img_path: str) -> Task:
+        """ Get a Task to process the specified image using these options. """
+        output_config = self.output_config or OutputConfiguration(False, False, True)
+        return Task(img_path, self.quality, self.remove_transparency,
+                    self.reduce_colors, self.max_colors, self.max_w, self.max_h,
+                    self.keep_exif, self.convert_all, self.conv_big,
+                    self.force_del, self.bg_color, self.grayscale,
+                    self.ignore_size_comparison, self.fast_mode, output_config,
+                    self.keep_timestamps, self.profile, self.max_pixels,
+                    self.huge_images, self.png_budget, self.output_format,
+                    quality_search=self.quality_search)
 
 
 @dataclass
 class BatchResult:
-    results: List[TaskResult]
-    found_files: int
-    optimized_files: int
-    skipped_files: int
-    total_src_size: int
-    total_bytes_saved: int
-    elapsed_seconds: float
+    results: List[TaskResult] = field(default_factory=list)
+    found_files: int = 0
+    optimized_files: int = 0
+    skipped_files: int = 0
+    total_src_size: int = 0
+    total_bytes_saved: int = 0
+    elapsed_seconds: float = 0.0
+
+    def add(self, result: TaskResult, keep: bool = True) -> None:
+        """ Update the totals with a new TaskResult (and keep it in the results
+            list, unless keep is False).
+        """
+        if keep:
+            self.results.append(result)
+        self.found_files += 1
+        self.total_src_size += result.orig_size
+        if result.was_optimized:
+            self.optimized_files += 1
+            self.total_bytes_saved += result.orig_size - result.final_size
+        else:
+            self.skipped_files += 1
@@ -1,15 +1,21 @@
 # encoding: utf-8
 
 import os
+from timeit import default_timer as timer
+from typing import BinaryIO, Optional
 
-from PIL import Image, ImageOps, ExifTags
-
+from optimize_images.cache import source_state
 from optimize_images.data_structures import Task, TaskResult
+from optimize_images.img_info import check_image_size, open_image, open_image_data
 from optimize_images.img_optimize_jpg import optimize_jpg
 from optimize_images.img_optimize_png import optimize_png
+from optimize_images.img_output_formats import optimize_to_format
+from optimize_images.profiling import NULL_PROFILER, Profiler
 
 
-def do_optimization(task: Task) -> TaskResult:
+def do_optimization(task: Task,
+                    data: Optional[bytes] = None,
+                    dest: Optional[BinaryIO] = None) -> TaskResult:
     """ Try to reduce file size of an image.
 
     Expects a Task object containing all the parameters for the image xprocessing.
@@ -18,35 +24,58 @@ def do_optimization(task: Task) -> TaskResult:
     according to the detected image format.
 
     :param task: A Task object containing all the parameters for the image processing.
+    :param data: The contents of the image file, if it is already in memory
+                 (in that case, task.src_path is only used as its name).
+    :param dest: A file object where the result should be written, instead
+                 of replacing the original file (only if it is optimized).
     :return: A TaskResult object containing information for single file report.
     """
+    start = timer()
+    profiler = Profiler() if task.profile else NULL_PROFILER
+    try:
+        result = profiler.finish(_do_optimization(task, data, dest, profiler))
+    finally:
+        profiler.stop()
+    if task.record_source and data is None and result.orig_format:
+        result = result._replace(source_state=source_state(task.src_path))
+    return result._replace(elapsed_seconds=timer() - start)
+
+
+def _do_optimization(task: Task,
+                     data: Optional[bytes],
+                     dest: Optional[BinaryIO],
+                     profiler: Profiler) -> TaskResult:
     # TODO: Catch exceptions that may occur here.
     try:
-        img: Image.Image
-        with Image.open(task.src_path) as img:
-            img_format: str = img.format.upper()
-            mode: str = img.mode
+        with profiler.stage('read'):
+            if data is None:
+                image = open_image(task.src_path)
+            else:
+                image = open_image_data(data, task.src_path)
+        img_format: str = image.img_format
+        mode: str = image.img.mode
+
+        # The file header was read, but the image was not decoded yet
+        task, error = check_image_size(task, image.header)
+        if error:
+            return TaskResult.unprocessed(task, image.orig_size, error)
+
+        if img_format in ('PNG', 'JPEG', 'MPO') and profiler.enabled and not (task.max_w or task.max_h):
+            # Decode it now, to measure it separately. When downsizing, it
+            # may be decoded at a reduced size, as part of the resizing.
+            with profiler.stage('decode'):
+                image.img.load()
 
+        if task.output_format and img_format in ('PNG', 'JPEG', 'MPO'):
+            return optimize_to_format(task, image, dest, profiler)
         if img_format == 'PNG':
-            return optimize_png(task)
+            return optimize_png(task, image, dest, profiler)
         if img_format in ('JPEG', 'MPO'):
-            return optimize_jpg(task)
+            return optimize_jpg(task, image, dest, profiler)
 
     except OSError:
-        return TaskResult(img=task.src_path,
-                          orig_format='',
-                          result_format='',
-                          orig_mode='',
-                          result_mode='',
-                          orig_colors=0,
-                          final_colors=0,
-                          orig_size=os.path.getsize(task.src_path),
-                          final_size=0,
-                          was_optimized=False,
-                          was_downsized=False,
-                          had_exif=False,
-                          has_exif=False,
-                          output_config=task.output_config)
+        orig_size = os.path.getsize(task.src_path) if data is None else len(data)
+        return TaskResult.unprocessed(task, orig_size)
 
     # TODO: improve method of image format detection (what should happen if the
     #       file extension does not match the image content's format? Maybe we
@@ -54,9 +83,8 @@ def do_optimization(task: Task) -> TaskResult:
 
     # Reporting about unsupported formats:
     try:
-        with Image.open(task.src_path) as img:
-            exif = img.getexif()
-            had_exif = bool(exif and len(exif) > 0)
+        exif = image.img.getexif()
+        had_exif = bool(exif and len(exif) > 0)
     except (OSError, ValueError):
         had_exif = False
 
@@ -67,7 +95,7 @@ def do_optimization(task: Task) -> TaskResult:
                       result_mode=mode,
                       orig_colors=0,
                       final_colors=0,
-                      orig_size=os.path.getsize(task.src_path),
+                      orig_size=image.orig_size,
                       final_size=0,
                       was_optimized=False,
                       was_downsized=False,
@@ -1,24 +1,166 @@
 # encoding: utf-8
 import os
-from typing import Iterable
+import tempfile
+import threading
+from typing import Iterable, Iterator, Set, Union
 
-from optimize_images.constants import SUPPORTED_FORMATS
+from optimize_images.constants import IMAGE_SIGNATURES, SUPPORTED_FORMATS
 
+_SIGNATURE_SIZE = max(len(signature) for signature in IMAGE_SIGNATURES)
 
-def search_images(dirpath: str, recursive: bool) -> Iterable[str]:
-    if recursive:
-        for root, _, files in os.walk(dirpath):
-            for filename in files:
-                if not os.path.isfile(os.path.join(root, filename)):
-                    continue
-                extension = os.path.splitext(filename)[1][1:]
-                if extension.lower() in SUPPORTED_FORMATS:
-                    yield os.path.join(root, filename)
-    else:
+
+def search_images(dirpath: str, recursive: bool, by_content: bool = False) -> Iterable[str]:
+    """ Find the image files in a folder (and, optionally, its subfolders).
+
+    By default, files are selected by their extension (SUPPORTED_FORMATS).
+    If by_content is True, the first few bytes of each file are read instead,
+    to find PNG and JPEG images whatever their names are.
+    """
+    for dir_entry in _scan_files(dirpath, recursive):
+        if by_content:
+            if '~temp~' in dir_entry.name or not _has_image_signature(dir_entry.path):
+                continue
+        else:
+            extension = os.path.splitext(dir_entry.name)[1][1:]
+            if extension.lower() not in SUPPORTED_FORMATS:
+                continue
+        yield dir_entry.path if recursive else os.path.normpath(dir_entry.path)
+
+
+def _scan_files(dirpath: str, recursive: bool) -> Iterator[os.DirEntry]:
+    """ Walk a folder (like os.walk, top-down), using the file type info
+        returned when listing it, instead of checking each entry again.
+    """
+    subdirs = []
+    try:
         with os.scandir(dirpath) as directory:
             for dir_entry in directory:
-                if not os.path.isfile(os.path.normpath(dir_entry)):
+                try:
+                    if dir_entry.is_file():
+                        yield dir_entry
+                    elif recursive and dir_entry.is_dir(follow_symlinks=False):
+                        subdirs.append(dir_entry.path)
+                except OSError:
                     continue
-                extension = os.path.splitext(dir_entry)[1][1:]
-                if extension.lower() in SUPPORTED_FORMATS:
-                    yield os.path.normpath(dir_entry)
+    except OSError:
+        # A folder that can't be read is skipped, like os.walk does
+        pass
+    for subdir in subdirs:
+        yield from _scan_files(subdir, recursive)
+
+
+def _has_image_signature(path: str) -> bool:
+    try:
+        with open(path, 'rb') as file:
+            return file.read(_SIGNATURE_SIZE).startswith(IMAGE_SIGNATURES)
+    except OSError:
+        return False
+
+
+class ImageCounter(threading.Thread):
+    """ Count the image files found in a folder, in a background thread.
+
+    The count keeps growing while the search is running, and `finished` is
+    set to True when it is complete.
+    """
+
+    def __init__(self, dirpath: str, recursive: bool, by_content: bool = False):
+        super().__init__(daemon=True)
+        self.dirpath = dirpath
+        self.recursive = recursive
+        self.by_content = by_content
+        self.count = 0
+        self.finished = False
+
+    def run(self):
+        for _ in search_images(self.dirpath, self.recursive, self.by_content):
+            self.count += 1
+        self.finished = True
+
+
+def replace_file(target_path: str,
+                 data: Union[bytes, memoryview],
+                 like_path: str = '',
+                 keep_timestamps: bool = False) -> None:
+    """ Safely replace (or create) a file with the specified contents.
+
+    The data is written to a temporary file in the same folder, which is
+    flushed to disk and then renamed over the target file, so that a crash
+    can never leave it partially written. The permissions and ownership of
+    like_path (by default, the target file itself) are copied to the new
+    file, as well as its access and modification times if keep_timestamps is
+    True.
+
+    The renaming itself only becomes durable when the folder is synced (see
+    DirectorySyncer), which can be done once for many files.
+    """
+    # Replace the actual file, not a symbolic link to it
+    target_path = os.path.realpath(target_path)
+    like_path = like_path or target_path
+    try:
+        orig_stat = os.stat(like_path)
+    except FileNotFoundError:
+        orig_stat = None
+
+    folder, filename = os.path.split(target_path)
+    fd, tmp_path = tempfile.mkstemp(prefix=f'.{filename}.', suffix='.~temp~', dir=folder)
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+        if orig_stat is not None:
+            _copy_file_attributes(orig_stat, tmp_path, keep_timestamps)
+        os.replace(tmp_path, target_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def _copy_file_attributes(orig_stat: os.stat_result, path: str, keep_timestamps: bool) -> None:
+    os.chmod(path, orig_stat.st_mode & 0o7777)
+    if hasattr(os, 'chown'):
+        try:
+            os.chown(path, orig_stat.st_uid, orig_stat.st_gid)
+        except OSError:
+            # Only privileged users may give away their files
+            pass
+    if keep_timestamps:
+        os.utime(path, ns=(orig_stat.st_atime_ns, orig_stat.st_mtime_ns))
+
+
+def fsync_dir(dirpath: str) -> None:
+    """ Make any files recently created, renamed or deleted in a folder
+        durable, where the platform supports it.
+    """
+    try:
+        fd = os.open(dirpath, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class DirectorySyncer:
+    """ Keep track of the folders where files were replaced, in order to
+        sync each one of them only once (e.g., at the end of a batch).
+    """
+
+    def __init__(self):
+        self.pending: Set[str] = set()
+
+    def add(self, path: str) -> None:
+        self.pending.add(os.path.dirname(os.path.abspath(path)))
+
+    def sync(self) -> None:
+        for dirpath in self.pending:
+            fsync_dir(dirpath)
+        self.pending.clear()
@@ -1,35 +1,61 @@
 # encoding: utf-8
 import os
 from io import BytesIO
-from typing import Tuple
+from typing import BinaryIO, Optional, Tuple
 
 from PIL import Image
 
 from .constants import DEFAULT_BG_COLOR
+from .file_utils import replace_file
+from .img_color_stats import analyze_mode_usage, count_colors
 from .reporting import show_img_exception
 
 
 class Palette:
     def __init__(self):
         self.palette = []
+        self.indexes = {}
 
     def add(self, red, green, blue):
         # map rgb tuple to colour index
         rgb = red, green, blue
         try:
-            return self.palette.index(rgb)
-        except ValueError as vex:
+            return self.indexes[rgb]
+        except KeyError as kex:
             i = len(self.palette)
             if i >= 256:
-                raise RuntimeError("all palette entries are used") from vex
+                raise RuntimeError("all palette entries are used") from kex
             self.palette.append(rgb)
+            self.indexes[rgb] = i
             return i
 
     def get_palette(self):
         # return flattened palette
-        palette = []
-        for red, green, blue in self.palette:
-            palette = palette + [red, green, blue]
+        return [value for rgb in self.palette for value in rgb]
+
+    @classmethod
+    def from_image(cls, img: Image.Image) -> 'Palette':
+        """ Build a palette with the colors of an image, in the order they are
+            first found when scanning the image column by column.
+
+        For indexed images, instead of visiting each pixel, it transposes the
+        image, so that each column becomes a row of raw index bytes, and then
+        finds the first occurrence of each index using bytes.find().
+        """
+        palette = cls()
+        if img.mode != "P":
+            for rgb in img.convert("RGB").transpose(Image.Transpose.TRANSPOSE).getdata():
+                palette.add(*rgb)
+            return palette
+
+        scan = img.transpose(Image.Transpose.TRANSPOSE).tobytes()
+        used_indexes = [index for _, index in img.getcolors(256)]
+        used_indexes.sort(key=lambda index: scan.find(bytes((index,))))
+
+        rgb_values = img.getpalette() or []
+        rgb_values += [0] * (768 - len(rgb_values))
+        for index in used_indexes:
+            palette.add(*rgb_values[3 * index: 3 * index + 3])
         return palette
 
 
@@ -99,11 +125,7 @@ def do_reduce_colors(img: Image.Image,
     if orig_mode == "1":
         return img, 2, 2
 
-    colors = img.getcolors()
-    if colors:
-        orig_colors = len(colors)
-    else:
-        orig_colors = 0
+    orig_colors = count_colors(img) or 0
 
     # Intermediate conversion steps when needed
     if orig_mode in ["CMYK", "YCbCr", "LAB", "HSV"]:
@@ -121,14 +143,8 @@ def do_reduce_colors(img: Image.Image,
         img = Image.composite(img, transparent, img)
     elif orig_mode == "P":
         palette = img.getpalette()
+        # The alpha band, if any, is taken from the palette or transparency info
         img = img.convert("RGBA")
-        width, height = img.size
-        alpha_layer = Image.new("L", img.size)
-        for x in range(width):
-            for y in range(height):
-                _, _, _, alpha = img.getpixel((x, y))
-                alpha_layer.putpixel((x, y), alpha)
-        img.putalpha(alpha_layer)
     else:
         return img, 0, 0
 
@@ -176,43 +192,105 @@ def rebuild_palette(img: Image.Image) -> Tuple[Image.Image, int]:
     :return: a tuple composed by a mode "P" PNG image object and an integer
              with the resulting number of colors
     """
-    width, height = img.size
+    new_palette = Palette.from_image(img)
     img = img.convert("RGBA")
-    new_palette = Palette()
-    alpha_layer: Image.Image = Image.new("L", img.size)
-
-    for x in range(width):
-        for y in range(height):
-            red, green, blue, alpha = img.getpixel((x, y))
-            alpha_layer.putpixel((x, y), alpha)
-            new_palette.add(red, green, blue)
-
-    img.putalpha(alpha_layer)
     palette = new_palette.get_palette()
     num_colors = len(palette) // 3
     img = img.convert("P", palette=palette, colors=num_colors)
     return img, len(img.getcolors())
 
 
+def to_lossless_palette(img: Image.Image) -> Optional[Image.Image]:
+    """ Convert an RGB or RGBA image with up to 256 colors to a palette image
+        (with the alpha values of each palette entry, if needed), without
+        changing any pixel, or return None if that isn't possible.
+    """
+    if img.mode not in ('RGB', 'RGBA'):
+        return None
+    colors = img.getcolors(256)
+    if colors is None:
+        return None
+
+    rgb_img = img.convert('RGB') if img.mode == 'RGBA' else img
+    palette_img = rgb_img.quantize(colors=256, method=Image.Quantize.MEDIANCUT,
+                                   dither=Image.Dither.NONE)
+    if img.mode == 'RGBA':
+        # Each palette entry can only have one alpha value
+        alphas = {}
+        for _, (red, green, blue, alpha) in colors:
+            if alphas.setdefault((red, green, blue), alpha) != alpha:
+                return None
+        rgb_values = palette_img.getpalette()
+        palette_img.info['transparency'] = bytes(
+            alphas.get(tuple(rgb_values[i:i + 3]), 255) for i in range(0, len(rgb_values), 3))
+
+    if palette_img.convert(img.mode).tobytes() != img.tobytes():
+        return None
+    return palette_img
+
+
+def reduce_mode_losslessly(img: Image.Image) -> Tuple[Image.Image, int]:
+    """ Convert an RGB, RGBA or LA image to the smallest color mode that keeps
+        every pixel unchanged.
+
+    A fully opaque alpha band is dropped, gray images are converted to L or
+    LA and images with up to 256 colors are converted to a palette.
+
+    :param img: a PIL image (other modes are returned unchanged)
+    :return: a tuple composed by the resulting image and the number of colors,
+             if converted to mode "P" (otherwise, 0)
+    """
+    if img.mode not in ('RGB', 'RGBA', 'LA') or 'transparency' in img.info:
+        return img, 0
+
+    usage = analyze_mode_usage(img)
+    # An RGB color profile doesn't apply to gray images
+    gray = usage.gray and (img.mode == 'LA' or 'icc_profile' not in img.info)
+
+    if gray and usage.opaque:
+        return img.convert('L'), 0
+    if usage.colors is not None and img.mode != 'LA':
+        palette_img = to_lossless_palette(img)
+        if palette_img is not None:
+            return palette_img, usage.colors
+    if gray and img.mode == 'RGBA':
+        return img.convert('LA'), 0
+    if usage.opaque and img.mode == 'RGBA':
+        return img.convert('RGB'), 0
+    return img, 0
+
+
 def save_compressed(src_path: str,
                     tmp_buffer: BytesIO,
                     compare_sizes: bool,
                     force_delete: bool = False,
-                    output_path: str = '') -> Tuple[bool, int]:
+                    output_path: str = '',
+                    orig_size: int = 0,
+                    dest: Optional[BinaryIO] = None,
+                    keep_timestamps: bool = False) -> Tuple[bool, int]:
     """ Check if there were any savings and save or discard temporary file.
 
         If the user used the option to ignore the file comparison, go ahead
-        and replace the original file anyway.
+        and replace the original file anyway. The original file size is only
+        read from disk if it isn't specified. If a dest file object is
+        specified, the result is written to it instead of to the disk.
+
+        The original file is replaced safely (see replace_file), keeping its
+        permissions, ownership and, optionally, its timestamps.
     """
     final_size = tmp_buffer.getbuffer().nbytes
-    orig_size: int = os.path.getsize(src_path)
+    if not orig_size:
+        orig_size = os.path.getsize(src_path)
 
     target_path = output_path if output_path else src_path
 
     if not compare_sizes or (final_size / orig_size < .99):
-        tmp_buffer.seek(0)
-        with open(target_path, 'wb') as file:
-            file.write(tmp_buffer.getbuffer())
+        if dest is not None:
+            dest.write(tmp_buffer.getbuffer())
+            return True, final_size
+
+        replace_file(target_path, tmp_buffer.getbuffer(), like_path=src_path,
+                     keep_timestamps=keep_timestamps)
 
         was_optimized = True
         if force_delete:
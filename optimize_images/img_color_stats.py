@@ -0,0 +1,78 @@
+# encoding: utf-8
+"""
+Color statistics, computed by Pillow at the C level instead of visiting each
+pixel in Python, to be used by any heuristics that need them.
+"""
+from typing import NamedTuple, Optional
+
+from PIL import Image, ImageChops
+
+# The size of a sample of the pixels, used to quickly rule out images that
+# are not gray or fully opaque before checking every pixel
+_SAMPLE_SIZE = (64, 64)
+
+
+class ModeUsage(NamedTuple):
+    """ Which of the bands of an image are actually needed. """
+    opaque: bool  # Every pixel is fully opaque (or there is no alpha band)
+    gray: bool  # Every pixel is gray (R == G == B), or it's a gray mode
+    colors: Optional[int]  # The number of unique colors, or None if more than 256
+
+
+def count_colors(img: Image.Image, max_colors: int = 256) -> Optional[int]:
+    """ Count the number of unique colors (pixel values) in an image
+
+    Counting stops as soon as the number of colors exceeds max_colors, so
+    that it is cheap to check images with lots of colors.
+
+    :param img: a PIL image in any mode (for images with an alpha band, the
+                alpha value is part of each color).
+    :param max_colors: the maximum number of colors to count.
+    :return: the number of unique colors, or None if there are more than
+             max_colors.
+    """
+    colors = img.getcolors(max_colors)
+    if colors is None:
+        return None
+    return len(colors)
+
+
+def has_more_colors_than(img: Image.Image, threshold: int) -> bool:
+    """ Check if an image has more than the specified number of unique colors. """
+    return count_colors(img, threshold) is None
+
+
+def analyze_mode_usage(img: Image.Image) -> ModeUsage:
+    """ Find out if an RGB, RGBA or LA image could use a smaller color mode
+        without changing any pixel.
+
+    If the image has up to 256 colors, a single scan (which stops as soon as
+    there are more) answers everything. Otherwise, a small sample of the
+    pixels is checked first, so that most photos are ruled out without
+    scanning the whole image again.
+    """
+    bands = img.getbands()
+    has_alpha = 'A' in bands
+    is_gray_mode = bands[0] == 'L'
+
+    colors = img.getcolors(256)
+    if colors is not None:
+        values = [value for _, value in colors]
+        opaque = not has_alpha or all(value[-1] == 255 for value in values)
+        gray = is_gray_mode or all(value[0] == value[1] == value[2] for value in values)
+        return ModeUsage(opaque, gray, len(colors))
+
+    sample = img.resize(_SAMPLE_SIZE, Image.Resampling.NEAREST)
+    opaque = not has_alpha or (_is_opaque(sample) and _is_opaque(img))
+    gray = is_gray_mode or (_is_gray(sample) and _is_gray(img))
+    return ModeUsage(opaque, gray, None)
+
+
+def _is_opaque(img: Image.Image) -> bool:
+    return img.getchannel('A').getextrema() == (255, 255)
+
+
+def _is_gray(img: Image.Image) -> bool:
+    red, green, blue = (img.getchannel(band) for band in 'RGB')
+    return ImageChops.difference(red, green).getbbox() is None \
+        and ImageChops.difference(green, blue).getbbox() is None
@@ -1,53 +1,149 @@
 # encoding: utf-8
-
+import math
+import mmap
+import os
 from io import BytesIO
+from typing import BinaryIO, Optional, Tuple, Union
 
-from PIL import Image, ImageFile
+from PIL import Image, ImageFile, JpegImagePlugin, PngImagePlugin
 
-from .constants import MIN_BIG_IMG_SIZE, MIN_BIG_IMG_AREA
+from .constants import MIN_BIG_IMG_SIZE, MIN_BIG_IMG_AREA, MIN_BIG_IMG_COLORS
+from .constants import IMAGE_SIGNATURES, MMAP_MIN_FILE_SIZE
+from .data_structures import ImageContext, ImageHeader, Task
 from .img_aux_processing import downsize_img
+from .img_color_stats import has_more_colors_than
+
+
+def _open_unchecked(file: BinaryIO) -> Image.Image:
+    """ Open a PNG or JPEG image without Pillow's decompression bomb check,
+        since the number of pixels is checked against Task.max_pixels instead
+        (see check_image_size).
+
+    The check is done by Image.open(), so these formats are opened by their
+    plugins directly (Image.MAX_IMAGE_PIXELS is shared by all threads, so it
+    can't be changed here). Other formats are opened as usual.
+    """
+    png_signature, jpeg_signature = IMAGE_SIGNATURES
+    prefix = file.read(len(png_signature))
+    file.seek(0)
+    try:
+        if prefix.startswith(png_signature):
+            return PngImagePlugin.PngImageFile(file)
+        if prefix.startswith(jpeg_signature):
+            return JpegImagePlugin.jpeg_factory(file)
+        return Image.open(file)
+    except SyntaxError as ex:
+        # As raised by Image.open() for invalid image files
+        raise Image.UnidentifiedImageError(str(ex)) from ex
+    except Image.DecompressionBombError as ex:
+        raise OSError(str(ex)) from ex
+
+
+def probe_image(src_path: str) -> Optional[ImageHeader]:
+    """ Read only the header of an image file (without reading the whole file
+        or decoding it), or return None if it can't be read.
+    """
+    try:
+        with open(src_path, 'rb') as file:
+            file_size = os.fstat(file.fileno()).st_size
+            with _open_unchecked(file) as img:
+                return ImageHeader.of(img, file_size)
+    except (OSError, ValueError, SyntaxError):
+        return None
+
+
+def check_image_size(task: Task, header: ImageHeader) -> Tuple[Task, str]:
+    """ Apply the policy for images with more than task.max_pixels pixels.
+
+    :return: The task to use for processing the image (with max_w and max_h
+             reduced, when it is to be downsized on load) and an error message,
+             if it should be skipped instead.
+    """
+    if header.pixels <= task.max_pixels or task.huge_images == 'isolate':
+        return task, ''
+
+    if task.huge_images == 'downsize':
+        scale = math.sqrt(task.max_pixels / header.pixels)
+        max_w = max(int(header.width * scale), 1)
+        max_h = max(int(header.height * scale), 1)
+        return task._replace(max_w=min(task.max_w or max_w, max_w),
+                             max_h=min(task.max_h or max_h, max_h)), ''
+
+    megapixels = header.pixels / 1_000_000
+    return task, f"This image has {megapixels:.1f} megapixels, which is more than " \
+                 f"the limit ({task.max_pixels / 1_000_000:.1f} megapixels). Use " \
+                 f"--max-pixels or --huge-images to process it anyway."
+
 
+def open_image(src_path: str) -> ImageContext:
+    """ Read an image file into memory and open it.
 
-def is_big_png_photo(src_path: str) -> bool:
+    The file is read with a single call (or, if it is big, mapped into
+    memory), and the image is only decoded when its pixel data is first
+    needed, so that it may still be decoded at a reduced size (e.g., JPEG
+    draft mode) when downsizing.
+
+    :param src_path: The path to the image file.
+    :return: An ImageContext object to be shared by all processing steps.
+    """
+    with open(src_path, 'rb') as file:
+        # Windows doesn't allow replacing a file that is mapped into memory
+        if os.name != 'nt' and os.fstat(file.fileno()).st_size >= MMAP_MIN_FILE_SIZE:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            data = file.read()
+
+    return open_image_data(data, src_path)
+
+
+def open_image_data(data: Union[bytes, mmap.mmap], name: str = '') -> ImageContext:
+    """ Open an image file that is already in memory, without copying it.
+
+    :param data: The contents of the image file.
+    :param name: A name (or path) to identify the image in the results.
+    :return: An ImageContext object to be shared by all processing steps.
+    """
+    img = _open_unchecked(data if isinstance(data, mmap.mmap) else BytesIO(data))
+    return ImageContext(name, img, (img.format or '').upper(), len(data))
+
+
+def is_big_png_photo(image: Union[str, ImageContext]) -> bool:
     """Try to determine if a given image if a big photo in PNG format
 
-    Expects a path to a PNG image file. Returns True if the image is a PNG
-    with an area bigger than MIN_BIG_IMG_AREA pixels that when resized to 1600
-    pixels (wide or high) converts to a JPEG bigger than MIN_BIG_IMG_SIZE.
-    Returns False otherwise.
+    Expects an ImageContext (or a path) for a PNG image file. Returns True if
+    the image is a PNG with an area bigger than MIN_BIG_IMG_AREA pixels that
+    when resized to 1600 pixels (wide or high) converts to a JPEG bigger than
+    MIN_BIG_IMG_SIZE. Returns False otherwise.
 
     Inspired by an idea first presented by Stephen Arthur
     (https://engineeringblog.yelp.com/2017/06/making-photos-smaller.html)
     """
-    with Image.open(src_path) as img:
-        img: Image.Image
-        orig_format: str = img.format
-        orig_mode: str = img.mode
-
-        if orig_format != 'PNG' or orig_mode in ['P', 'L', 'LA']:
-            return False
-
-        width, height = img.size
-        if (width * height) >= MIN_BIG_IMG_AREA:
-            unique_colors = {img.getpixel((x, y))
-                             for x in range(width)
-                             for y in range(height)}
-
-            if len(unique_colors) > 2 ** 16:
-                img = img.convert("RGB")
-                if width > height:
-                    img, _ = downsize_img(img, 1600, 0)
-                else:
-                    img, _ = downsize_img(img, 0, 1600)
-
-                tempfile = BytesIO()
-                try:
-                    img.save(tempfile, quality=80, format="JPEG")
-                except IOError:
-                    ImageFile.MAXBLOCK = img.size[0] * img.size[1]
-                    img.save(tempfile, quality=80, format="JPEG")
-
-                final_size = tempfile.getbuffer().nbytes
-                return final_size > MIN_BIG_IMG_SIZE
+    if isinstance(image, str):
+        image = open_image(image)
+
+    img: Image.Image = image.img
+    orig_mode: str = img.mode
+
+    if image.img_format != 'PNG' or orig_mode in ['P', 'L', 'LA']:
+        return False
+
+    width, height = img.size
+    if (width * height) >= MIN_BIG_IMG_AREA:
+        if has_more_colors_than(img, MIN_BIG_IMG_COLORS):
+            img = img.convert("RGB")
+            if width > height:
+                img, _ = downsize_img(img, 1600, 0)
+            else:
+                img, _ = downsize_img(img, 0, 1600)
+
+            tempfile = BytesIO()
+            try:
+                img.save(tempfile, quality=80, format="JPEG")
+            except IOError:
+                ImageFile.MAXBLOCK = img.size[0] * img.size[1]
+                img.save(tempfile, quality=80, format="JPEG")
+
+            final_size = tempfile.getbuffer().nbytes
+            return final_size > MIN_BIG_IMG_SIZE
 
     return False
@@ -1,16 +1,21 @@
 # encoding: utf-8
-import os
 from io import BytesIO
+from typing import BinaryIO, Optional
 
 from PIL import Image, ImageFile, ImageOps
 
-from .data_structures import Task, TaskResult
+from .data_structures import ImageContext, Task, TaskResult
 from .img_aux_processing import downsize_img, save_compressed
 from .img_aux_processing import make_grayscale
-from .img_dynamic_quality import jpeg_dynamic_quality
+from .img_dynamic_quality import search_jpeg_quality
+from .img_info import open_image
+from .profiling import NULL_PROFILER, Profiler
 
 
-def optimize_jpg(task: Task) -> TaskResult:
+def optimize_jpg(task: Task,
+                 image: Optional[ImageContext] = None,
+                 dest: Optional[BinaryIO] = None,
+                 profiler: Profiler = NULL_PROFILER) -> TaskResult:
     """ Try to reduce file size of a JPG image.
 
     Expects a Task object containing all the parameters for the image processing.
@@ -21,13 +26,21 @@ def optimize_jpg(task: Task) -> TaskResult:
     and resulting status of the optimization.
 
     :param task: A Task object containing all the parameters for the image processing.
+    :param image: The already opened image file, if available.
+    :param dest: A file object where the result should be written, instead
+                 of replacing the original file (only if it is optimized).
+    :param profiler: Where to record the time spent in each stage (only
+                     when profiling).
     :return: A TaskResult object containing information for single file report.
     """
-    img: Image.Image = Image.open(task.src_path)
+    if image is None:
+        image = open_image(task.src_path)
+
+    img: Image.Image = image.img
     orig_format = img.format
     orig_mode = img.mode
 
-    orig_size = os.path.getsize(task.src_path)
+    orig_size = image.orig_size
     orig_colors, final_colors = 0, 0
 
     result_format = "JPEG"
@@ -39,20 +52,26 @@ def optimize_jpg(task: Task) -> TaskResult:
         had_exif = False
 
     if task.max_w or task.max_h:
-        img, was_downsized = downsize_img(img, task.max_w, task.max_h)
+        with profiler.stage('resize'):
+            img, was_downsized = downsize_img(img, task.max_w, task.max_h)
     else:
         was_downsized = False
 
     if task.grayscale:
-        img = make_grayscale(img)
+        with profiler.stage('convert'):
+            img = make_grayscale(img)
 
     # only use progressive if file size is bigger
     use_progressive_jpg = orig_size > 10000
 
     if task.fast_mode:
         quality = task.quality
+        encodes = 1
     else:
-        quality, _ = jpeg_dynamic_quality(img)
+        with profiler.stage('quality search'):
+            quality_search = search_jpeg_quality(img, strategy=task.quality_search)
+        quality = quality_search.quality
+        encodes = quality_search.encodes + 1
 
     tmp_buffer = BytesIO()  # In-memory buffer
 
@@ -66,22 +85,27 @@ def optimize_jpg(task: Task) -> TaskResult:
     if task.keep_exif and had_exif and exif:
         save_kwargs["exif"] = exif
 
-    try:
-        img.save(tmp_buffer, **save_kwargs)
-    except IOError:
-        ImageFile.MAXBLOCK = img.size[0] * img.size[1]
-        img.save(tmp_buffer, **save_kwargs)
+    with profiler.stage('encode'):
+        try:
+            img.save(tmp_buffer, **save_kwargs)
+        except IOError:
+            ImageFile.MAXBLOCK = img.size[0] * img.size[1]
+            img.save(tmp_buffer, **save_kwargs)
 
     has_exif = bool(save_kwargs.get("exif"))
 
     img_mode = img.mode
     img.close()
     compare_sizes = not task.no_size_comparison
-    was_optimized, final_size = save_compressed(task.src_path,
-                                                tmp_buffer,
-                                                compare_sizes)
+    with profiler.stage('write'):
+        was_optimized, final_size = save_compressed(task.src_path,
+                                                    tmp_buffer,
+                                                    compare_sizes,
+                                                    orig_size=orig_size,
+                                                    dest=dest,
+                                                    keep_timestamps=task.keep_timestamps)
 
     return TaskResult(task.src_path, orig_format, result_format, orig_mode,
                       img_mode, orig_colors, final_colors, orig_size,
                       final_size, was_optimized, was_downsized, had_exif,
-                      has_exif, task.output_config)
+                      has_exif, task.output_config, encodes, quality=quality)
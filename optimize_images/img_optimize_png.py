@@ -1,16 +1,23 @@
 # encoding: utf-8
 import os
 from io import BytesIO
+from typing import BinaryIO, Optional
 
 from PIL import Image, ImageFile
 
-from optimize_images.data_structures import Task, TaskResult
+from optimize_images.data_structures import ImageContext, Task, TaskResult
 from optimize_images.img_aux_processing import do_reduce_colors, downsize_img, rebuild_palette
 from optimize_images.img_aux_processing import remove_transparency, make_grayscale, save_compressed
-from optimize_images.img_info import is_big_png_photo
+from optimize_images.img_aux_processing import reduce_mode_losslessly
+from optimize_images.img_info import is_big_png_photo, open_image
+from optimize_images.img_png_trials import encode_png_trials
+from optimize_images.profiling import NULL_PROFILER, Profiler
 
 
-def optimize_png(task: Task) -> TaskResult:
+def optimize_png(task: Task,
+                 image: Optional[ImageContext] = None,
+                 dest: Optional[BinaryIO] = None,
+                 profiler: Profiler = NULL_PROFILER) -> TaskResult:
     """ Try to reduce file size of a PNG image.
 
         Expects a Task object containing all the parameters for the image processing.
@@ -21,10 +28,17 @@ def optimize_png(task: Task) -> TaskResult:
         and resulting status of the optimization.
 
         :param task: A Task object containing all the parameters for the image processing.
+        :param image: The already opened image file, if available.
+        :param dest: A file object where the result should be written, instead
+                     of replacing the original file (only if it is optimized).
+        :param profiler: Where to record the time spent in each stage (only
+                         when profiling).
         :return: A TaskResult object containing information for single file report.
         """
+    if image is None:
+        image = open_image(task.src_path)
 
-    img: Image.Image = Image.open(task.src_path)
+    img: Image.Image = image.img
     orig_format = img.format
     orig_mode = img.mode
 
@@ -33,99 +47,129 @@ def optimize_png(task: Task) -> TaskResult:
     if folder == '':
         folder = os.getcwd()
 
-    orig_size = os.path.getsize(task.src_path)
+    orig_size = image.orig_size
     orig_colors, final_colors = 0, 0
 
     had_exif = has_exif = False  # Currently no exif methods for PNG files
-    if orig_mode == 'P':
-        final_colors = orig_colors = len(img.getcolors())
+    with profiler.stage('analysis'):
+        if orig_mode == 'P':
+            final_colors = orig_colors = len(img.getcolors())
+        convert_to_jpg = task.convert_all or (task.conv_big and is_big_png_photo(image))
 
-    if task.convert_all or (task.conv_big and is_big_png_photo(task.src_path)):
+    if convert_to_jpg:
         # convert to jpg format
         filename = os.path.splitext(os.path.basename(task.src_path))[0]
         output_path = os.path.join(folder + "/" + filename + ".jpg")
 
         if task.max_w or task.max_h:
-            img, was_downsized = downsize_img(img, task.max_w, task.max_h)
+            with profiler.stage('resize'):
+                img, was_downsized = downsize_img(img, task.max_w, task.max_h)
         else:
             was_downsized = False
 
-        img = remove_transparency(img, task.bg_color)
-        img = img.convert("RGB")
+        with profiler.stage('convert'):
+            img = remove_transparency(img, task.bg_color)
+            img = img.convert("RGB")
 
-        if task.grayscale:
-            img = make_grayscale(img)
+            if task.grayscale:
+                img = make_grayscale(img)
 
         tmp_buffer = BytesIO()  # In-memory buffer
-        try:
-            img.save(
-                tmp_buffer,
-                quality=task.quality,
-                optimize=True,
-                progressive=True,
-                format="JPEG")
-        except IOError:
-            ImageFile.MAXBLOCK = img.size[0] * img.size[1]
-            img.save(
-                tmp_buffer,
-                quality=task.quality,
-                optimize=True,
-                progressive=True,
-                format="JPEG")
+        with profiler.stage('encode'):
+            try:
+                img.save(
+                    tmp_buffer,
+                    quality=task.quality,
+                    optimize=True,
+                    progressive=True,
+                    format="JPEG")
+            except IOError:
+                ImageFile.MAXBLOCK = img.size[0] * img.size[1]
+                img.save(
+                    tmp_buffer,
+                    quality=task.quality,
+                    optimize=True,
+                    progressive=True,
+                    format="JPEG")
 
         img_mode = img.mode
         img.close()
         compare_sizes = not (task.no_size_comparison or task.convert_all)
-        was_optimized, final_size = save_compressed(task.src_path,
-                                                    tmp_buffer,
-                                                    force_delete=task.force_del,
-                                                    compare_sizes=compare_sizes,
-                                                    output_path=output_path)
+        with profiler.stage('write'):
+            was_optimized, final_size = save_compressed(task.src_path,
+                                                        tmp_buffer,
+                                                        force_delete=task.force_del,
+                                                        compare_sizes=compare_sizes,
+                                                        output_path=output_path,
+                                                        orig_size=orig_size,
+                                                        dest=dest,
+                                                        keep_timestamps=task.keep_timestamps)
 
         result_format = "JPEG"
         return TaskResult(task.src_path, orig_format, result_format,
                           orig_mode, img_mode, orig_colors, final_colors,
                           orig_size, final_size, was_optimized,
                           was_downsized, had_exif, has_exif,
-                          task.output_config)
+                          task.output_config, encodes=1, quality=task.quality)
 
     # if PNG and user didn't ask for PNG to JPEG conversion, do this instead.
     else:
         result_format = "PNG"
         if task.remove_transparency:
-            img = remove_transparency(img, task.bg_color)
+            with profiler.stage('convert'):
+                img = remove_transparency(img, task.bg_color)
 
         if task.max_w or task.max_h:
-            img, was_downsized = downsize_img(img, task.max_w, task.max_h)
+            with profiler.stage('resize'):
+                img, was_downsized = downsize_img(img, task.max_w, task.max_h)
         else:
             was_downsized = False
 
         if task.reduce_colors:
-            img, orig_colors, final_colors = do_reduce_colors(
-                img, task.max_colors)
+            with profiler.stage('palette'):
+                img, orig_colors, final_colors = do_reduce_colors(
+                    img, task.max_colors)
 
         if task.grayscale:
-            img = make_grayscale(img)
+            with profiler.stage('convert'):
+                img = make_grayscale(img)
 
         if not task.fast_mode and img.mode == "P":
-            img, final_colors = rebuild_palette(img)
-
-        tmp_buffer = BytesIO()  # In-memory buffer
-        try:
-            img.save(tmp_buffer, optimize=True, format=result_format)
-        except IOError:
-            ImageFile.MAXBLOCK = img.size[0] * img.size[1]
-            img.save(tmp_buffer, optimize=True, format=result_format)
-
+            with profiler.stage('palette'):
+                img, final_colors = rebuild_palette(img)
+        elif not task.fast_mode:
+            with profiler.stage('analysis'):
+                img, reduced_colors = reduce_mode_losslessly(img)
+                final_colors = reduced_colors or final_colors
+
+        encodes, png_trial = 1, ''
         img_mode = img.mode
+        with profiler.stage('encode'):
+            if task.png_budget and not task.fast_mode:
+                trials = encode_png_trials(img, task.png_budget)
+                tmp_buffer = trials.buffer
+                encodes, png_trial = trials.encodes, trials.trial
+            else:
+                tmp_buffer = BytesIO()  # In-memory buffer
+                try:
+                    img.save(tmp_buffer, optimize=True, format=result_format)
+                except IOError:
+                    ImageFile.MAXBLOCK = img.size[0] * img.size[1]
+                    img.save(tmp_buffer, optimize=True, format=result_format)
+
         img.close()
         compare_sizes = not task.no_size_comparison
-        was_optimized, final_size = save_compressed(task.src_path,
-                                                    tmp_buffer,
-                                                    force_delete=task.force_del,
-                                                    compare_sizes=compare_sizes)
+        with profiler.stage('write'):
+            was_optimized, final_size = save_compressed(task.src_path,
+                                                        tmp_buffer,
+                                                        force_delete=task.force_del,
+                                                        compare_sizes=compare_sizes,
+                                                        orig_size=orig_size,
+                                                        dest=dest,
+                                                        keep_timestamps=task.keep_timestamps)
 
         return TaskResult(task.src_path, orig_format, result_format, orig_mode,
                           img_mode, orig_colors, final_colors, orig_size,
                           final_size, was_optimized, was_downsized, had_exif,
-                          has_exif, task.output_config)
+                          has_exif, task.output_config, encodes=encodes,
+                          png_trial=png_trial)
@@ -0,0 +1,197 @@
+# encoding: utf-8
+"""
+Conversion of PNG and JPEG images to other output formats (WebP or AVIF),
+selected by --output-format.
+
+For each candidate format, the quality is searched in the same way as for JPEG
+images (see img_dynamic_quality), so that every candidate attains the same
+quality threshold. PNG images are also encoded as lossless WebP. The candidates
+are encoded concurrently, in threads (Pillow releases the GIL while encoding),
+and the smallest one is kept.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from typing import Any, BinaryIO, Dict, List, NamedTuple, Optional
+
+from PIL import Image, ImageFile, features
+
+from optimize_images.constants import AUTO_OUTPUT_FORMAT, OUTPUT_FORMATS
+from optimize_images.data_structures import ImageContext, Task, TaskResult
+from optimize_images.img_aux_processing import downsize_img, make_grayscale
+from optimize_images.img_aux_processing import remove_transparency, save_compressed
+from optimize_images.img_dynamic_quality import search_quality
+from optimize_images.img_info import open_image
+from optimize_images.profiling import NULL_PROFILER, Profiler
+
+
+class OutputCandidate(NamedTuple):
+    extension: str  # The file extension of the output format (e.g., 'webp')
+    img_format: str  # The Pillow format name (e.g., 'WEBP')
+    lossless: bool = False
+
+
+class EncodedCandidate(NamedTuple):
+    candidate: OutputCandidate
+    buffer: BytesIO
+    quality: int  # The quality setting used (0 if lossless)
+    encodes: int  # The number of encodes, including the quality search
+
+
+def available_output_formats() -> List[str]:
+    """ Get the output formats (file extensions) supported by the installed
+        version of Pillow (AVIF requires Pillow 11.3 or later).
+    """
+    return [extension for extension in OUTPUT_FORMATS if features.check(extension)]
+
+
+def output_candidates(output_format: str, orig_format: str) -> List[OutputCandidate]:
+    """ Get the candidates to try for the specified output format ('webp',
+        'avif' or 'auto'), for an image in the specified original format
+        (only the formats available in the installed version of Pillow).
+    """
+    available = available_output_formats()
+    if output_format == AUTO_OUTPUT_FORMAT:
+        extensions = available
+    else:
+        extensions = [output_format] if output_format in available else []
+
+    candidates = [OutputCandidate(extension, OUTPUT_FORMATS[extension])
+                  for extension in extensions]
+    if orig_format == 'PNG' and 'webp' in extensions:
+        candidates.append(OutputCandidate('webp', 'WEBP', lossless=True))
+    return candidates
+
+
+def _encode_candidate(img: Image.Image,
+                      candidate: OutputCandidate,
+                      task: Task,
+                      save_kwargs: Dict[str, Any]) -> EncodedCandidate:
+    # Image.save() keeps some state in the image object, so each thread
+    # needs its own copy.
+    img = img.copy()
+    if candidate.lossless:
+        quality, encodes = 0, 1
+        params = dict(save_kwargs, lossless=True)
+    else:
+        if task.fast_mode:
+            quality, encodes = task.quality, 1
+        else:
+            quality_search = search_quality(img, candidate.img_format,
+                                            strategy=task.quality_search)
+            quality, encodes = quality_search.quality, quality_search.encodes + 1
+        params = dict(save_kwargs, quality=quality)
+        if candidate.img_format == 'WEBP':
+            params['method'] = 6
+
+    buffer = BytesIO()
+    try:
+        img.save(buffer, format=candidate.img_format, **params)
+    except IOError:
+        ImageFile.MAXBLOCK = img.size[0] * img.size[1]
+        buffer = BytesIO()
+        img.save(buffer, format=candidate.img_format, **params)
+    return EncodedCandidate(candidate, buffer, quality, encodes)
+
+
+def optimize_to_format(task: Task,
+                       image: Optional[ImageContext] = None,
+                       dest: Optional[BinaryIO] = None,
+                       profiler: Profiler = NULL_PROFILER) -> TaskResult:
+    """ Convert a PNG or JPEG image to the output format of the task (WebP,
+        AVIF or the smallest of them).
+
+    As when converting PNG images to JPEG (-ca), the result is saved alongside
+    the original file, with the extension of the new format, and the original
+    file is only deleted if requested (force_del). By default, the result is
+    only saved if it is smaller than the original file.
+
+    :param task: A Task object containing all the parameters for the image processing.
+    :param image: The already opened image file, if available.
+    :param dest: A file object where the result should be written, instead
+                 of saving it to the disk (only if it is optimized).
+    :param profiler: Where to record the time spent in each stage (only
+                     when profiling).
+    :return: A TaskResult object containing information for single file report
+             (or for an image not processed, if the output format isn't
+             supported by the installed version of Pillow).
+    """
+    if image is None:
+        image = open_image(task.src_path)
+
+    candidates = output_candidates(task.output_format, image.img_format)
+    if not candidates:
+        error = f'{task.output_format.upper()} output is not supported ' \
+                f'by the installed version of Pillow.'
+        return TaskResult.unprocessed(task, image.orig_size, error)
+
+    img: Image.Image = image.img
+    orig_format = image.img_format
+    orig_mode = img.mode
+    orig_size = image.orig_size
+
+    try:
+        exif = img.getexif()
+        had_exif = bool(exif and len(exif) > 0)
+    except Exception:
+        exif, had_exif = None, False
+
+    if task.max_w or task.max_h:
+        with profiler.stage('resize'):
+            img, was_downsized = downsize_img(img, task.max_w, task.max_h)
+    else:
+        was_downsized = False
+
+    with profiler.stage('convert'):
+        if task.remove_transparency:
+            img = remove_transparency(img, task.bg_color)
+        if task.grayscale:
+            img = make_grayscale(img)
+        # Both formats (and the quality search) work with RGB or RGBA images.
+        # An alpha channel is only kept if it is actually used.
+        if 'A' in img.getbands() or 'transparency' in img.info:
+            img = img.convert('RGBA')
+            if img.getchannel('A').getextrema() == (255, 255):
+                img = img.convert('RGB')
+        else:
+            img = img.convert('RGB')
+
+    save_kwargs: Dict[str, Any] = {}
+    if task.keep_exif and had_exif:
+        save_kwargs['exif'] = exif
+
+    with profiler.stage('encode'):
+        img.load()
+        with ThreadPoolExecutor(max_workers=len(candidates)) as executor:
+            encoded: List[EncodedCandidate] = list(executor.map(
+                lambda candidate: _encode_candidate(img, candidate, task, save_kwargs),
+                candidates))
+
+    best = min(encoded, key=lambda result: result.buffer.getbuffer().nbytes)
+    output_path = f'{os.path.splitext(task.src_path)[0]}.{best.candidate.extension}'
+
+    img_mode = img.mode
+    img.close()
+    compare_sizes = not task.no_size_comparison
+    with profiler.stage('write'):
+        was_optimized, final_size = save_compressed(task.src_path,
+                                                    best.buffer,
+                                                    force_delete=task.force_del,
+                                                    compare_sizes=compare_sizes,
+                                                    output_path=output_path,
+                                                    orig_size=orig_size,
+                                                    dest=dest,
+                                                    keep_timestamps=task.keep_timestamps)
+
+    encodes = sum(result.encodes for result in encoded)
+    if not was_optimized:
+        # The original image was kept
+        return TaskResult(task.src_path, orig_format, orig_format, orig_mode,
+                          orig_mode, 0, 0, orig_size, final_size, False, False,
+                          had_exif, had_exif, task.output_config, encodes=encodes)
+
+    has_exif = bool(save_kwargs.get('exif'))
+    return TaskResult(task.src_path, orig_format, best.candidate.img_format,
+                      orig_mode, img_mode, 0, 0, orig_size, final_size,
+                      was_optimized, was_downsized, had_exif, has_exif,
+                      task.output_config, encodes=encodes, quality=best.quality)
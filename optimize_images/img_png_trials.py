@@ -0,0 +1,90 @@
+# encoding: utf-8
+"""
+Encoding of PNG images using several encoder settings (trials), keeping the
+smallest result, within a time budget per image.
+
+The first trial always runs, on its own, so that there is always a result,
+and its duration is used to estimate the duration of the remaining ones (each
+trial has a cost relative to the first one). These run concurrently, in
+threads (Pillow releases the GIL while encoding), and each one is only started
+if it is expected to finish before the time is up.
+
+Pillow doesn't allow choosing the PNG row filters (its encoder selects a filter
+for each row), so there are no trials over filter choices. There is no trial
+with a color palette either, since images with up to 256 colors are already
+converted to a palette, without losing any information, before being encoded
+(see reduce_mode_losslessly).
+"""
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from timeit import default_timer as timer
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+from PIL import Image, ImageFile
+
+from optimize_images.constants import PNG_TRIAL_THREADS
+
+
+class PngTrial(NamedTuple):
+    name: str
+    params: Dict[str, Any]  # Passed to Image.save()
+    cost: float = 1.0  # The expected encoding time, relative to the first trial
+
+
+# Ordered by how often each one is expected to win. The zlib strategy is set
+# by compress_type (e.g., 3 is Z_RLE). The costs were measured with drawings
+# and photos, rounded up.
+PNG_TRIALS = (
+    PngTrial('optimize', {'optimize': True}),
+    PngTrial('level 9', {'compress_level': 9}),
+    PngTrial('rle', {'compress_level': 9, 'compress_type': 3}, cost=0.25),
+)
+
+
+class PngTrialResult(NamedTuple):
+    buffer: BytesIO
+    trial: str  # The name of the trial that won
+    encodes: int  # The number of trials that were actually run
+
+
+def _encode(img: Image.Image, params: Dict[str, Any]) -> BytesIO:
+    buffer = BytesIO()
+    try:
+        img.save(buffer, format='PNG', **params)
+    except IOError:
+        ImageFile.MAXBLOCK = img.size[0] * img.size[1]
+        buffer = BytesIO()
+        img.save(buffer, format='PNG', **params)
+    return buffer
+
+
+def encode_png_trials(img: Image.Image,
+                      budget: float,
+                      trials: Sequence[PngTrial] = PNG_TRIALS) -> PngTrialResult:
+    """ Encode a PNG image using each trial that is expected to finish within
+        the time budget (in seconds), and return the smallest result.
+    """
+    deadline = timer() + budget
+    img.load()
+
+    def run(trial: PngTrial) -> Tuple[PngTrial, BytesIO]:
+        # Image.save() keeps some state in the image object, so each thread
+        # needs its own copy.
+        return trial, _encode(img.copy(), trial.params)
+
+    start = timer()
+    done: List[Tuple[PngTrial, BytesIO]] = [run(trials[0])]
+    time_per_cost = (timer() - start) / trials[0].cost
+
+    def run_in_budget(trial: PngTrial) -> Optional[Tuple[PngTrial, BytesIO]]:
+        if timer() + trial.cost * time_per_cost > deadline:
+            return None
+        return run(trial)
+
+    remaining = trials[1:]
+    if remaining:
+        with ThreadPoolExecutor(max_workers=min(PNG_TRIAL_THREADS, len(remaining))) as executor:
+            done.extend(outcome for outcome in executor.map(run_in_budget, remaining) if outcome)
+
+    trial, buffer = min(done, key=lambda outcome: outcome[1].getbuffer().nbytes)
+    return PngTrialResult(buffer, trial.name, len(done))
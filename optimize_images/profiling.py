@@ -0,0 +1,173 @@
+# encoding: utf-8
+"""
+Opt-in instrumentation (--profile) of the time spent in each processing stage
+and the peak memory used while processing each image.
+
+When profiling is off, the processing functions use NULL_PROFILER, whose
+stages are just a shared no-op context manager.
+"""
+import threading
+import tracemalloc
+from collections import defaultdict
+from contextlib import contextmanager, nullcontext
+from timeit import default_timer as timer
+from typing import Dict, Iterator
+
+from optimize_images.data_structures import TaskResult
+
+# The names of the processing stages, in the order they usually happen.
+STAGES = ('read', 'decode', 'resize', 'convert', 'analysis', 'quality search',
+          'palette', 'encode', 'write')
+
+_NULL_STAGE = nullcontext()
+
+
+class _PeakMemory:
+    """ Measure the peak memory used by the current process since it was
+        created, above the memory that was already in use.
+
+    On Linux, the peak resident set size (RSS) is reset at the start, which
+    includes the memory allocated by Pillow for the pixel data. Elsewhere,
+    only the memory allocated by Python code can be traced (tracemalloc,
+    which is started once and then kept running in the process).
+
+    Both peaks are process-wide, so they can only be attributed to an image
+    if it is processed alone in its process, as in the usual worker
+    processes. When several images are processed at the same time in one
+    process (e.g., in a thread pool), the peak is not measured (0) for any of
+    them.
+    """
+    _lock = threading.Lock()
+    _active = set()  # The measurements in progress in this process
+
+    def __init__(self):
+        self.peak = 0
+        self._stopped = False
+        with self._lock:
+            self._shared = bool(self._active)
+            for other in self._active:
+                other._shared = True
+            self._active.add(self)
+            if not self._shared:
+                self._use_rss = _reset_peak_rss()
+                if self._use_rss:
+                    self._start = _read_status_kb('VmRSS')
+                else:
+                    if not tracemalloc.is_tracing():
+                        tracemalloc.start()
+                    tracemalloc.reset_peak()
+                    self._start = tracemalloc.get_traced_memory()[0]
+
+    def stop(self) -> int:
+        with self._lock:
+            if self._stopped:
+                return self.peak
+            self._stopped = True
+            self._active.discard(self)
+            if self._shared:
+                return self.peak
+            if self._use_rss:
+                self.peak = max(_read_status_kb('VmHWM') - self._start, 0) * 1024
+            else:
+                self.peak = max(tracemalloc.get_traced_memory()[1] - self._start, 0)
+        return self.peak
+
+
+def _reset_peak_rss() -> bool:
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+        return bool(_read_status_kb('VmHWM'))
+    except OSError:
+        return False
+
+
+def _read_status_kb(field: str) -> int:
+    with open('/proc/self/status') as file:
+        for line in file:
+            if line.startswith(field + ':'):
+                return int(line.split()[1])
+    return 0
+
+
+class Profiler:
+    """ Record the time spent in each processing stage of an image and the
+        peak memory used to process it.
+
+    Usage:
+
+        profiler = Profiler()
+        with profiler.stage('encode'):
+            img.save(...)
+        result = profiler.finish(result)
+    """
+    enabled = True
+
+    def __init__(self):
+        self.stage_seconds: Dict[str, float] = defaultdict(float)
+        self._memory = _PeakMemory()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        start = timer()
+        try:
+            yield
+        finally:
+            self.stage_seconds[name] += timer() - start
+
+    def stop(self) -> None:
+        self._memory.stop()
+
+    def finish(self, result: TaskResult) -> TaskResult:
+        """ Stop measuring and add the measurements to a TaskResult. """
+        return result._replace(stage_seconds=dict(self.stage_seconds),
+                               peak_memory=self._memory.stop())
+
+
+class NullProfiler(Profiler):
+    """ A profiler that doesn't measure anything. """
+    enabled = False
+
+    def __init__(self):
+        pass
+
+    def stage(self, name: str):
+        return _NULL_STAGE
+
+    def stop(self) -> None:
+        pass
+
+    def finish(self, result: TaskResult) -> TaskResult:
+        return result
+
+
+NULL_PROFILER = NullProfiler()
+
+
+class ProfileSummary:
+    """ Aggregate the measurements of many TaskResults, by image format. """
+
+    def __init__(self):
+        self.files: Dict[str, int] = defaultdict(int)
+        self.encodes: Dict[str, int] = defaultdict(int)
+        self.peak_memory: Dict[str, int] = defaultdict(int)
+        self.stage_seconds: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+
+    def add(self, result: TaskResult) -> None:
+        if not result.stage_seconds:
+            # Cached or unreadable files weren't actually processed
+            return
+        img_format = result.orig_format or 'other'
+        self.files[img_format] += 1
+        self.encodes[img_format] += result.encodes
+        self.peak_memory[img_format] = max(self.peak_memory[img_format], result.peak_memory)
+        for stage, seconds in result.stage_seconds.items():
+            self.stage_seconds[img_format][stage] += seconds
+
+    def __bool__(self) -> bool:
+        return bool(self.files)
+
+    def stages(self):
+        """ The names of the stages found, in processing order. """
+        found = {stage for times in self.stage_seconds.values() for stage in times}
+        return [stage for stage in STAGES if stage in found] + sorted(found.difference(STAGES))
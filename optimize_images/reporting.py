@@ -1,8 +1,12 @@
 # encoding: utf-8
+import json
+import sys
 from functools import lru_cache
+from typing import Optional
 
-from optimize_images.data_structures import OutputConfiguration, TaskResult
+from optimize_images.data_structures import BatchResult, OutputConfiguration, TaskResult
 from optimize_images.platforms import IconGenerator
+from optimize_images.profiling import ProfileSummary
 
 
 @lru_cache(maxsize=None)
@@ -19,6 +23,16 @@ def human(number: int, suffix='B') -> str:
     return f"{number:.1f}{'Yi'}{suffix}"
 
 
+def overall_progress(processed: int, discovered: int, counting_finished: bool) -> str:
+    """ Describe the progress of a batch, as a percentage once all the images
+        were counted, or as the number of images found so far until then.
+    """
+    if counting_finished:
+        perc_done = min(processed / discovered * 100, 100) if discovered else 100
+        return f"{perc_done:.1f}%"
+    return f"{processed} processed / {discovered} discovered so far"
+
+
 def show_file_status(result: TaskResult, line_width: int, icons: IconGenerator):
     output_config = result.output_config
 
@@ -64,7 +78,8 @@ def show_final_report(found_files: int,
                       src_size: int,
                       bytes_saved: int,
                       time_passed: float,
-                      output_config: OutputConfiguration):
+                      output_config: OutputConfiguration,
+                      profile: Optional[ProfileSummary] = None):
     """
     Show a final report with the time spent and filesize savings
 
@@ -73,6 +88,7 @@ def show_final_report(found_files: int,
     :param src_size: original sum of file sizes
     :param bytes_saved: savings in file sizes (sum)
     :param time_passed: specify -1 in order to hide this (watch directory)
+    :param profile: the time spent in each stage, by format (when profiling)
     """
     
     if output_config.quiet_mode:
@@ -99,6 +115,25 @@ def show_final_report(found_files: int,
         f"\n   Total space saved: {human(bytes_saved)} / {percent:.1f}%\n"
     print(report)
 
+    if profile:
+        show_profile_report(profile)
+
+
+def show_profile_report(profile: ProfileSummary) -> None:
+    """ Show the total time spent in each processing stage, by format. """
+    report = f"{40 * '-'}\n\n   Time spent in each stage (all jobs):\n"
+    for img_format in sorted(profile.files):
+        stage_seconds = profile.stage_seconds[img_format]
+        total = sum(stage_seconds.values()) or 1
+        report += f"\n   {img_format}: {profile.files[img_format]} files, " \
+            f"{profile.encodes[img_format]} encodes, " \
+            f"peak memory {human(profile.peak_memory[img_format])}\n"
+        for stage in profile.stages():
+            if stage in stage_seconds:
+                seconds = stage_seconds[stage]
+                report += f"      {stage:<16}{seconds:>8.2f}s {seconds / total * 100:>5.1f}%\n"
+    print(report)
+
 
 def show_img_exception(exception: Exception, image_path: str, details: str = '') -> None:
     print("\nAn error has occurred while trying to optimize this file:")
@@ -109,3 +144,38 @@ def show_img_exception(exception: Exception, image_path: str, details: str = '')
 
     print("\nThe following info may help to understand what has gone wrong here:\n")
     print(exception)
+
+
+class JsonLinesReport:
+    """ Write a JSON record (one per line) for each processed image, as soon as
+        it is available, and a summary record at the end.
+
+    Each line is flushed right away, so that the file can be followed while a
+    batch is running. The path '-' means the standard output.
+    """
+
+    def __init__(self, path: str):
+        if path == '-':
+            self.file = sys.stdout
+        else:
+            self.file = open(path, 'w', encoding='utf-8')
+
+    def add(self, result: TaskResult) -> None:
+        self._write({'type': 'result', **result.to_dict()})
+
+    def finish(self, batch: BatchResult, completed: bool = True) -> None:
+        """ Write the summary record and close the file. """
+        self._write({'type': 'summary',
+                     'found_files': batch.found_files,
+                     'optimized_files': batch.optimized_files,
+                     'skipped_files': batch.skipped_files,
+                     'total_src_size': batch.total_src_size,
+                     'total_bytes_saved': batch.total_bytes_saved,
+                     'elapsed_seconds': batch.elapsed_seconds,
+                     'completed': completed})
+        if self.file is not sys.stdout:
+            self.file.close()
+
+    def _write(self, record: dict) -> None:
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
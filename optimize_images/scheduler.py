@@ -0,0 +1,341 @@
+# encoding: utf-8
+"""
+Dispatching of image processing tasks to a pool executor.
+
+Tasks are submitted as they are discovered, keeping a bounded number of them
+in flight, so that processing starts right away and memory usage does not
+grow with the number of files found. Results are yielded as soon as each
+submission completes, so that a slow image doesn't hold back the results of
+the others (unless they are requested in the order the images were found).
+
+Before a task is admitted, the header of its image file is read (preflight),
+to estimate its cost and apply the policy for images with too many pixels
+(Task.max_pixels and Task.huge_images): skip them, without submitting them at
+all, process them alone, or downsize them on load.
+
+Among the tasks discovered but not yet submitted (up to SCHEDULER_WINDOW of
+them), the most expensive ones are submitted first, estimating their cost
+from the image dimensions, so that a few huge images found near the end
+don't leave the other workers idle while they are processed. Small images
+are sent to the workers in chunks, to reduce the communication overhead per
+image. The window is filled while the workers are busy: whenever there is
+room for another submission, the next complete chunk is submitted right away,
+instead of waiting for the whole window to be discovered.
+
+If a memory budget is specified, the peak memory needed to process each image
+is also estimated from its header, and tasks are only submitted while the sum
+of the estimates for the submissions in flight fits in it. An image that
+doesn't fit in the budget by itself is processed alone.
+
+If a worker process terminates abruptly (e.g., it runs out of memory), the
+pool is replaced by a new one and the tasks that were in flight are retried
+one at a time, so that only the image that actually caused it is reported
+as failed.
+"""
+import heapq
+import os
+from collections import deque
+from concurrent.futures import BrokenExecutor, Executor, Future, FIRST_COMPLETED, wait
+from itertools import count
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+from typing import Union
+
+from PIL import Image
+
+from optimize_images.cache import ResultCache
+from optimize_images.constants import MAX_TASKS_PER_CHUNK, PEAK_MEMORY_COPIES
+from optimize_images.constants import SCHEDULER_WINDOW, SMALL_TASK_COST
+from optimize_images.data_structures import ImageHeader, Task, TaskResult
+from optimize_images.do_optimization import do_optimization
+from optimize_images.img_info import check_image_size, probe_image
+
+WORKER_CRASHED_MSG = 'The worker process that was processing this image ' \
+                     'terminated abruptly (it may have run out of memory).'
+
+
+class _Item(NamedTuple):
+    seq: int  # Discovery order
+    task: Task
+    cost: int
+    memory: int  # Estimated peak memory use, in bytes
+    alone: bool  # A huge image, to be processed while nothing else is
+
+
+class _Submission(NamedTuple):
+    items: List[_Item]
+    future: Future  # Resolves to a list of TaskResults (one per task)
+    executor: Optional[Executor]
+    isolated: bool  # Retried alone, after a worker crashed
+    memory: int  # The tasks are processed in a row, so it's the biggest one
+    alone: bool
+
+
+def estimate_cost(header: ImageHeader) -> Tuple[int, int]:
+    """ Estimate the relative cost of processing an image, from its number
+        of pixels, and the peak memory needed to process it, in bytes.
+    """
+    bands = Image.getmodebands(header.mode)
+    if header.mode in ('P', 'PA') or header.has_transparency:
+        # It may be converted to RGBA
+        bands = 4
+    # Grayscale images may also be converted to RGB
+    memory = header.pixels * max(bands, 3) * PEAK_MEMORY_COPIES + header.file_size
+    return header.pixels, memory
+
+
+def preflight(seq: int, task: Task) -> Union[_Item, TaskResult]:
+    """ Read the header of the image file, to estimate the cost of the task
+        and apply the policy for huge images, before the task is admitted.
+
+    :return: The task to be submitted, or a TaskResult if it is skipped.
+    """
+    header = probe_image(task.src_path)
+    if header is None:
+        # It will be reported by the worker
+        file_size = _file_size(task.src_path)
+        return _Item(seq, task, file_size, file_size * PEAK_MEMORY_COPIES, False)
+
+    task, error = check_image_size(task, header)
+    if error:
+        return TaskResult.unprocessed(task, header.file_size, error)
+    cost, memory = estimate_cost(header)
+    alone = header.pixels > task.max_pixels and task.huge_images == 'isolate'
+    return _Item(seq, task, cost, memory, alone)
+
+
+def _file_size(src_path: str) -> int:
+    try:
+        return os.path.getsize(src_path)
+    except OSError:
+        return 0
+
+
+def optimize_chunk(tasks: List[Task]) -> List[TaskResult]:
+    """ Process a few tasks in a row (in a worker process). """
+    return [do_optimization(task) for task in tasks]
+
+
+class _Window:
+    """ The tasks discovered but not yet submitted, most expensive first. """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._heap: List[Tuple[int, int, _Item]] = []
+        self._cost = 0
+
+    def __len__(self) -> int:
+        return len(self._heap)
+
+    def is_full(self) -> bool:
+        return len(self._heap) >= self.max_size
+
+    def add(self, item: _Item) -> None:
+        heapq.heappush(self._heap, (-item.cost, item.seq, item))
+        self._cost += item.cost
+
+    def has_chunk(self) -> bool:
+        """ Whether the next chunk is already complete (i.e., it wouldn't
+            grow if more small tasks were discovered).
+        """
+        return bool(self._heap) and (self.peek().alone
+                                     or self._cost > SMALL_TASK_COST
+                                     or len(self._heap) >= MAX_TASKS_PER_CHUNK)
+
+    def peek(self) -> _Item:
+        """ The next task (the first one in the next chunk). """
+        return self._heap[0][2]
+
+    def pop_next(self) -> List[_Item]:
+        """ Get the most expensive task or, if it is small, a chunk of small
+            tasks.
+        """
+        neg_cost, _, item = heapq.heappop(self._heap)
+        chunk = [item]
+        chunk_cost = -neg_cost
+        while (self._heap and len(chunk) < MAX_TASKS_PER_CHUNK
+               and not chunk[0].alone and not self.peek().alone
+               and chunk_cost - self._heap[0][0] <= SMALL_TASK_COST):
+            neg_cost, _, item = heapq.heappop(self._heap)
+            chunk.append(item)
+            chunk_cost -= neg_cost
+        self._cost -= chunk_cost
+        return chunk
+
+
+class _ResultOrder:
+    """ Release the results either right away or in discovery order. """
+
+    def __init__(self, ordered: bool):
+        self.ordered = ordered
+        self._next_seq = 0
+        self._pending: Dict[int, TaskResult] = {}
+
+    def release(self, seq: int, result: TaskResult) -> List[TaskResult]:
+        if not self.ordered:
+            return [result]
+        self._pending[seq] = result
+        released = []
+        while self._next_seq in self._pending:
+            released.append(self._pending.pop(self._next_seq))
+            self._next_seq += 1
+        return released
+
+    def flush(self) -> List[TaskResult]:
+        """ Release all the results held back, even if some are missing. """
+        released = [self._pending[seq] for seq in sorted(self._pending)]
+        self._pending.clear()
+        return released
+
+
+def run_tasks(executor: Optional[Executor],
+              tasks: Iterable[Task],
+              max_in_flight: int,
+              cache: Optional[ResultCache] = None,
+              window_size: int = SCHEDULER_WINDOW,
+              ordered: bool = False,
+              new_executor: Optional[Callable[[], Executor]] = None,
+              max_memory: int = 0) -> Iterator[TaskResult]:
+    """ Process each task using the executor, yielding the results as they
+        are completed (or in the same order as the tasks, if ordered is True).
+
+    The tasks iterable is consumed lazily, and no more than max_in_flight
+    submissions are sent to the executor at a given time. Up to window_size
+    discovered tasks are kept waiting, to be submitted by decreasing cost. If
+    no executor is specified, the tasks are processed in the current thread,
+    in the same order. If a cache is specified, tasks that were already
+    processed are not submitted at all, and the results of the remaining ones
+    are stored in the cache.
+
+    If max_memory is specified (in bytes), tasks are only submitted while the
+    sum of their estimated peak memory use fits in it. The tasks are still
+    submitted by decreasing cost, so a task that doesn't fit has to wait for
+    others to complete (an oversized one runs alone).
+
+    If the executor breaks (because a worker process crashed) and new_executor
+    is specified, it is called to replace it, and a failed TaskResult is
+    yielded for the image that caused it. Otherwise, BrokenExecutor is raised.
+    On KeyboardInterrupt, the results that were already completed are yielded
+    before it is raised again.
+    """
+    if executor is None:
+        for task in tasks:
+            cached_result = cache.lookup(task) if cache is not None else None
+            if cached_result is None:
+                cached_result = do_optimization(task._replace(record_source=cache is not None))
+                if cache is not None:
+                    cache.store(task, cached_result)
+            yield cached_result
+        return
+
+    window = _Window(max(window_size, 1))
+    order = _ResultOrder(ordered)
+    in_flight: Dict[Future, _Submission] = {}
+    suspects: Deque[_Item] = deque()
+    seqs = count()
+    pending_tasks = iter(tasks)
+    exhausted = False
+
+    def submit(items: List[_Item], isolated: bool) -> None:
+        nonlocal executor
+        chunk = [item.task for item in items]
+        try:
+            future = executor.submit(optimize_chunk, chunk)
+        except BrokenExecutor:
+            if new_executor is None:
+                raise
+            executor = new_executor()
+            future = executor.submit(optimize_chunk, chunk)
+        in_flight[future] = _Submission(items, future, executor, isolated,
+                                        max(item.memory for item in items),
+                                        any(item.alone for item in items))
+
+    def fits(item: _Item) -> bool:
+        if not in_flight:
+            return True
+        if item.alone or any(s.alone for s in in_flight.values()):
+            return False
+        return not max_memory or sum(s.memory for s in in_flight.values()) + item.memory <= max_memory
+
+    try:
+        while True:
+            # Discover more tasks, yielding the cached results right away,
+            # until there is a complete chunk that can be submitted now
+            while not exhausted and not window.is_full():
+                if (not suspects and len(in_flight) < max_in_flight
+                        and window.has_chunk() and fits(window.peek())):
+                    break
+                task = next(pending_tasks, None)
+                if task is None:
+                    exhausted = True
+                    break
+                seq = next(seqs)
+                cached_result = cache.lookup(task) if cache is not None else None
+                if cached_result is not None:
+                    yield from order.release(seq, cached_result)
+                    continue
+                if cache is not None:
+                    # The worker records the state of the file to be cached
+                    task = task._replace(record_source=True)
+
+                item = preflight(seq, task)
+                if isinstance(item, TaskResult):
+                    yield from order.release(seq, item)
+                else:
+                    window.add(item)
+
+            if suspects:
+                # Retry the tasks that were in flight when a worker crashed
+                # alone, one by one, to find out which one caused it
+                if not in_flight:
+                    submit([suspects.popleft()], isolated=True)
+            else:
+                while (window and len(in_flight) < max_in_flight
+                       and fits(window.peek())):
+                    submit(window.pop_next(), isolated=False)
+
+            if not in_flight:
+                if exhausted and not window:
+                    break
+                continue
+
+            # Keep discovering tasks while the submissions are in flight
+            can_discover = not exhausted and not window.is_full()
+            done, _ = wait(in_flight, timeout=0 if can_discover else None,
+                           return_when=FIRST_COMPLETED)
+            for future in done:
+                submission = in_flight.pop(future)
+                try:
+                    results = future.result()
+                except BrokenExecutor:
+                    if new_executor is None:
+                        raise
+                    if submission.executor is executor:
+                        executor = new_executor()
+                    if submission.isolated:
+                        for item in submission.items:
+                            result = TaskResult.unprocessed(item.task,
+                                                            _file_size(item.task.src_path),
+                                                            WORKER_CRASHED_MSG)
+                            yield from order.release(item.seq, result)
+                    else:
+                        suspects.extend(submission.items)
+                    continue
+
+                for item, result in zip(submission.items, results):
+                    if cache is not None:
+                        cache.store(item.task, result)
+                    yield from order.release(item.seq, result)
+
+    except KeyboardInterrupt:
+        # Keep the results that were completed before the interruption
+        completed: List[TaskResult] = []
+        for future, submission in in_flight.items():
+            if not future.done():
+                future.cancel()
+            elif not future.cancelled() and future.exception() is None:
+                for item, result in zip(submission.items, future.result()):
+                    if cache is not None:
+                        cache.store(item.task, result)
+                    completed.extend(order.release(item.seq, result))
+        yield from completed + order.flush()
+        raise
@@ -0,0 +1,473 @@
+# encoding: utf-8
+"""
+Long-running server mode, which keeps a pool of worker processes ready and
+accepts optimization jobs over a local (Unix domain) or TCP socket.
+
+The protocol is line-based: each request and each response is a JSON object,
+followed by a newline. A connection may send any number of requests, one at a
+time. The supported requests are:
+
+    {"op": "optimize", "paths": ["img.jpg", "folder"], "options": {...}}
+
+        Processes the specified images and folders (on the server machine),
+        sending one {"result": {...}} line per image as soon as it is ready,
+        followed by a {"done": true, "summary": {...}} line.
+
+    {"op": "optimize", "data": "<base64>", "filename": "img.png", "options": {...}}
+
+        Processes an image sent by the client, sending back a {"result": {...},
+        "data": "<base64>", "filename": "..."} line with the resulting image
+        (the file name changes if the image is converted to another format), followed by
+        the {"done": true, ...} line.
+
+    {"op": "stats"}
+
+        Sends back a {"stats": {...}} line, with the current queue depth and
+        throughput of the server.
+
+The options are the fields of BatchOptions (e.g., "quality", "max_w",
+"reduce_colors"). Any options not specified by the client take the values
+that were given when the server was started. If a request can't be carried
+out, an {"error": "..."} line is sent instead and the connection remains open.
+"""
+import base64
+import dataclasses
+import json
+import ipaddress
+import os
+import socket
+import socketserver
+import threading
+from concurrent.futures import BrokenExecutor, Executor, Future
+from timeit import default_timer as timer
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+from optimize_images.api import Optimizer, iter_batch_results, optimize_bytes
+from optimize_images.constants import MAX_TASKS_IN_FLIGHT_PER_WORKER, OUTPUT_FORMATS
+from optimize_images.data_structures import BatchOptions, BatchResult
+from optimize_images.data_structures import OutputConfiguration, TaskResult
+from optimize_images.exceptions import OIImagesNotFoundError, OIInvalidPathError
+from optimize_images.scheduler import WORKER_CRASHED_MSG
+
+Address = Union[str, Tuple[str, int]]
+
+# BatchOptions fields that can't be set by the clients.
+_SERVER_ONLY_OPTIONS = ('src_path', 'jobs', 'output_config')
+
+
+def _is_loopback(host: str) -> bool:
+    if host == 'localhost':
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def parse_address(address: str) -> Address:
+    """ Convert 'unix:PATH' into a socket path and 'HOST:PORT' into a
+        (host, port) tuple.
+
+    Only loopback hosts are accepted: there is no authentication, and the
+    clients can process (and replace or delete) any images that the server
+    has access to, so it must not be reachable from other machines.
+    """
+    if address.startswith('unix:'):
+        path = os.path.expanduser(address[len('unix:'):])
+        if not path:
+            raise OIInvalidPathError("\nPlease specify the path for the server socket.")
+        return path
+
+    host, sep, port = address.rpartition(':')
+    if not sep or not port.isdigit():
+        msg = "\nPlease specify the server address as unix:PATH or HOST:PORT."
+        raise OIInvalidPathError(msg)
+
+    host = host.strip('[]') or '127.0.0.1'
+    if not _is_loopback(host):
+        msg = f"\nThe server can only use a loopback address (e.g., 127.0.0.1), " \
+              f"not {host}, since it has no authentication."
+        raise OIInvalidPathError(msg)
+    return host, int(port)
+
+
+def result_from_dict(data: Dict[str, Any]) -> TaskResult:
+    fields = {k: v for k, v in data.items() if k in TaskResult._fields}
+    fields['output_config'] = OutputConfiguration(False, False, True)
+    return TaskResult(**fields)
+
+
+class ServerStats:
+    """ Thread-safe counters, used to report the server load and throughput. """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.started = timer()
+        self.active_jobs = 0
+        self.queued_tasks = 0
+        self.batch = BatchResult()
+
+    def job_started(self) -> None:
+        with self._lock:
+            self.active_jobs += 1
+
+    def job_finished(self) -> None:
+        with self._lock:
+            self.active_jobs -= 1
+
+    def task_queued(self) -> None:
+        with self._lock:
+            self.queued_tasks += 1
+
+    def task_dequeued(self, _future: Optional[Future] = None) -> None:
+        with self._lock:
+            self.queued_tasks -= 1
+
+    def task_completed(self, result: TaskResult) -> None:
+        with self._lock:
+            self.batch.add(result, keep=False)
+
+    def as_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            uptime = timer() - self.started
+            return {'uptime_seconds': round(uptime, 3),
+                    'active_jobs': self.active_jobs,
+                    'queue_depth': self.queued_tasks,
+                    'processed_files': self.batch.found_files,
+                    'optimized_files': self.batch.optimized_files,
+                    'bytes_saved': self.batch.total_bytes_saved,
+                    'files_per_second': round(self.batch.found_files / uptime, 3) if uptime else 0.0}
+
+
+class _TrackingExecutor(Executor):
+    """ Keeps track of the number of tasks waiting in (or being processed by)
+        the worker pool, which is shared by all the connections.
+    """
+
+    def __init__(self, executor: Executor, stats: ServerStats):
+        self._executor = executor
+        self._stats = stats
+
+    def submit(self, fn, *args, **kwargs) -> Future:
+        self._stats.task_queued()
+        try:
+            future = self._executor.submit(fn, *args, **kwargs)
+        except BrokenExecutor:
+            self._stats.task_dequeued()
+            raise
+        future.add_done_callback(self._stats.task_dequeued)
+        return future
+
+
+class _RequestHandler(socketserver.StreamRequestHandler):
+    server: '_ServerMixin'
+
+    def handle(self) -> None:
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+                for response in self.server.optimize_server.process_request(request):
+                    self.send(response)
+            except (BrokenPipeError, ConnectionResetError):
+                break
+            except (ValueError, TypeError, OSError) as ex:
+                self.send({'error': getattr(ex, 'message', '').strip() or str(ex)})
+            except BrokenExecutor:
+                self.send({'error': WORKER_CRASHED_MSG})
+
+    def send(self, response: Dict[str, Any]) -> None:
+        self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+        self.wfile.flush()
+
+
+class _ServerMixin:
+    daemon_threads = True
+    allow_reuse_address = True
+    optimize_server: 'OptimizeServer'
+
+
+class _TCPServer(_ServerMixin, socketserver.ThreadingTCPServer):
+    pass
+
+
+class _TCPServerIPv6(_TCPServer):
+    address_family = socket.AF_INET6
+
+
+if hasattr(socketserver, 'ThreadingUnixStreamServer'):
+    class _UnixServer(_ServerMixin, socketserver.ThreadingUnixStreamServer):
+        pass
+
+
+class OptimizeServer:
+    """ Accept optimization jobs over a socket, processing them concurrently
+        using a pool of worker processes that is kept ready between jobs.
+
+    Usage:
+
+        with OptimizeServer('unix:/run/oi.sock', BatchOptions('')) as server:
+            server.serve_forever()
+    """
+
+    def __init__(self, address: str, defaults: BatchOptions, jobs: int = 0):
+        self.address = parse_address(address)
+        self.defaults = defaults
+        self.stats = ServerStats()
+
+        if isinstance(self.address, str):
+            _remove_stale_socket(self.address)
+            self.server = _UnixServer(self.address, _RequestHandler)
+        else:
+            ipv6 = ':' in self.address[0]
+            self.server = (_TCPServerIPv6 if ipv6 else _TCPServer)(self.address, _RequestHandler)
+            # The actual port, if it was 0
+            self.address = self.server.server_address[:2]
+        self.server.optimize_server = self
+
+        self.optimizer = Optimizer(jobs or defaults.jobs)
+        self.executor = _TrackingExecutor(self.optimizer.executor, self.stats)
+        self._pool_lock = threading.Lock()
+        self.max_in_flight = self.optimizer.workers * MAX_TASKS_IN_FLIGHT_PER_WORKER
+
+    def serve_forever(self) -> None:
+        self.server.serve_forever()
+
+    def shutdown(self) -> None:
+        """ Stop serve_forever() (must be called from another thread). """
+        self.server.shutdown()
+
+    def close(self) -> None:
+        self.server.server_close()
+        self.optimizer.close()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def process_request(self, request: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """ Carry out a client request, yielding each response to be sent. """
+        op = request.get('op')
+        if op == 'stats':
+            yield {'stats': self.stats.as_dict()}
+        elif op == 'optimize':
+            options = self._options_for(request.get('options') or {})
+            self.stats.job_started()
+            try:
+                if 'data' in request:
+                    yield from self._optimize_data(request['data'],
+                                                   request.get('filename', 'image'),
+                                                   options)
+                else:
+                    yield from self._optimize_paths(request.get('paths') or [], options)
+            finally:
+                self.stats.job_finished()
+        else:
+            raise ValueError(f"Unsupported request: {op!r}")
+
+    def _options_for(self, client_options: Dict[str, Any]) -> BatchOptions:
+        valid_fields = {f.name for f in dataclasses.fields(BatchOptions)}
+        for name in client_options:
+            if name not in valid_fields or name in _SERVER_ONLY_OPTIONS:
+                raise ValueError(f"Unsupported option: {name!r}")
+        if 'bg_color' in client_options:
+            client_options = dict(client_options, bg_color=tuple(client_options['bg_color']))
+        return dataclasses.replace(self.defaults, **client_options)
+
+    def _replace_pool(self, broken: Executor) -> Executor:
+        """ Replace the worker pool, which is shared by all the connections,
+            after a worker process crashed (unless it was already replaced).
+        """
+        with self._pool_lock:
+            if self.executor is broken:
+                self.executor = _TrackingExecutor(self.optimizer._replace_pool(), self.stats)
+            return self.executor
+
+    def _optimize(self, options: BatchOptions) -> Iterator[TaskResult]:
+        executor = self.executor
+
+        def new_executor() -> Executor:
+            nonlocal executor
+            executor = self._replace_pool(executor)
+            return executor
+
+        for result in iter_batch_results(options, executor, self.max_in_flight, new_executor):
+            self.stats.task_completed(result)
+            yield result
+
+    def _optimize_paths(self, paths: List[str], options: BatchOptions) -> Iterator[Dict[str, Any]]:
+        batch = BatchResult()
+        start = timer()
+        for path in paths:
+            path_options = dataclasses.replace(options, src_path=os.path.expanduser(path))
+            try:
+                for result in self._optimize(path_options):
+                    batch.add(result, keep=False)
+                    yield {'result': result.to_dict()}
+            except OIImagesNotFoundError as ex:
+                yield {'error': ex.message.strip(), 'path': path}
+        yield {'done': True, 'summary': _summary(batch, timer() - start)}
+
+    def _optimize_data(self, data: str, filename: str,
+                       options: BatchOptions) -> Iterator[Dict[str, Any]]:
+        start = timer()
+        in_data = base64.b64decode(data, validate=True)
+        executor = self.executor
+        try:
+            future = executor.submit(optimize_bytes, in_data, options, filename)
+        except BrokenExecutor:
+            # A worker process crashed while running another job
+            executor = self._replace_pool(executor)
+            future = executor.submit(optimize_bytes, in_data, options, filename)
+        try:
+            out_data, result = future.result()
+        except BrokenExecutor:
+            self._replace_pool(executor)
+            raise
+        self.stats.task_completed(result)
+
+        # The original image is sent back if it could not be optimized
+        if result.was_optimized and result.result_format != result.orig_format:
+            if result.result_format == 'JPEG':
+                filename = os.path.splitext(filename)[0] + '.jpg'
+            elif result.result_format in OUTPUT_FORMATS.values():
+                filename = os.path.splitext(filename)[0] + '.' + result.result_format.lower()
+        batch = BatchResult()
+        batch.add(result, keep=False)
+        yield {'result': result.to_dict(),
+               'data': base64.b64encode(out_data).decode('ascii'),
+               'filename': filename}
+        yield {'done': True, 'summary': _summary(batch, timer() - start)}
+
+
+def _summary(batch: BatchResult, elapsed_seconds: float) -> Dict[str, Any]:
+    return {'found_files': batch.found_files,
+            'optimized_files': batch.optimized_files,
+            'skipped_files': batch.skipped_files,
+            'total_src_size': batch.total_src_size,
+            'total_bytes_saved': batch.total_bytes_saved,
+            'elapsed_seconds': round(elapsed_seconds, 3)}
+
+
+def _remove_stale_socket(path: str) -> None:
+    """ Remove a socket file left behind by a server that is no longer
+        running, refusing to replace one that is still in use.
+    """
+    if not os.path.exists(path):
+        return
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            os.remove(path)
+            return
+    raise OIInvalidPathError(f"\nThere is already a server listening on {path}.")
+
+
+def serve(address: str, defaults: BatchOptions, jobs: int = 0) -> None:
+    """ Run an optimization server until interrupted by the user. """
+    with OptimizeServer(address, defaults, jobs) as server:
+        if isinstance(server.address, str):
+            where = f"unix:{server.address}"
+        else:
+            where = f"{server.address[0]}:{server.address[1]}"
+        print(f"\nOptimize Images server listening on {where} "
+              f"({server.optimizer.workers} jobs). Press Ctrl+C to stop.\n")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            stats = server.stats.as_dict()
+            print(f"\n\nServer stopped after processing {stats['processed_files']} "
+                  f"files ({stats['optimized_files']} optimized).")
+
+
+class OptimizeClient:
+    """ A client for a running optimization server.
+
+    Usage:
+
+        with OptimizeClient('unix:/run/oi.sock') as client:
+            for result in client.optimize(['path/to/images'], quality=70):
+                print(result.img, result.final_size)
+    """
+
+    def __init__(self, address: str, timeout: Optional[float] = None):
+        target = parse_address(address)
+        family = socket.AF_UNIX if isinstance(target, str) else socket.AF_INET
+        if family == socket.AF_INET:
+            self.sock = socket.create_connection(target, timeout=timeout)
+        else:
+            self.sock = socket.socket(family, socket.SOCK_STREAM)
+            self.sock.settimeout(timeout)
+            self.sock.connect(target)
+        self._file = self.sock.makefile('rwb')
+        self.summary: Dict[str, Any] = {}
+        self.errors: List[str] = []
+
+    def request(self, request: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+        """ Send a raw request, yielding each response until the last one. """
+        self._file.write(json.dumps(request).encode('utf-8') + b'\n')
+        self._file.flush()
+        while True:
+            line = self._file.readline()
+            if not line:
+                raise ConnectionError("The server closed the connection.")
+            response = json.loads(line)
+            yield response
+            if request.get('op') != 'optimize' or 'done' in response:
+                return
+            if 'error' in response and 'path' not in response:
+                return
+
+    def optimize(self, paths: List[str], **options) -> Iterator[TaskResult]:
+        """ Optimize images (on the server machine), yielding a TaskResult
+            for each one. The totals are then available in self.summary, and
+            any paths where no images were found are listed in self.errors.
+        """
+        self.errors = []
+        for response in self.request({'op': 'optimize', 'paths': list(paths), 'options': options}):
+            yield from self._handle(response)
+
+    def optimize_data(self, data: bytes, filename: str, **options) -> Tuple[TaskResult, bytes, str]:
+        """ Optimize an image sent to the server, returning its TaskResult,
+            the resulting image data and file name.
+        """
+        request = {'op': 'optimize', 'filename': filename, 'options': options,
+                   'data': base64.b64encode(data).decode('ascii')}
+        output = None
+        for response in self.request(request):
+            for result in self._handle(response):
+                output = result, base64.b64decode(response['data']), response['filename']
+        if output is None:
+            raise ValueError("The server did not return any image.")
+        return output
+
+    def stats(self) -> Dict[str, Any]:
+        """ Get the current queue depth and throughput of the server. """
+        response = next(self.request({'op': 'stats'}))
+        return response['stats']
+
+    def _handle(self, response: Dict[str, Any]) -> Iterator[TaskResult]:
+        if 'result' in response:
+            yield result_from_dict(response['result'])
+        elif 'done' in response:
+            self.summary = response['summary']
+        elif 'path' in response:
+            self.errors.append(response['path'])
+        elif 'error' in response:
+            raise ValueError(response['error'])
+
+    def close(self) -> None:
+        self._file.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
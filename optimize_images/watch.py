@@ -1,6 +1,12 @@
+import heapq
 import os
+import queue
+import threading
 import time
-from typing import List
+from collections import OrderedDict
+from concurrent.futures import Executor, Future
+from functools import partial
+from typing import Callable, Dict, List, Optional, Tuple
 
 try:
     from watchdog.events import FileSystemEventHandler
@@ -9,9 +15,13 @@ except ImportError:
     print("Watchdog is not available.")
     exit(1)
 
-from optimize_images.data_structures import OutputConfiguration, Task, TaskResult
+from optimize_images.constants import MAX_TASKS_IN_FLIGHT_PER_WORKER
+from optimize_images.constants import WATCH_DEBOUNCE_SECONDS, WATCH_RECENT_PATHS_MAX
+from optimize_images.data_structures import BatchResult, OutputConfiguration, Task, TaskResult
 from optimize_images.do_optimization import do_optimization
-from optimize_images.reporting import show_file_status, show_final_report
+from optimize_images.file_utils import DirectorySyncer
+from optimize_images.reporting import JsonLinesReport, show_file_status, show_final_report
+from optimize_images.reporting import show_img_exception
 from optimize_images.platforms import adjust_for_platform, IconGenerator
 
 
@@ -23,11 +33,140 @@ def is_image(filepath):
         return extension.lower() in ['jpg', 'jpeg', 'png']
 
 
+class RecentPaths:
+    """ A bounded set of file paths. When full, the least recently added path
+        is discarded.
+    """
+
+    def __init__(self, max_size: int = WATCH_RECENT_PATHS_MAX):
+        self.max_size = max_size
+        self._paths: 'OrderedDict[str, None]' = OrderedDict()
+
+    def __contains__(self, path: str) -> bool:
+        return path in self._paths
+
+    def __len__(self) -> int:
+        return len(self._paths)
+
+    def add(self, path: str) -> None:
+        self._paths[path] = None
+        self._paths.move_to_end(path)
+        if len(self._paths) > self.max_size:
+            self._paths.popitem(last=False)
+
+
+class WriteReadinessTracker:
+    """ Decide when a new file has been completely written.
+
+    A file is ready as soon as it is closed after writing (where the platform
+    reports it) or moved into the folder. Otherwise, it is ready when no
+    events were received for it during the debounce period and its size
+    and modification time are no longer changing. Repeated events for a path
+    that is already pending are coalesced.
+
+    All the pending paths are handled by a single background thread, which
+    calls on_ready(path) for each of them.
+    """
+
+    def __init__(self, on_ready: Callable[[str], None], debounce: float = WATCH_DEBOUNCE_SECONDS):
+        self.on_ready = on_ready
+        self.debounce = debounce
+        self._pending: Dict[str, Tuple[float, Tuple[int, int]]] = {}
+        self._deadlines: List[Tuple[float, str]] = []
+        self._ready: List[str] = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def is_pending(self, path: str) -> bool:
+        with self._cond:
+            return path in self._pending
+
+    def touch(self, path: str) -> None:
+        """ The file was created or written to: (re)start its debounce timer. """
+        with self._cond:
+            deadline = time.monotonic() + self.debounce
+            self._pending[path] = (deadline, self._file_state(path))
+            heapq.heappush(self._deadlines, (deadline, path))
+            self._cond.notify()
+
+    def finished(self, path: str) -> None:
+        """ The file was closed after writing or moved into the folder. """
+        with self._cond:
+            self._pending.pop(path, None)
+            self._ready.append(path)
+            self._cond.notify()
+
+    def discard(self, path: str) -> None:
+        with self._cond:
+            self._pending.pop(path, None)
+
+    def stop(self) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify()
+        self._thread.join()
+
+    @staticmethod
+    def _file_state(path: str) -> Tuple[int, int]:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return -1, -1
+        return stat.st_size, stat.st_mtime_ns
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not (self._stopped or self._ready or self._deadlines):
+                    self._cond.wait()
+                if self._stopped:
+                    return
+
+                now = time.monotonic()
+                while self._deadlines and self._deadlines[0][0] <= now:
+                    deadline, path = heapq.heappop(self._deadlines)
+                    if path not in self._pending or self._pending[path][0] != deadline:
+                        continue  # Superseded by a more recent event
+
+                    state = self._file_state(path)
+                    if state != self._pending[path][1]:
+                        # Still being written (without reporting any events)
+                        new_deadline = now + self.debounce
+                        self._pending[path] = (new_deadline, state)
+                        heapq.heappush(self._deadlines, (new_deadline, path))
+                    else:
+                        del self._pending[path]
+                        self._ready.append(path)
+
+                ready, self._ready = self._ready, []
+                if not ready and self._deadlines:
+                    self._cond.wait(self._deadlines[0][0] - now)
+
+            for path in ready:
+                self.on_ready(path)
+
+
 class OptimizeImageEventHandler(FileSystemEventHandler):
-    def __init__(self, task: Task):
+    """ Submit each new image file to the executor as soon as it is completely
+        written.
+
+    Up to max_in_flight images may be waiting or being processed at a given
+    time. When that limit is reached, new files wait in a queue (handled by a
+    background thread) until one of them is finished, so that the readiness
+    of other files is still tracked meanwhile. The counters are updated as
+    each image is finished, and the folders where images were replaced are
+    synced periodically (sync_dirs).
+    """
+
+    def __init__(self, task: Task, executor: Executor, max_in_flight: int,
+                 json_report: Optional[JsonLinesReport] = None):
         super().__init__()
         self.task = task
-        self.paths_to_ignore: List[str] = []
+        self.executor = executor
+        self.json_report = json_report
+        self.paths_to_ignore = RecentPaths()
         self.new_files = 0
         self.optimized_files = 0
         self.total_bytes_saved = 0
@@ -35,63 +174,141 @@ class OptimizeImageEventHandler(FileSystemEventHandler):
 
         self.line_width, pool_ex, default_workers = adjust_for_platform()
         self.icons = IconGenerator()
+        self.readiness = WriteReadinessTracker(self.submit)
+        self.syncer = DirectorySyncer()
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._lock = threading.Lock()
+        self._queue: 'queue.Queue[Optional[str]]' = queue.Queue()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
+
+    def is_new_image(self, path: str) -> bool:
+        with self._lock:
+            if '~temp~' in path or path in self.paths_to_ignore:
+                return False
+        return is_image(path)
 
     def on_created(self, event):
-        if (event.is_directory
-                or not is_image(event.src_path)
-                or '~temp~' in event.src_path
-                or event.src_path in self.paths_to_ignore):
+        if not event.is_directory and self.is_new_image(event.src_path):
+            self.readiness.touch(event.src_path)
+
+    def on_modified(self, event):
+        # Only new files are processed, not changes to existing ones
+        if not event.is_directory and self.readiness.is_pending(event.src_path):
+            self.readiness.touch(event.src_path)
+
+    def on_closed(self, event):
+        if not event.is_directory and self.readiness.is_pending(event.src_path):
+            self.readiness.finished(event.src_path)
+
+    def on_moved(self, event):
+        if event.is_directory:
             return
+        self.readiness.discard(event.src_path)
+        if self.is_new_image(event.dest_path):
+            self.readiness.finished(event.dest_path)
 
-        self.paths_to_ignore.append(event.src_path)
-        self.wait_for_write_finish(event.src_path)
-        self.new_files += 1
+    def submit(self, src_path: str):
+        """ Queue an image file that is completely written, to be submitted
+            to the executor as soon as there is room for it.
+        """
+        with self._lock:
+            if src_path in self.paths_to_ignore or not is_image(src_path):
+                return
+            self.paths_to_ignore.add(src_path)
+        self._queue.put(src_path)
 
-        task = self.task
-        img_task = Task(event.src_path, task.quality, task.remove_transparency,
-                        task.reduce_colors, task.max_colors, task.max_w,
-                        task.max_h, task.keep_exif, task.convert_all,
-                        task.conv_big, task.force_del, task.bg_color,
-                        task.grayscale, task.no_size_comparison, task.fast_mode,
-                        task.output_config)
+    def _dispatch(self):
+        while True:
+            src_path = self._queue.get()
+            if src_path is None:
+                return
+            img_task = self.task._replace(src_path=src_path)
+            self._slots.acquire()
+            future = self.executor.submit(do_optimization, img_task)
+            future.add_done_callback(partial(self.on_finished, src_path))
 
-        result: TaskResult = do_optimization(img_task)
-        self.total_src_size += result.orig_size
-        if result.was_optimized:
-            self.optimized_files += 1
-            self.total_bytes_saved += result.orig_size - result.final_size
+    def stop(self):
+        """ Stop tracking new files, after submitting the ones already queued. """
+        self.readiness.stop()
+        self._queue.put(None)
+        self._dispatcher.join()
 
-        show_file_status(result, self.line_width, self.icons)
+    def on_finished(self, src_path: str, future: Future):
+        self._slots.release()
+        try:
+            result: TaskResult = future.result()
+        except Exception as ex:
+            show_img_exception(ex, src_path)
+            return
 
-    @staticmethod
-    def wait_for_write_finish(filename: str) -> None:
-        """ Wait until file has been completely written (when file size stabilizes)
+        with self._lock:
+            # Ignore the events caused by saving the optimized file
+            self.paths_to_ignore.add(src_path)
+            self.new_files += 1
+            self.total_src_size += result.orig_size
+            if result.was_optimized:
+                self.optimized_files += 1
+                self.total_bytes_saved += result.orig_size - result.final_size
+
+                self.syncer.add(src_path)
+
+            if self.json_report is not None:
+                self.json_report.add(result)
+            if not self.task.output_config.quiet_mode:
+                show_file_status(result, self.line_width, self.icons)
+
+    def sync_dirs(self):
+        """ Sync each folder where images were replaced since the last call
+            only once, however many images were replaced in it.
         """
-        size = -1
-        while size != os.stat(filename).st_size:
-            size = os.stat(filename).st_size
-            time.sleep(0.01)
+        with self._lock:
+            syncer, self.syncer = self.syncer, DirectorySyncer()
+        syncer.sync()
 
 
-def watch_for_new_files(task: Task):
+def watch_for_new_files(task: Task, workers: int,
+                        json_report: Optional[JsonLinesReport] = None):
+    start = time.monotonic()
+    quiet = task.output_config.quiet_mode
     folder = os.path.abspath(task.src_path)
-    print(f"\nPreparing to watch directory (press CTRL+C to quit):\n {folder}\n")
+    if not quiet:
+        print(f"\nPreparing to watch directory (press CTRL+C to quit):\n {folder}\n")
 
-    event_handler = OptimizeImageEventHandler(task)
-    observer = Observer()
-    observer.schedule(event_handler, folder, recursive=True)
-    observer.start()
+    _, pool_executor, _ = adjust_for_platform()
+    with pool_executor(max_workers=workers) as executor:
+        max_in_flight = workers * MAX_TASKS_IN_FLIGHT_PER_WORKER
+        event_handler = OptimizeImageEventHandler(task, executor, max_in_flight, json_report)
+        observer = Observer()
+        observer.schedule(event_handler, folder, recursive=True)
+        observer.start()
 
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        print("\b \n\n  == Operation was interrupted by the user. ==\n")
-        observer.stop()
+        try:
+            while True:
+                time.sleep(1)
+                event_handler.sync_dirs()
+        except KeyboardInterrupt:
+            if not quiet:
+                print("\b \n\n  == Operation was interrupted by the user. ==\n")
+            observer.stop()
+
+        observer.join()
+        event_handler.stop()
+
+    # After the executor has finished the images that were still in flight
+    event_handler.sync_dirs()
 
-    observer.join()
+    if json_report is not None:
+        json_report.finish(BatchResult(found_files=event_handler.new_files,
+                                       optimized_files=event_handler.optimized_files,
+                                       skipped_files=event_handler.new_files - event_handler.optimized_files,
+                                       total_src_size=event_handler.total_src_size,
+                                       total_bytes_saved=event_handler.total_bytes_saved,
+                                       elapsed_seconds=time.monotonic() - start))
 
-    if event_handler.new_files > 0:
+    if quiet:
+        return
+    elif event_handler.new_files > 0:
         show_final_report(event_handler.new_files,
                           event_handler.optimized_files,
                           event_handler.total_src_size,
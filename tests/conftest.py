@@ -0,0 +1,33 @@
+#!/usr/bin/env python3
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+TEST_IMAGES = os.path.join(os.path.dirname(__file__), 'test-images')
+
+
+@pytest.fixture(autouse=True)
+def cache_home(tmp_path_factory, monkeypatch):
+    """ Keep the result cache of each test (including the command line runs)
+        away from the user's cache folder.
+    """
+    path = tmp_path_factory.mktemp('cache')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(path))
+    return path
+
+
+@pytest.fixture
+def jpeg_data() -> bytes:
+    """ The contents of an 800x600 JPEG image, saved at the highest quality. """
+    buffer = BytesIO()
+    Image.linear_gradient("L").resize((800, 600)).convert("RGB").save(buffer, "JPEG", quality=100)
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def png_data() -> bytes:
+    """ The contents of a PNG test image with transparency. """
+    with open(os.path.join(TEST_IMAGES, 'png_with_transparency.png'), 'rb') as f:
+        return f.read()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+import os
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from optimize_images import api
+from optimize_images.api import Optimizer, optimize_as_batch, optimize_bytes, optimize_file_obj
+from optimize_images.data_structures import BatchOptions
+
+
+def test_optimize_bytes_jpeg(tmp_path, monkeypatch, jpeg_data):
+    images_dir, work_dir = tmp_path / 'images', tmp_path / 'cwd'
+    images_dir.mkdir()
+    work_dir.mkdir()
+    monkeypatch.chdir(work_dir)
+    name = str(images_dir / 'photo.jpg')
+
+    out_data, result = optimize_bytes(jpeg_data, BatchOptions('', max_w=400), name=name)
+
+    assert result.img == name
+    assert result.was_optimized and result.was_downsized
+    assert result.orig_size == len(jpeg_data)
+    assert result.final_size == len(out_data) < len(jpeg_data)
+    with Image.open(BytesIO(out_data)) as img:
+        assert (img.format, img.size) == ('JPEG', (400, 300))
+    # Nothing is written next to the named input, or in the current directory
+    assert os.listdir(images_dir) == os.listdir(work_dir) == []
+
+
+def test_optimize_bytes_png_to_jpeg(tmp_path, monkeypatch, png_data):
+    monkeypatch.chdir(tmp_path)
+    out_data, result = optimize_bytes(png_data, BatchOptions('', convert_all=True, force_del=True),
+                                      name=str(tmp_path / 'image.png'))
+
+    assert result.result_format == 'JPEG'
+    with Image.open(BytesIO(out_data)) as img:
+        assert (img.format, img.size) == ('JPEG', (1138, 1165))
+    assert os.listdir(tmp_path) == []
+
+
+def test_optimize_bytes_keeps_original_data(png_data):
+    optimized_data, _ = optimize_bytes(png_data)
+
+    out_data, result = optimize_bytes(optimized_data)
+    assert not result.was_optimized
+    assert out_data is optimized_data
+
+
+def test_optimize_bytes_unsupported_data():
+    out_data, result = optimize_bytes(b'not an image', name='file.txt')
+    assert out_data == b'not an image'
+    assert not result.was_optimized and result.orig_format == ''
+
+
+def test_optimize_file_obj(jpeg_data):
+    dest = BytesIO()
+    result = optimize_file_obj(BytesIO(jpeg_data), dest)
+    assert result.final_size == len(dest.getvalue()) < len(jpeg_data)
+
+
+@pytest.fixture
+def images(tmp_path, jpeg_data, png_data):
+    """ A folder with an image that can be optimized and one that can't. """
+    (tmp_path / 'photo.jpg').write_bytes(jpeg_data)
+    (tmp_path / 'optimized.png').write_bytes(optimize_bytes(png_data)[0])
+    return tmp_path
+
+
+def test_optimize_as_batch(images):
+    result = optimize_as_batch(str(images), jobs=1, use_cache=False)
+
+    assert (result.found_files, result.optimized_files, result.skipped_files) == (2, 1, 1)
+    assert sorted(os.path.basename(r.img) for r in result.results) == ['optimized.png', 'photo.jpg']
+    assert result.total_bytes_saved > 0
+
+
+def test_optimizer_reuses_its_pool(images):
+    with Optimizer(jobs=1) as optimizer:
+        pool = optimizer.executor
+        first = optimizer.optimize(BatchOptions(str(images), use_cache=False))
+        second = optimizer.optimize(BatchOptions(str(images), use_cache=False))
+        assert optimizer.executor is pool
+
+    assert first.found_files == second.found_files == 2
+    with pytest.raises(RuntimeError):
+        pool.submit(os.getpid)
+
+
+def test_optimize_as_batch_options(monkeypatch):
+    class FakeOptimizer:
+        def __init__(self, jobs):
+            pass
+
+        def optimize(self, options):
+            self.options = options
+            return options
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    monkeypatch.setattr(api, 'Optimizer', FakeOptimizer)
+    kwargs = dict(recursive=False, quality=55, remove_transparency=True, reduce_colors=True,
+                  max_colors=64, max_w=10, max_h=20, keep_exif=True, convert_all=True,
+                  conv_big=True, force_del=True, bg_color=(1, 2, 3), grayscale=True,
+                  ignore_size_comparison=True, fast_mode=True, jobs=3, use_cache=False,
+                  keep_timestamps=True, max_memory=1000, huge_images='isolate',
+                  png_budget=1.5, output_format='webp', quality_search='parallel')
+    options = optimize_as_batch('images', **kwargs)
+
+    assert options.src_path == 'images'
+    for name, value in kwargs.items():
+        assert getattr(options, name) == value, name
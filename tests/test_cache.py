@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+import os
+
+import pytest
+from PIL import Image
+
+from optimize_images import cache as cache_module
+from optimize_images.cache import ResultCache
+from optimize_images.data_structures import BatchOptions
+from optimize_images.do_optimization import do_optimization
+
+
+@pytest.fixture
+def cache(tmp_path):
+    with ResultCache(str(tmp_path / 'cache.sqlite3')) as result_cache:
+        yield result_cache
+
+
+@pytest.fixture
+def img_path(tmp_path):
+    path = tmp_path / 'image.png'
+    Image.effect_noise((64, 64), 50).save(path)
+    return str(path)
+
+
+def process(cache, task):
+    """ Process an image as the scheduler does, when using the cache. """
+    result = do_optimization(task._replace(record_source=True))
+    cache.store(task, result)
+    return result
+
+
+def test_hit(cache, img_path, monkeypatch):
+    task = BatchOptions('').task_for(img_path)
+    result = do_optimization(task._replace(record_source=True))
+
+    # The file was already read by the worker, to record its state
+    monkeypatch.setattr(cache_module, 'file_digest', None)
+    cache.store(task, result)
+    cached_result = cache.lookup(task)
+    assert cached_result is not None
+    assert cached_result.orig_format == result.orig_format == 'PNG'
+    assert not cached_result.was_optimized
+    assert cached_result.cached and not result.cached
+    assert result.encodes > 0 and cached_result.encodes == 0
+    assert cached_result.orig_size == cached_result.final_size == os.path.getsize(img_path)
+
+
+def test_hit_after_touch(cache, img_path):
+    task = BatchOptions('').task_for(img_path)
+    process(cache, task)
+
+    stat = os.stat(img_path)
+    os.utime(img_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert cache.lookup(task) is not None
+
+
+def test_miss_after_content_change(cache, img_path):
+    task = BatchOptions('').task_for(img_path)
+    process(cache, task)
+
+    # Same size, but different contents (and a new modification time)
+    stat = os.stat(img_path)
+    with open(img_path, 'r+b') as file:
+        file.seek(-8, os.SEEK_END)
+        file.write(b'\0' * 8)
+    assert os.path.getsize(img_path) == stat.st_size
+    os.utime(img_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    assert cache.lookup(task) is None
+
+
+def test_miss_after_options_change(cache, img_path):
+    process(cache, BatchOptions('').task_for(img_path))
+
+    assert cache.lookup(BatchOptions('', grayscale=True).task_for(img_path)) is None
+    # Options that don't change the resulting image
+    assert cache.lookup(BatchOptions('', keep_timestamps=True).task_for(img_path)) is not None
+
+
+def test_corrupt_row(cache, img_path):
+    task = BatchOptions('').task_for(img_path)
+    process(cache, task)
+
+    for result in ('{not json', '[]', '{"img": "image.png"}'):
+        cache.conn.execute('UPDATE results SET result = ?', (result,))
+        assert cache.lookup(task) is None
+
+    # It is replaced when the image is processed again
+    process(cache, task)
+    assert cache.lookup(task) is not None
+
+
+def test_default_location(cache_home):
+    with ResultCache() as result_cache:
+        assert result_cache.db_path.startswith(str(cache_home))
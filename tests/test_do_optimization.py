@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+import builtins
+import os
+import shutil
+
+import pytest
+from PIL import Image, ImageFile
+
+from optimize_images import img_info
+from optimize_images.data_structures import BatchOptions
+from optimize_images.do_optimization import do_optimization
+
+TEST_IMAGES = os.path.join(os.path.dirname(__file__), 'test-images')
+
+
+@pytest.fixture
+def counters(monkeypatch):
+    """ Count the times the source file is opened for reading, and the times
+        the source image (not the encoded results) is decoded.
+    """
+    counts = {'reads': [], 'decodes': 0}
+    source_images = []
+
+    orig_open = builtins.open
+
+    def counting_open(file, mode='r', *args, **kwargs):
+        if 'r' in mode and os.path.basename(str(file)).startswith('source'):
+            counts['reads'].append(str(file))
+        return orig_open(file, mode, *args, **kwargs)
+
+    orig_open_unchecked = img_info._open_unchecked
+
+    def recording_open_unchecked(file):
+        img = orig_open_unchecked(file)
+        source_images.append(img)
+        return img
+
+    orig_load = ImageFile.ImageFile.load
+
+    def counting_load(self):
+        if self.tile and any(self is img for img in source_images):
+            counts['decodes'] += 1
+        return orig_load(self)
+
+    monkeypatch.setattr(builtins, 'open', counting_open)
+    monkeypatch.setattr(img_info, '_open_unchecked', recording_open_unchecked)
+    monkeypatch.setattr(ImageFile.ImageFile, 'load', counting_load)
+    return counts
+
+
+@pytest.mark.parametrize('max_w', [0, 400])
+def test_jpeg_read_and_decoded_once(tmp_path, counters, max_w):
+    src_path = tmp_path / 'source.jpg'
+    img = Image.effect_noise((800, 600), 40).convert('RGB')
+    img.save(src_path, quality=95)
+
+    result = do_optimization(BatchOptions('', max_w=max_w, use_cache=False).task_for(str(src_path)))
+
+    assert result.was_optimized
+    assert counters['reads'] == [str(src_path)]
+    assert counters['decodes'] == 1
+
+
+@pytest.mark.parametrize('png_budget', [0, 10])
+def test_png_read_and_decoded_once(tmp_path, counters, png_budget):
+    src_path = tmp_path / 'source.png'
+    shutil.copy(os.path.join(TEST_IMAGES, 'png_with_transparency.png'), src_path)
+
+    options = BatchOptions('', png_budget=png_budget, use_cache=False)
+    result = do_optimization(options.task_for(str(src_path)))
+
+    assert result.orig_format == 'PNG' and not result.error
+    assert counters['reads'] == [str(src_path)]
+    assert counters['decodes'] == 1
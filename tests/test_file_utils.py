@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import os
+import threading
+
+import pytest
+
+from optimize_images import file_utils
+from optimize_images.file_utils import ImageCounter, replace_file, search_images
+
+
+def test_replace_file_keeps_attributes(tmp_path):
+    target = tmp_path / "img.jpg"
+    target.write_bytes(b"original")
+    os.chmod(target, 0o640)
+    os.utime(target, (1_500_000_000, 1_500_000_000))
+
+    replace_file(str(target), memoryview(b"optimized"), keep_timestamps=True)
+
+    assert target.read_bytes() == b"optimized"
+    assert target.stat().st_mode & 0o777 == 0o640
+    assert target.stat().st_mtime == 1_500_000_000
+    assert os.listdir(tmp_path) == ["img.jpg"]
+
+
+def test_replace_file_new_file_like_source(tmp_path):
+    src = tmp_path / "img.png"
+    src.write_bytes(b"png")
+    os.chmod(src, 0o600)
+
+    replace_file(str(tmp_path / "img.jpg"), b"jpeg", like_path=str(src))
+
+    assert (tmp_path / "img.jpg").stat().st_mode & 0o777 == 0o600
+
+
+@pytest.mark.skipif(not hasattr(os, 'symlink') or os.name == 'nt', reason="needs symlinks")
+def test_replace_file_follows_symlinks(tmp_path):
+    target = tmp_path / "img.jpg"
+    target.write_bytes(b"original")
+    link = tmp_path / "link.jpg"
+    link.symlink_to("img.jpg")
+
+    replace_file(str(link), b"optimized")
+
+    assert link.is_symlink()
+    assert target.read_bytes() == b"optimized"
+
+
+def test_replace_file_failure_keeps_original(tmp_path):
+    target = tmp_path / "img.jpg"
+    target.write_bytes(b"original")
+
+    with pytest.raises(TypeError):
+        replace_file(str(target), "not bytes")
+
+    assert target.read_bytes() == b"original"
+    assert os.listdir(tmp_path) == ["img.jpg"]
+
+
+def test_search_images(tmp_path):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.png").write_bytes(b"\x89PNG\r\n\x1a\n...")
+    (tmp_path / "sub" / "b.JPG").write_bytes(b"\xff\xd8\xff\xe0...")
+    (tmp_path / "sub" / "photo").write_bytes(b"\xff\xd8\xff\xe1...")  # No extension
+    (tmp_path / "not_an_image.jpg").write_bytes(b"text")
+    (tmp_path / ".a.png.x1y2.~temp~").write_bytes(b"\x89PNG\r\n\x1a\n...")
+
+    def found(**kwargs):
+        return sorted(os.path.relpath(path, tmp_path)
+                      for path in search_images(str(tmp_path), **kwargs))
+
+    assert found(recursive=True) == ["a.png", "not_an_image.jpg", os.path.join("sub", "b.JPG")]
+    assert found(recursive=False) == ["a.png", "not_an_image.jpg"]
+    assert found(recursive=True, by_content=True) == [
+        "a.png", os.path.join("sub", "b.JPG"), os.path.join("sub", "photo")]
+
+
+@pytest.mark.parametrize("recursive, by_content, expected", [
+    (True, False, 4), (False, False, 2), (True, True, 5)])
+def test_image_counter(tmp_path, recursive, by_content, expected):
+    (tmp_path / "sub").mkdir()
+    (tmp_path / "a.png").write_bytes(b"\x89PNG\r\n\x1a\n...")
+    (tmp_path / "b.jpg").write_bytes(b"\xff\xd8\xff\xe0...")
+    (tmp_path / "sub" / "c.jpg").write_bytes(b"\xff\xd8\xff\xe0...")
+    (tmp_path / "sub" / "photo").write_bytes(b"\xff\xd8\xff\xe1...")  # No extension
+    (tmp_path / "sub" / "drawing").write_bytes(b"\x89PNG\r\n\x1a\n...")
+    (tmp_path / "sub" / "not_an_image.png").write_bytes(b"text")
+
+    counter = ImageCounter(str(tmp_path), recursive, by_content)
+    counter.start()
+    counter.join(5)
+    assert counter.finished
+    assert counter.count == expected
+
+
+def test_image_counter_in_progress(tmp_path, monkeypatch):
+    resume = threading.Event()
+    found_two = threading.Event()
+
+    def slow_search(dirpath, recursive, by_content):
+        yield "a.png"
+        yield "b.png"
+        found_two.set()
+        resume.wait(5)
+        yield "c.png"
+
+    monkeypatch.setattr(file_utils, "search_images", slow_search)
+    counter = ImageCounter(str(tmp_path), recursive=True)
+    counter.start()
+
+    assert found_two.wait(5)
+    assert (counter.count, counter.finished) == (2, False)
+    resume.set()
+    counter.join(5)
+    assert (counter.count, counter.finished) == (3, True)
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+from timeit import default_timer as timer
+
+import pytest
+from PIL import Image
+
+from optimize_images.img_aux_processing import Palette, do_reduce_colors, rebuild_palette
+from optimize_images.img_aux_processing import reduce_mode_losslessly
+
+
+def legacy_reduce_palette_colors(img, max_colors):
+    """ The original do_reduce_colors() code path for mode P images. """
+    orig_colors = len(img.getcolors())
+    palette = img.getpalette()
+    img = img.convert("RGBA")
+    width, height = img.size
+    alpha_layer = Image.new("L", img.size)
+    for x in range(width):
+        for y in range(height):
+            _, _, _, alpha = img.getpixel((x, y))
+            alpha_layer.putpixel((x, y), alpha)
+    img.putalpha(alpha_layer)
+    img = img.convert("P", palette=palette, colors=max_colors)
+    return img, orig_colors, len(img.getcolors())
+
+
+def legacy_rebuild_palette(img):
+    """ The original rebuild_palette() code, visiting every pixel. """
+    width, height = img.size
+    img = img.convert("RGBA")
+    palette = []
+    alpha_layer = Image.new("L", img.size)
+    for x in range(width):
+        for y in range(height):
+            red, green, blue, alpha = img.getpixel((x, y))
+            alpha_layer.putpixel((x, y), alpha)
+            if (red, green, blue) not in palette:
+                palette.append((red, green, blue))
+    img.putalpha(alpha_layer)
+    flat_palette = []
+    for rgb in palette:
+        flat_palette = flat_palette + list(rgb)
+    img = img.convert("P", palette=flat_palette, colors=len(palette))
+    return img, len(img.getcolors()), flat_palette
+
+
+def make_indexed_image(width, height, transparency):
+    img = Image.effect_noise((width, height), 64).convert("RGB").quantize(200)
+    if transparency == "index":
+        img.info["transparency"] = 0
+    elif transparency == "bytes":
+        img.info["transparency"] = bytes(range(0, 256, 2)) * 2
+    return img
+
+
+@pytest.mark.parametrize("transparency", [None, "index", "bytes"])
+def test_reduce_colors_palette_image_is_unchanged(transparency):
+    img = make_indexed_image(160, 120, transparency)
+
+    expected, exp_orig_colors, exp_final_colors = legacy_reduce_palette_colors(img.copy(), 16)
+    result, orig_colors, final_colors = do_reduce_colors(img.copy(), 16)
+
+    assert (orig_colors, final_colors) == (exp_orig_colors, exp_final_colors)
+    assert result.mode == expected.mode == "P"
+    assert result.tobytes() == expected.tobytes()
+    assert result.getpalette() == expected.getpalette()
+    assert result.info.get("transparency") == expected.info.get("transparency")
+
+
+@pytest.mark.parametrize("transparency", [None, "index", "bytes"])
+def test_rebuild_palette_is_unchanged(transparency):
+    # Only every third palette entry is used, in a shuffled order
+    src = make_indexed_image(90, 70, transparency)
+    img = Image.frombytes("P", src.size, bytes((index * 3 + 50) % 256 for index in src.tobytes()))
+    img.putpalette([value for i in range(256) for value in (i, 255 - i, i * 7 % 256)])
+    img.info = src.info
+    assert len(img.getcolors()) < len(img.getpalette()) // 3
+
+    expected, exp_colors, exp_palette = legacy_rebuild_palette(img.copy())
+    result, colors = rebuild_palette(img.copy())
+
+    assert Palette.from_image(img).get_palette() == exp_palette
+    assert colors == exp_colors
+    assert result.tobytes() == expected.tobytes()
+    assert result.getpalette() == expected.getpalette()
+
+
+def test_reduce_colors_big_palette_image_timing():
+    small = make_indexed_image(300, 200, "bytes")
+    start = timer()
+    legacy_reduce_palette_colors(small.copy(), 64)
+    legacy_time = timer() - start
+
+    # 50 times the pixels of the image used for the per-pixel code path
+    big = make_indexed_image(3000, 1000, "bytes")
+    start = timer()
+    result, _, final_colors = do_reduce_colors(big, 64)
+    elapsed = timer() - start
+
+    assert result.mode == "P" and final_colors <= 64
+    assert elapsed < legacy_time
+
+
+@pytest.mark.parametrize("mode, content, expected_mode", [
+    ("RGBA", "noise", "RGB"),
+    ("RGBA", "gray noise", "L"),
+    ("RGB", "gray noise", "L"),
+    ("RGB", "few colors", "P"),
+    ("RGBA", "few colors", "P"),
+    ("RGBA", "gray noise with alpha", "LA"),
+    ("RGBA", "noise with alpha", "RGBA"),
+])
+def test_reduce_mode_losslessly(mode, content, expected_mode):
+    noise = Image.effect_noise((320, 240), 64)
+    color_noise = Image.merge("RGB", (noise, noise.transpose(Image.Transpose.FLIP_LEFT_RIGHT),
+                                      noise.transpose(Image.Transpose.FLIP_TOP_BOTTOM)))
+    if content == "few colors":
+        img = color_noise.quantize(100).convert(mode)
+        if mode == "RGBA":
+            img.putalpha(img.getchannel("R").point(lambda value: 255 if value > 128 else 0))
+    elif content.startswith("gray noise"):
+        img = noise.convert(mode)
+    else:
+        img = color_noise.convert(mode)
+    if content.endswith("with alpha"):
+        img.putalpha(noise.transpose(Image.Transpose.ROTATE_180))
+
+    result, colors = reduce_mode_losslessly(img)
+
+    assert result.mode == expected_mode
+    assert (colors > 0) == (expected_mode == "P")
+    assert result.convert(mode).tobytes() == img.tobytes()
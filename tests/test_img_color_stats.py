@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import random
+
+import pytest
+from PIL import Image
+
+from optimize_images.constants import MIN_BIG_IMG_COLORS
+from optimize_images.img_color_stats import analyze_mode_usage, count_colors
+from optimize_images.img_color_stats import has_more_colors_than
+from optimize_images.img_info import is_big_png_photo
+
+
+def make_image(num_colors, size=(320, 240), mode="RGB"):
+    """ An image with exactly num_colors colors, in a random order. """
+    width, height = size
+    values = [i % num_colors for i in range(width * height)]
+    random.Random(0).shuffle(values)
+    data = bytes(byte for value in values for byte in (value & 255, value >> 8 & 255, 80))
+    img = Image.frombytes("RGB", size, data)
+    return img if mode == "RGB" else img.convert(mode)
+
+
+@pytest.mark.parametrize("num_colors, expected", [(256, 256), (257, None)])
+def test_count_colors(num_colors, expected):
+    img = make_image(num_colors)
+    assert count_colors(img) == expected
+    assert has_more_colors_than(img, 256) == (expected is None)
+    assert count_colors(img, 1000) == num_colors
+
+
+@pytest.mark.parametrize("num_colors", [200, 5000])
+def test_gray_rgb_image(num_colors):
+    gray = make_image(num_colors).getchannel("R").convert("RGB")
+    assert analyze_mode_usage(gray).gray
+    assert not analyze_mode_usage(make_image(num_colors)).gray
+
+
+@pytest.mark.parametrize("num_colors", [200, 5000])
+@pytest.mark.parametrize("alpha, opaque", [(255, True), (254, False)])
+def test_opaque_and_translucent_images(num_colors, alpha, opaque):
+    img = make_image(num_colors, mode="RGBA")
+    img.putpixel((10, 10), img.getpixel((10, 10))[:3] + (alpha,))
+
+    usage = analyze_mode_usage(img)
+    assert usage.opaque == opaque
+    assert usage.colors == (count_colors(img) if num_colors <= 256 else None)
+
+
+@pytest.mark.parametrize("extra_color, expected", [(False, False), (True, True)])
+def test_is_big_png_photo_color_threshold(tmp_path, extra_color, expected):
+    img = make_image(MIN_BIG_IMG_COLORS, size=(1024, 768))
+    if extra_color:
+        img.putpixel((0, 0), (0, 0, 0))
+    src_path = str(tmp_path / "image.png")
+    img.save(src_path)
+
+    assert count_colors(img, MIN_BIG_IMG_COLORS) == (None if extra_color else MIN_BIG_IMG_COLORS)
+    assert is_big_png_photo(src_path) == expected
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+from io import BytesIO
+
+import pytest
+from PIL import Image, ImageFilter
+
+from optimize_images.data_structures import BatchOptions
+from optimize_images.do_optimization import do_optimization
+from optimize_images.img_aux_processing import downsize_img
+from optimize_images.img_dynamic_quality import QUALITY_SEARCH_STRATEGIES
+from optimize_images.img_dynamic_quality import compare_images, search_jpeg_quality
+
+
+def make_photo(width, height):
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 30).filter(ImageFilter.GaussianBlur(2))
+    fractal = Image.effect_mandelbrot((width, height), (-2.0, -1.5, 1.0, 1.5), 100)
+    return Image.merge("RGB", (gradient, noise, fractal))
+
+
+@pytest.fixture(scope="module")
+def big_photo():
+    return make_photo(4000, 3000)
+
+
+def test_analysis_thumbnail_is_close_to_full_resample(big_photo):
+    full_resample = big_photo.resize((400, 400))
+    reduced_resample = big_photo.resize((400, 400), reducing_gap=3.0)
+    assert compare_images(full_resample, reduced_resample) < 0.5
+
+
+@pytest.mark.parametrize("strategy", sorted(QUALITY_SEARCH_STRATEGIES))
+def test_quality_search_strategies_agree(big_photo, strategy):
+    expected = search_jpeg_quality(big_photo, strategy="bisection")
+    result = search_jpeg_quality(big_photo, strategy=strategy)
+    assert result.quality == expected.quality
+    assert result.encodes <= 7
+
+
+def test_downsize_with_draft_is_close_to_full_decode(big_photo):
+    jpeg_buffer = BytesIO()
+    big_photo.save(jpeg_buffer, format="JPEG", quality=90)
+
+    with Image.open(BytesIO(jpeg_buffer.getvalue())) as img:
+        img.load()
+        expected = img.resize((800, 600), resample=Image.LANCZOS)
+
+    with Image.open(BytesIO(jpeg_buffer.getvalue())) as img:
+        # Not decoded yet, so it may use JPEG draft mode
+        result, was_downsized = downsize_img(img, 800, 0)
+        assert was_downsized
+        assert result.size == expected.size
+        assert compare_images(result.convert("RGB"), expected) < 1.0
+
+
+def test_quality_search_option(tmp_path):
+    results = {}
+    for strategy in ("secant", "parallel"):
+        src_path = tmp_path / f"{strategy}.jpg"
+        make_photo(800, 600).save(src_path, quality=95)
+        options = BatchOptions(str(tmp_path), quality_search=strategy)
+        results[strategy] = do_optimization(options.task_for(str(src_path)))
+
+    assert results["secant"].quality == results["parallel"].quality
+    # Parallel search encodes every candidate value
+    assert results["parallel"].encodes > results["secant"].encodes
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import threading
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from optimize_images.data_structures import BatchOptions
+from optimize_images.do_optimization import do_optimization
+from optimize_images.img_output_formats import available_output_formats, optimize_to_format
+from optimize_images.img_output_formats import output_candidates
+from optimize_images.server import OptimizeClient, OptimizeServer
+
+TEST_IMAGES = os.path.join(os.path.dirname(__file__), 'test-images')
+
+needs_webp = pytest.mark.skipif('webp' not in available_output_formats(),
+                                reason='WebP support is not available')
+
+
+@pytest.fixture
+def png_path(tmp_path):
+    src_path = tmp_path / 'png_with_transparency.png'
+    shutil.copy(os.path.join(TEST_IMAGES, src_path.name), src_path)
+    return src_path
+
+
+def test_lossless_candidate_only_for_png():
+    if 'webp' not in available_output_formats():
+        assert output_candidates('webp', 'PNG') == []
+        return
+    assert [c.lossless for c in output_candidates('webp', 'PNG')] == [False, True]
+    assert [c.lossless for c in output_candidates('webp', 'JPEG')] == [False]
+
+
+@needs_webp
+@pytest.mark.parametrize('force_del', [False, True])
+def test_convert_to_webp(png_path, force_del):
+    options = BatchOptions('', output_format='webp', force_del=force_del)
+    result = do_optimization(options.task_for(str(png_path)))
+
+    webp_path = png_path.with_suffix('.webp')
+    assert result.was_optimized and result.result_format == 'WEBP'
+    assert webp_path.stat().st_size == result.final_size
+    assert png_path.exists() != force_del
+    with Image.open(webp_path) as img:
+        assert img.format == 'WEBP' and img.mode == 'RGBA'
+
+
+def test_auto_keeps_smallest(png_path):
+    formats = available_output_formats()
+    if not formats:
+        pytest.skip('No output formats available')
+
+    sizes = {}
+    for output_format in formats:
+        options = BatchOptions('', output_format=output_format, ignore_size_comparison=True)
+        sizes[output_format] = do_optimization(options.task_for(str(png_path))).final_size
+
+    options = BatchOptions('', output_format='auto', ignore_size_comparison=True)
+    result = do_optimization(options.task_for(str(png_path)))
+    assert result.final_size == min(sizes.values())
+    assert result.result_format.lower() == min(sizes, key=sizes.get)
+
+
+@pytest.mark.parametrize('output_format', ['webp', 'avif'])
+def test_opaque_alpha_channel_dropped(tmp_path, output_format):
+    if output_format not in available_output_formats():
+        pytest.skip(f'{output_format} support is not available')
+    src_path = tmp_path / 'opaque.png'
+    noise = Image.effect_noise((128, 128), 50)
+    opaque = Image.new('L', noise.size, 255)
+    Image.merge('RGBA', (noise, noise.rotate(90), noise.rotate(180), opaque)).save(src_path)
+
+    options = BatchOptions('', output_format=output_format, ignore_size_comparison=True)
+    result = do_optimization(options.task_for(str(src_path)))
+
+    assert not result.error and result.was_optimized
+    assert (result.orig_mode, result.result_mode) == ('RGBA', 'RGB')
+
+
+def test_unsupported_format_not_processed(png_path):
+    # e.g., AVIF with an older version of Pillow
+    task = BatchOptions('', output_format='jxl').task_for(str(png_path))
+    result = optimize_to_format(task)
+
+    assert not result.was_optimized
+    assert 'not supported' in result.error
+    assert sorted(p.name for p in png_path.parent.iterdir()) == [png_path.name]
+
+
+def make_low_quality_jpeg() -> bytes:
+    """ A noisy JPEG image, saved at a quality much lower than the one
+        selected for the output formats (so that they can't be smaller).
+    """
+    noise = Image.effect_noise((256, 256), 100)
+    buffer = BytesIO()
+    Image.merge('RGB', (noise, noise.rotate(90), noise.rotate(180))).save(buffer, 'JPEG', quality=5)
+    return buffer.getvalue()
+
+
+@needs_webp
+def test_original_kept_if_not_smaller(tmp_path):
+    src_path = tmp_path / 'photo.jpg'
+    src_path.write_bytes(make_low_quality_jpeg())
+    result = do_optimization(BatchOptions('', output_format='webp').task_for(str(src_path)))
+
+    assert not result.was_optimized
+    assert (result.result_format, result.result_mode) == ('JPEG', 'RGB')
+    assert result.final_size == src_path.stat().st_size
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['photo.jpg']
+
+    # The server sends back the original image, with its original name
+    address = f'unix:{tmp_path / "oi.sock"}'
+    server = OptimizeServer(address, BatchOptions('', use_cache=False, output_format='webp'), jobs=1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with OptimizeClient(address) as client:
+            result, out_data, filename = client.optimize_data(src_path.read_bytes(), 'photo.jpg')
+    finally:
+        server.shutdown()
+        thread.join()
+        server.close()
+
+    assert not result.was_optimized
+    assert (filename, out_data) == ('photo.jpg', src_path.read_bytes())
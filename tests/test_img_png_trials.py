@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+import os
+import shutil
+from io import BytesIO
+
+from PIL import Image, ImageDraw
+
+from optimize_images.data_structures import BatchOptions
+from optimize_images.do_optimization import do_optimization
+from optimize_images.img_png_trials import PNG_TRIALS, PngTrial, encode_png_trials
+
+TEST_IMAGES = os.path.join(os.path.dirname(__file__), 'test-images')
+
+
+def make_drawing() -> Image.Image:
+    img = Image.new('RGB', (400, 300), 'white')
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((10, 10, 200, 100), fill='red')
+    draw.text((20, 150), 'Optimize Images ' * 4, fill='black')
+    return img
+
+
+def test_smallest_result_wins():
+    img = make_drawing()
+    result = encode_png_trials(img, budget=10)
+
+    sizes = {}
+    for trial in PNG_TRIALS:
+        buffer = BytesIO()
+        img.save(buffer, format='PNG', **trial.params)
+        sizes[trial.name] = buffer.tell()
+    assert result.encodes == len(PNG_TRIALS)
+    assert result.buffer.getbuffer().nbytes == min(sizes.values())
+    with Image.open(result.buffer) as optimized:
+        assert optimized.convert('RGB').tobytes() == img.tobytes()
+
+
+def test_few_colors_saved_with_palette(tmp_path):
+    # Converted before the trials, without losing any information
+    src_path = tmp_path / 'drawing.png'
+    make_drawing().save(src_path)
+    result = do_optimization(BatchOptions('', png_budget=10).task_for(str(src_path)))
+    assert result.result_mode == 'P' and result.png_trial
+
+
+def test_budget_runs_first_trial_only():
+    trials = (PngTrial('level 1', {'compress_level': 1}), PngTrial('level 9', {'compress_level': 9}))
+    result = encode_png_trials(make_drawing(), budget=0, trials=trials)
+    assert (result.trial, result.encodes) == ('level 1', 1)
+
+
+def test_trial_expected_to_overrun_budget_not_run():
+    trials = (PngTrial('level 1', {'compress_level': 1}),
+              PngTrial('rle', {'compress_level': 9, 'compress_type': 3}, cost=0.1),
+              PngTrial('level 9', {'compress_level': 9}, cost=1e6))
+    result = encode_png_trials(make_drawing(), budget=10, trials=trials)
+    assert result.encodes == 2
+    assert result.trial != 'level 9'
+
+
+def test_winner_in_task_result(tmp_path):
+    src_path = tmp_path / 'png_with_transparency.png'
+    shutil.copy(os.path.join(TEST_IMAGES, src_path.name), src_path)
+    result = do_optimization(BatchOptions('', png_budget=10).task_for(str(src_path)))
+    assert result.png_trial
+    assert result.encodes > 1
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import tracemalloc
+
+import pytest
+
+from optimize_images import profiling
+from optimize_images.data_structures import BatchOptions
+from optimize_images.do_optimization import do_optimization
+from optimize_images.profiling import NULL_PROFILER, ProfileSummary
+
+TEST_IMAGES = os.path.join(os.path.dirname(__file__), 'test-images')
+
+
+def copy_test_image(tmp_path):
+    src_path = tmp_path / 'png_with_transparency.png'
+    shutil.copy(os.path.join(TEST_IMAGES, src_path.name), src_path)
+    return str(src_path)
+
+
+def test_profiling_is_off_by_default(tmp_path):
+    result = do_optimization(BatchOptions('').task_for(copy_test_image(tmp_path)))
+    assert result.stage_seconds is None
+    assert result.peak_memory == 0
+
+
+def test_profiled_stages(tmp_path):
+    task = BatchOptions('', reduce_colors=True, profile=True).task_for(copy_test_image(tmp_path))
+    result = do_optimization(task)
+
+    assert {'read', 'decode', 'palette', 'encode', 'write'} <= set(result.stage_seconds)
+    assert all(seconds >= 0 for seconds in result.stage_seconds.values())
+    assert result.peak_memory > 0
+
+    summary = ProfileSummary()
+    summary.add(result)
+    summary.add(result._replace(stage_seconds=None))  # e.g., a cached result
+    assert summary.files == {'PNG': 1}
+    assert summary.stages()[:2] == ['read', 'decode']
+
+
+def test_null_profiler_does_nothing():
+    with NULL_PROFILER.stage('encode'):
+        pass
+    assert NULL_PROFILER.finish('result') == 'result'
+
+
+@pytest.mark.parametrize("use_rss", [True, False])
+def test_peak_memory_of_overlapping_images(monkeypatch, use_rss):
+    if not use_rss:
+        monkeypatch.setattr(profiling, '_reset_peak_rss', lambda: False)
+
+    # e.g., two images processed at the same time in a thread pool
+    first = profiling._PeakMemory()
+    second = profiling._PeakMemory()
+    data = bytearray(32 * 1024 * 1024)
+    assert first.stop() == 0
+    if not use_rss:
+        # Stopping one of them doesn't stop tracing for the other one
+        assert tracemalloc.is_tracing()
+    assert second.stop() == 0
+
+    alone = profiling._PeakMemory()
+    data = bytearray(32 * 1024 * 1024)
+    assert alone.stop() >= len(data) // 2
+    if not use_rss:
+        tracemalloc.stop()
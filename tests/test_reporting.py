@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+import json
+import os
+import shutil
+
+from optimize_images.data_structures import BatchOptions, BatchResult
+from optimize_images.do_optimization import do_optimization
+from optimize_images.reporting import JsonLinesReport, overall_progress
+
+TEST_IMAGES = os.path.join(os.path.dirname(__file__), 'test-images')
+
+
+def test_json_lines_report(tmp_path):
+    src_path = tmp_path / 'png_with_transparency.png'
+    shutil.copy(os.path.join(TEST_IMAGES, src_path.name), src_path)
+    result = do_optimization(BatchOptions('', convert_all=True, quality=70).task_for(str(src_path)))
+
+    report_path = tmp_path / 'report.jsonl'
+    report = JsonLinesReport(str(report_path))
+    report.add(result)
+    # Each record is available as soon as it is written
+    assert len(report_path.read_text().splitlines()) == 1
+
+    batch = BatchResult()
+    batch.add(result)
+    report.finish(batch, completed=False)
+
+    records = [json.loads(line) for line in report_path.read_text().splitlines()]
+    assert records[0]['type'] == 'result'
+    assert records[0]['img'] == str(src_path)
+    assert records[0]['result_format'] == 'JPEG'
+    assert records[0]['quality'] == 70
+    assert records[0]['elapsed_seconds'] > 0
+    assert 'output_config' not in records[0]
+    assert records[1] == {'type': 'summary', 'found_files': 1, 'optimized_files': 1,
+                          'skipped_files': 0, 'total_src_size': result.orig_size,
+                          'total_bytes_saved': result.orig_size - result.final_size,
+                          'elapsed_seconds': 0.0, 'completed': False}
+
+
+def test_overall_progress():
+    assert overall_progress(3, 10, counting_finished=False) == "3 processed / 10 discovered so far"
+    assert overall_progress(3, 10, counting_finished=True) == "30.0%"
+    # Images added to the folder after they were counted
+    assert overall_progress(12, 10, counting_finished=True) == "100.0%"
+    assert overall_progress(0, 0, counting_finished=True) == "100.0%"
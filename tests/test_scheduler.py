@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+import os
+import struct
+import threading
+import time
+import zlib
+from concurrent.futures import BrokenExecutor, Executor, Future, ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from optimize_images.data_structures import BatchOptions
+from optimize_images.do_optimization import do_optimization
+from optimize_images.img_info import check_image_size, probe_image
+from optimize_images import scheduler
+from optimize_images.scheduler import optimize_chunk, run_tasks
+
+
+class RecordingExecutor(Executor):
+    """ Run each submission right away, recording the tasks submitted. """
+
+    def __init__(self):
+        self.submissions = []
+
+    def submit(self, fn, *args, **kwargs):
+        self.submissions.append([task.src_path for task in args[0]])
+        future = Future()
+        future.set_result(fn(*args, **kwargs))
+        return future
+
+
+class DeferredExecutor(RecordingExecutor):
+    """ Keep the submissions pending (like busy workers) until run_pending(),
+        and then run the following ones right away.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pending = []
+        self.deferring = True
+
+    def submit(self, fn, *args, **kwargs):
+        if not self.deferring:
+            return super().submit(fn, *args, **kwargs)
+        self.submissions.append([task.src_path for task in args[0]])
+        future = Future()
+        self.pending.append((future, fn, args))
+        return future
+
+    def run_pending(self):
+        self.deferring = False
+        for future, fn, args in self.pending:
+            future.set_result(fn(*args))
+
+
+def test_biggest_first_and_small_in_chunks(tmp_path):
+    sizes = {'a_photo.png': 900, 'b_icon1.png': 16, 'c_icon2.png': 16,
+             'd_huge.png': 1200, 'e_photo.png': 1000}
+    for name, size in sizes.items():
+        Image.new('RGB', (size, size), 'red').save(tmp_path / name)
+    options = BatchOptions(str(tmp_path), use_cache=False)
+    executor = DeferredExecutor()
+
+    def tasks():
+        for name in sorted(sizes):
+            yield options.task_for(str(tmp_path / name))
+        # The first submission was in flight while the others were found
+        assert len(executor.submissions) == 1
+        executor.run_pending()
+
+    results = list(run_tasks(executor, tasks(), max_in_flight=1))
+
+    names = [[path.rsplit('/', 1)[-1] for path in paths] for paths in executor.submissions]
+    assert names == [['a_photo.png'], ['d_huge.png'], ['e_photo.png'],
+                     ['b_icon1.png', 'c_icon2.png']]
+    assert sorted(os.path.basename(result.img) for result in results) == sorted(sizes)
+
+
+def test_first_chunk_submitted_before_window_is_full(tmp_path):
+    Image.new('RGB', (900, 900), 'red').save(tmp_path / 'photo.png')
+    options = BatchOptions(str(tmp_path), use_cache=False)
+    executor = RecordingExecutor()
+    discovered = []
+
+    def tasks():
+        for i in range(50):
+            discovered.append(i)
+            if executor.submissions:
+                break
+            yield options.task_for(str(tmp_path / 'photo.png'))
+
+    list(run_tasks(executor, tasks(), max_in_flight=8))
+    assert len(discovered) == 2
+
+
+class CrashingExecutor(RecordingExecutor):
+    """ Break (like a pool whose worker crashed) when given a crash*.png file. """
+
+    def submit(self, fn, *args, **kwargs):
+        if any('crash' in task.src_path for task in args[0]):
+            self.submissions.append([task.src_path for task in args[0]])
+            future = Future()
+            future.set_exception(BrokenExecutor())
+            return future
+        return super().submit(fn, *args, **kwargs)
+
+
+def test_ordered_results_and_worker_crash(tmp_path):
+    names = ['a.png', 'b_crash.png', 'c.png', 'd.png']
+    for i, name in enumerate(names):
+        Image.new('RGB', (16 + i * 100, 16), 'red').save(tmp_path / name)
+    options = BatchOptions(str(tmp_path), use_cache=False)
+    tasks = [options.task_for(str(tmp_path / name)) for name in names]
+
+    executors = []
+
+    def new_executor():
+        executors.append(CrashingExecutor())
+        return executors[-1]
+
+    results = list(run_tasks(new_executor(), tasks, max_in_flight=8,
+                             ordered=True, new_executor=new_executor))
+
+    assert [result.img for result in results] == [task.src_path for task in tasks]
+    assert [bool(result.error) for result in results] == [False, True, False, False]
+    # After the first crash, the tasks of the broken chunk are retried one by one
+    assert len(executors) == 3
+    retried = executors[1].submissions + executors[2].submissions
+    assert sorted(retried) == [[task.src_path] for task in tasks]
+
+
+def test_memory_budget(tmp_path):
+    for i in range(4):
+        Image.new('RGB', (500, 400), 'red').save(tmp_path / f'{i}.png')
+    options = BatchOptions(str(tmp_path), use_cache=False)
+    tasks = [options.task_for(str(tmp_path / f'{i}.png')) for i in range(4)]
+
+    running = []
+    max_running = []
+    lock = threading.Lock()
+
+    def tracked_chunk(chunk):
+        with lock:
+            running.append(chunk)
+            max_running.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(chunk)
+        return optimize_chunk(chunk)
+
+    class TrackingExecutor(ThreadPoolExecutor):
+        def submit(self, fn, *args, **kwargs):
+            return super().submit(tracked_chunk, *args, **kwargs)
+
+    # Each image needs more than 1 MB (500 x 400 x 3 bands x 3 copies)
+    with TrackingExecutor(max_workers=4) as executor:
+        results = list(run_tasks(executor, tasks, max_in_flight=4, max_memory=2_000_000))
+
+    assert len(results) == 4
+    assert max(max_running) == 1
+
+
+def test_huge_image_policy(tmp_path):
+    Image.new('RGB', (300, 200), 'red').save(tmp_path / 'huge.png')
+    for name in ('a.png', 'b.png'):
+        Image.new('RGB', (50, 50), 'red').save(tmp_path / name)
+    huge_path = str(tmp_path / 'huge.png')
+
+    # Skipped before being submitted
+    options = BatchOptions(str(tmp_path), use_cache=False, max_pixels=10_000)
+    executor = RecordingExecutor()
+    results = list(run_tasks(executor, [options.task_for(huge_path)], max_in_flight=8))
+    assert executor.submissions == []
+    assert 'megapixels' in results[0].error
+
+    # Downsized on load (also when processed without the scheduler)
+    options = BatchOptions(str(tmp_path), use_cache=False, max_pixels=10_000,
+                           huge_images='downsize')
+    result = do_optimization(options.task_for(huge_path))
+    assert result.was_downsized
+    with Image.open(huge_path) as img:
+        assert img.width * img.height <= 10_000
+
+    # Processed alone
+    Image.new('RGB', (300, 200), 'red').save(huge_path)
+    options = BatchOptions(str(tmp_path), use_cache=False, max_pixels=10_000,
+                           huge_images='isolate')
+    tasks = [options.task_for(str(tmp_path / name)) for name in ('a.png', 'huge.png', 'b.png')]
+    executor = RecordingExecutor()
+    results = list(run_tasks(executor, tasks, max_in_flight=8))
+    assert executor.submissions[0] == [huge_path]
+    assert not any(result.error for result in results)
+
+
+def write_png_header(path, width, height):
+    """ Write a PNG file with the specified dimensions, but no pixel data. """
+    def chunk(chunk_type, data):
+        return struct.pack('>I', len(data)) + chunk_type + data \
+            + struct.pack('>I', zlib.crc32(chunk_type + data))
+
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    with open(path, 'wb') as file:
+        file.write(b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', ihdr) + chunk(b'IEND', b''))
+
+
+def test_probe_doesnt_change_pillow_limit(tmp_path):
+    # More than twice Pillow's limit, which makes Image.open() raise an error
+    write_png_header(tmp_path / 'bomb.png', 30_000, 20_000)
+    max_image_pixels = Image.MAX_IMAGE_PIXELS
+    opened = []
+
+    def probe():
+        opened.append(probe_image(str(tmp_path / 'bomb.png')))
+
+    threads = [threading.Thread(target=probe) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert [header.pixels for header in opened] == [600_000_000] * 8
+    assert Image.MAX_IMAGE_PIXELS == max_image_pixels
+
+
+def test_big_images_not_skipped_by_default(tmp_path):
+    # Pillow only warns about images of this size, so they were always processed
+    write_png_header(tmp_path / 'big.png', 10_000, 10_000)
+    task = BatchOptions(str(tmp_path)).task_for(str(tmp_path / 'big.png'))
+    header = probe_image(task.src_path)
+
+    assert header.pixels == 100_000_000
+    assert check_image_size(task, header) == (task, '')
+
+
+def _install_worker_hook(log_dir):
+    """ Run in each worker process: exit right away when processing an image
+        with 'crash' in its name, and log when each other image is processed.
+    """
+    do_optimization_in_worker = scheduler.do_optimization
+
+    def hooked(task):
+        name = os.path.basename(task.src_path)
+        if 'crash' in name:
+            os._exit(1)
+        start = time.monotonic()
+        time.sleep(0.2)
+        result = do_optimization_in_worker(task)
+        with open(os.path.join(log_dir, name), 'w') as file:
+            file.write(f'{start} {time.monotonic()}')
+        return result
+
+    scheduler.do_optimization = hooked
+
+
+def run_in_process_pool(tasks, log_dir, **kwargs):
+    def new_executor():
+        executors.append(ProcessPoolExecutor(max_workers=2, initializer=_install_worker_hook,
+                                             initargs=(str(log_dir),)))
+        return executors[-1]
+
+    executors = []
+    try:
+        return list(run_tasks(new_executor(), tasks, max_in_flight=8,
+                              new_executor=new_executor, **kwargs)), len(executors)
+    finally:
+        for executor in executors:
+            executor.shutdown()
+
+
+def test_worker_crash_in_process_pool(tmp_path):
+    images_dir, log_dir = tmp_path / 'images', tmp_path / 'log'
+    images_dir.mkdir()
+    log_dir.mkdir()
+    names = ['a.png', 'b_crash.png', 'c.png', 'd.png', 'e.png']
+    for name in names:
+        Image.new('RGB', (64, 64), 'red').save(images_dir / name)
+    options = BatchOptions(str(images_dir), use_cache=False)
+    tasks = [options.task_for(str(images_dir / name)) for name in names]
+
+    results, pools = run_in_process_pool(tasks, log_dir, ordered=True)
+
+    assert [result.img for result in results] == [task.src_path for task in tasks]
+    assert [name for name, result in zip(names, results) if result.error] == ['b_crash.png']
+    assert all(result.orig_format == 'PNG' for result in results if not result.error)
+    assert pools >= 2
+    assert sorted(os.listdir(log_dir)) == ['a.png', 'c.png', 'd.png', 'e.png']
+
+
+def test_isolated_image_in_process_pool(tmp_path):
+    images_dir, log_dir = tmp_path / 'images', tmp_path / 'log'
+    images_dir.mkdir()
+    log_dir.mkdir()
+    names = ['a.png', 'b.png', 'c_huge.png', 'd.png', 'e.png', 'f.png']
+    for name in names:
+        size = (300, 200) if 'huge' in name else (64, 64)
+        Image.new('RGB', size, 'red').save(images_dir / name)
+    options = BatchOptions(str(images_dir), use_cache=False, max_pixels=10_000,
+                           huge_images='isolate')
+    tasks = [options.task_for(str(images_dir / name)) for name in names]
+
+    results, pools = run_in_process_pool(tasks, log_dir)
+
+    assert not any(result.error for result in results) and pools == 1
+    intervals = {name: tuple(map(float, (log_dir / name).read_text().split()))
+                 for name in names}
+    huge_start, huge_end = intervals.pop('c_huge.png')
+    for start, end in intervals.values():
+        assert end <= huge_start or start >= huge_end
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+import os
+import threading
+from concurrent.futures import BrokenExecutor
+from io import BytesIO
+
+import pytest
+from PIL import Image
+
+from optimize_images.data_structures import BatchOptions
+from optimize_images.exceptions import OIInvalidPathError
+from optimize_images.server import OptimizeClient, OptimizeServer, parse_address
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    socket_path = tmp_path_factory.mktemp("server") / "oi.sock"
+    address = f"unix:{socket_path}"
+    optimize_server = OptimizeServer(address, BatchOptions('', use_cache=False), jobs=2)
+    thread = threading.Thread(target=optimize_server.serve_forever, daemon=True)
+    thread.start()
+    yield address
+    optimize_server.shutdown()
+    thread.join()
+    optimize_server.close()
+    assert not socket_path.exists()
+
+
+@pytest.fixture
+def images(tmp_path, jpeg_data, png_data):
+    (tmp_path / 'png_with_transparency.png').write_bytes(png_data)
+    (tmp_path / 'photo.jpg').write_bytes(jpeg_data)
+    return tmp_path
+
+
+def test_parse_address():
+    assert parse_address("unix:/run/oi.sock") == "/run/oi.sock"
+    assert parse_address("127.0.0.1:8080") == ("127.0.0.1", 8080)
+    assert parse_address(":8080") == ("127.0.0.1", 8080)
+    assert parse_address("[::1]:8080") == ("::1", 8080)
+
+
+@pytest.mark.parametrize("address", ["0.0.0.0:8080", "192.168.1.10:8080",
+                                     "[::]:8080", "example.com:8080"])
+def test_non_loopback_address_refused(address):
+    with pytest.raises(OIInvalidPathError, match="loopback"):
+        parse_address(address)
+
+
+def test_optimize_paths(server, images):
+    with OptimizeClient(server) as client:
+        results = list(client.optimize([str(images), str(images / "missing")], quality=70))
+
+        assert sorted(os.path.basename(r.img) for r in results) == \
+            ['photo.jpg', 'png_with_transparency.png']
+        assert client.summary['found_files'] == 2
+        assert client.errors == [str(images / "missing")]
+
+        # The same connection can be used for more requests
+        stats = client.stats()
+        assert stats['processed_files'] >= 2
+        assert stats['queue_depth'] >= 0
+
+
+def test_optimize_data(server, jpeg_data):
+    with OptimizeClient(server) as client:
+        result, out_data, filename = client.optimize_data(jpeg_data, 'photo.jpg', max_w=100)
+
+    assert filename == 'photo.jpg'
+    assert result.was_downsized
+    assert Image.open(BytesIO(out_data)).width == 100
+
+
+def test_invalid_options(server, images):
+    with OptimizeClient(server) as client:
+        with pytest.raises(ValueError, match="Unsupported option"):
+            list(client.optimize([str(images)], src_path='/'))
+        assert client.stats()['active_jobs'] == 0
+
+
+def test_ipv6_loopback(images):
+    with OptimizeServer("[::1]:0", BatchOptions('', use_cache=False), jobs=1) as optimize_server:
+        thread = threading.Thread(target=optimize_server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            with OptimizeClient(f"[::1]:{optimize_server.address[1]}") as client:
+                assert len(list(client.optimize([str(images)]))) == 2
+        finally:
+            optimize_server.shutdown()
+            thread.join()
+
+
+def test_worker_crash(tmp_path, images, jpeg_data):
+    address = f"unix:{tmp_path / 'oi.sock'}"
+    with OptimizeServer(address, BatchOptions('', use_cache=False), jobs=2) as optimize_server:
+        thread = threading.Thread(target=optimize_server.serve_forever, daemon=True)
+        thread.start()
+        try:
+            with OptimizeClient(address) as client:
+                for request in ('data', 'paths'):
+                    with pytest.raises(BrokenExecutor):
+                        optimize_server.executor.submit(os._exit, 1).result()
+
+                    if request == 'data':
+                        result, _, _ = client.optimize_data(jpeg_data, 'photo.jpg')
+                        assert result.was_optimized
+                    else:
+                        results = list(client.optimize([str(images)]))
+                        assert len(results) == 2 and not any(r.error for r in results)
+                assert client.stats()['queue_depth'] == 0
+        finally:
+            optimize_server.shutdown()
+            thread.join()
@@ -0,0 +1,238 @@
+#!/usr/bin/env python3
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import Executor, Future
+
+from PIL import Image
+from watchdog.events import FileClosedEvent, FileCreatedEvent, FileModifiedEvent
+from watchdog.events import FileMovedEvent
+
+from optimize_images import file_utils
+from optimize_images.data_structures import BatchOptions, OutputConfiguration, TaskResult
+from optimize_images.do_optimization import do_optimization
+from optimize_images.watch import OptimizeImageEventHandler, RecentPaths
+from optimize_images.watch import WriteReadinessTracker
+
+TEST_IMAGES = os.path.join(os.path.dirname(__file__), 'test-images')
+
+
+def finished_future(path, was_optimized=True):
+    future = Future()
+    future.set_result(TaskResult(path, 'PNG', 'PNG', 'RGB', 'RGB', 0, 0, 1000, 800,
+                                 was_optimized, False, False, False,
+                                 OutputConfiguration(False, False, True)))
+    return future
+
+
+def test_directory_syncs_are_grouped(tmp_path, monkeypatch):
+    synced = []
+    monkeypatch.setattr(file_utils, 'fsync_dir', synced.append)
+    (tmp_path / 'a').mkdir()
+    (tmp_path / 'b').mkdir()
+
+    handler = OptimizeImageEventHandler(BatchOptions(str(tmp_path)).task_for(str(tmp_path)),
+                                        executor=None, max_in_flight=8)
+    try:
+        paths = [tmp_path / 'a' / '1.png', tmp_path / 'a' / '2.png', tmp_path / 'b' / '3.png']
+        for path in paths:
+            handler._slots.acquire()
+            handler.on_finished(str(path), finished_future(str(path)))
+        handler._slots.acquire()
+        handler.on_finished(str(tmp_path / '4.png'), finished_future(str(tmp_path / '4.png'), False))
+
+        assert synced == []
+        handler.sync_dirs()
+        assert sorted(synced) == [str(tmp_path / 'a'), str(tmp_path / 'b')]
+        handler.sync_dirs()
+        assert len(synced) == 2
+    finally:
+        handler.stop()
+
+
+class ReadyPaths:
+    """ Collects the paths reported as ready by a WriteReadinessTracker. """
+
+    def __init__(self):
+        self.paths = []
+        self.event = threading.Event()
+
+    def __call__(self, path):
+        self.paths.append(path)
+        self.event.set()
+
+
+class RecordingExecutor(Executor):
+    """ Records the tasks submitted, without actually processing them. """
+
+    def __init__(self):
+        self.tasks = []
+        self.submitted = threading.Event()
+
+    def submit(self, fn, task):
+        self.tasks.append(task)
+        self.submitted.set()
+        return finished_future(task.src_path)
+
+
+def test_recent_paths_eviction():
+    paths = RecentPaths(max_size=2)
+    paths.add('a')
+    paths.add('b')
+    paths.add('a')  # Now the most recently added
+    paths.add('c')
+    assert 'a' in paths and 'c' in paths and 'b' not in paths
+    assert len(paths) == 2
+
+
+def test_debounce_coalesces_events(tmp_path):
+    path = str(tmp_path / 'a.png')
+    open(path, 'wb').close()
+    ready = ReadyPaths()
+    tracker = WriteReadinessTracker(ready, debounce=0.2)
+    try:
+        for _ in range(5):
+            tracker.touch(path)
+            time.sleep(0.05)
+        assert ready.event.wait(2)
+        time.sleep(0.4)
+        assert ready.paths == [path]
+        assert not tracker.is_pending(path)
+    finally:
+        tracker.stop()
+
+
+def test_file_still_growing_not_ready(tmp_path):
+    path = str(tmp_path / 'a.png')
+    ready = ReadyPaths()
+    tracker = WriteReadinessTracker(ready, debounce=0.1)
+    try:
+        with open(path, 'wb') as file:
+            tracker.touch(path)
+            # Written without any more events (as with some network shares)
+            for _ in range(10):
+                file.write(b'x' * 1000)
+                file.flush()
+                time.sleep(0.05)
+            assert ready.paths == []
+        assert ready.event.wait(2)
+        assert ready.paths == [path]
+    finally:
+        tracker.stop()
+
+
+def test_finished_bypasses_debounce(tmp_path):
+    path = str(tmp_path / 'a.png')
+    open(path, 'wb').close()
+    ready = ReadyPaths()
+    tracker = WriteReadinessTracker(ready, debounce=60)
+    try:
+        tracker.touch(path)
+        tracker.finished(path)
+        assert ready.event.wait(2)
+        assert ready.paths == [path]
+        assert not tracker.is_pending(path)
+    finally:
+        tracker.stop()
+
+
+def test_closed_file_submitted_once(tmp_path):
+    executor = RecordingExecutor()
+    handler = OptimizeImageEventHandler(BatchOptions(str(tmp_path)).task_for(str(tmp_path)),
+                                        executor, max_in_flight=8)
+    try:
+        path = str(tmp_path / 'a.png')
+        open(path, 'wb').close()
+        handler.on_created(FileCreatedEvent(path))
+        handler.on_modified(FileModifiedEvent(path))
+        handler.on_closed(FileClosedEvent(path))
+        assert executor.submitted.wait(2)
+        handler.on_modified(FileModifiedEvent(path))  # Saving the optimized image
+        time.sleep(0.2)
+    finally:
+        handler.stop()
+    assert [task.src_path for task in executor.tasks] == [path]
+
+
+def test_renamed_partial_file_submitted_once(tmp_path):
+    executor = RecordingExecutor()
+    handler = OptimizeImageEventHandler(BatchOptions(str(tmp_path)).task_for(str(tmp_path)),
+                                        executor, max_in_flight=8)
+    try:
+        part_path, path = str(tmp_path / 'a.jpg.part'), str(tmp_path / 'a.jpg')
+        open(part_path, 'wb').close()
+        handler.on_created(FileCreatedEvent(part_path))
+        handler.on_modified(FileModifiedEvent(part_path))
+        os.rename(part_path, path)
+        handler.on_moved(FileMovedEvent(part_path, path))
+        assert executor.submitted.wait(2)
+        handler.on_created(FileCreatedEvent(path))
+        handler.on_closed(FileClosedEvent(path))
+        time.sleep(0.2)
+    finally:
+        handler.stop()
+    assert [task.src_path for task in executor.tasks] == [path]
+
+
+def test_ready_files_queued_when_executor_is_busy(tmp_path):
+    class PendingExecutor(RecordingExecutor):
+        def submit(self, fn, task):
+            super().submit(fn, task)
+            self.future = Future()
+            return self.future
+
+    executor = PendingExecutor()
+    handler = OptimizeImageEventHandler(BatchOptions(str(tmp_path)).task_for(str(tmp_path)),
+                                        executor, max_in_flight=1)
+    try:
+        paths = [str(tmp_path / 'a.png'), str(tmp_path / 'b.png')]
+        for path in paths:
+            open(path, 'wb').close()
+            handler.submit(path)  # Doesn't wait for the executor
+        assert executor.submitted.wait(2)
+        time.sleep(0.2)
+        assert len(executor.tasks) == 1
+
+        executor.submitted.clear()
+        executor.future.set_result(finished_future(paths[0]).result())
+        assert executor.submitted.wait(2)
+        assert [task.src_path for task in executor.tasks] == paths
+        executor.future.set_result(finished_future(paths[1]).result())
+    finally:
+        handler.stop()
+    assert handler.new_files == 2
+
+
+def test_images_processed_by_executor(tmp_path):
+    class SyncExecutor(Executor):
+        """ Runs each task right away, in the calling thread. """
+
+        def __init__(self):
+            self.calls = []
+
+        def submit(self, fn, *args):
+            self.calls.append((fn, args))
+            future = Future()
+            future.set_result(fn(*args))
+            return future
+
+    executor = SyncExecutor()
+    task = BatchOptions(str(tmp_path), use_cache=False,
+                        output_config=OutputConfiguration(False, False, True)).task_for(str(tmp_path))
+    handler = OptimizeImageEventHandler(task, executor, max_in_flight=2)
+    try:
+        paths = [str(tmp_path / 'a.png'), str(tmp_path / 'b.png')]
+        shutil.copy(os.path.join(TEST_IMAGES, 'png_with_transparency.png'), paths[0])
+        Image.new('RGB', (8, 8)).save(paths[1], optimize=True)
+        orig_sizes = [os.path.getsize(path) for path in paths]
+        for path in paths:
+            handler.submit(path)
+    finally:
+        handler.stop()
+
+    assert [args[0].src_path for _, args in executor.calls] == paths
+    assert all(fn is do_optimization for fn, _ in executor.calls)
+    assert (handler.new_files, handler.optimized_files) == (2, 1)
+    assert handler.total_src_size == sum(orig_sizes)
+    assert handler.total_bytes_saved == orig_sizes[0] - os.path.getsize(paths[0]) > 0